@@ -1,7 +1,7 @@
 import json
 import logging
 from typing import Optional
-from mongo.utils import logger
+from mongo.utils import logger, get_redis_url, run_in_background
 from flask import Flask
 from flask_socketio import SocketIO
 from model import *
@@ -32,6 +32,16 @@ def setup_app(
     def on_sandbox_not_found(_):
         return HTTPError('There are no sandbox available', 503)
 
+    @app.errorhandler(RateLimitExceeded)
+    def on_rate_limit_exceeded(e: RateLimitExceeded):
+        resp, status = HTTPError(
+            str(e),
+            429,
+            data={'retryAfter': e.retry_after},
+        )
+        resp.headers['Retry-After'] = str(e.retry_after)
+        return resp, status
+
     app.url_map.strict_slashes = False
     app.json_encoder = PyShareJSONEncoder
     # Override flask's config by core config
@@ -65,24 +75,38 @@ def setup_app(
             ' use this under production mode', )
         from model.dummy import dummy_api
         app.register_blueprint(dummy_api, url_prefix='/dummy')
-    # Setup SocketIO server
+    # Setup SocketIO server, emits are relayed by redis so that sockets
+    # connected to other workers also receive them
     socketio = SocketIO(cors_allowed_origins='*')
-    socketio.on_namespace(Notifier(Notifier.namespace))
-    socketio.init_app(app)
+    Notifier.setup(socketio)
+    socketio.init_app(app, message_queue=get_redis_url())
     try:
-        init = engine.AppConfig.objects(key='init').get()
-    except DoesNotExist:
-        init = engine.AppConfig(
-            id='init',
+        engine.AppConfig.objects(key='init').update_one(
+            upsert=True,
+            set_on_insert__value=True,
+        )
+    except NotUniqueError:
+        # Another worker has created it
+        pass
+    # Setup environment for testing, only the worker which claims the flag
+    # runs it. The flag is cleared only after it succeeds so that a failed
+    # setup runs again on next start
+    if engine.AppConfig.objects(
+            key='init',
             value=True,
-        ).save()
-    # Setup environment for testing
-    if init.value == True:
+    ).modify(set__value='running'):
         logger().info('First run. Start setup process')
-        if env is not None:
-            setup_env(env)
-        sandbox.init()
-        init.update(value=False)
+        try:
+            if env is not None:
+                setup_env(env)
+        except Exception:
+            engine.AppConfig.objects(key='init').update_one(set__value=True)
+            raise
+        engine.AppConfig.objects(key='init').update_one(set__value=False)
+    # Sandboxes in config may change between deploys
+    sandbox.init()
+    # Resume purges of removed students interrupted by last shutdown
+    run_in_background(Course.resume_purges)
     return app
 
 
@@ -221,6 +245,7 @@ def setup_course(courses):
                 for s in students:
                     s.update(add_to_set__courses=c.obj)
                 c.update(push_all__students=students)
+                c.enroll(students)
             # Add problems if specified
             problems = course_data.get('problems')
             if problems is not None:
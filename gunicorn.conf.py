@@ -1,8 +1,13 @@
+import os
+
 bind = '0.0.0.0:8080'
 timeout = 60
 
 errorlog = 'logs/error.log'
 accesslog = 'logs/access.log'
 
-workers = 1
+# Socket.IO emits are shared by the redis message queue, but gunicorn can't
+# route long-polling requests of a session to the same worker. Raise it only
+# if clients connect with websocket transport.
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
 worker_class = 'eventlet'
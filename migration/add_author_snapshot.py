@@ -0,0 +1,39 @@
+from mongo.config import config
+from pymongo import MongoClient
+
+client = MongoClient(config['MONGO']['HOST'])
+db = client[config['MONGO']['DB']]
+
+users = db['user'].find(
+    {},
+    {
+        'username': 1,
+        'displayName': 1,
+        'school': 1,
+        'role': 1,
+        'md5': 1,
+    },
+)
+for user in users:
+    snapshot = {
+        'id': user['_id'],
+        'username': user['username'],
+        'displayName': user['displayName'],
+        'school': user.get('school', ''),
+        'role': user.get('role', 2),  # STUDENT
+        'md5': user['md5'],
+    }
+    for collection in ('problem', 'comment', 'attachment'):
+        db[collection].update_many(
+            {'author': user['_id']},
+            {'$set': {
+                'authorSnapshot': snapshot
+            }},
+        )
+
+# Simple validation
+from mongo import engine
+for document in (engine.Problem, engine.Comment, engine.Attachment):
+    for d in document.objects():
+        d.validate()
+        assert d.author_snapshot.username == d.author.username
@@ -0,0 +1,46 @@
+from mongo.config import config
+from pymongo import MongoClient
+
+client = MongoClient(config['MONGO']['HOST'])
+db = client[config['MONGO']['DB']]
+
+# Problems which only allow one comment per user
+problems = {
+    p['_id']
+    for p in db['problem'].find(
+        {'allowMultipleComments': {
+            '$ne': True
+        }},
+        {'_id': 1},
+    )
+}
+keys = set()
+comments = db['comment'].find(
+    {
+        'depth': 0,
+        'status': 1,  # SHOW
+    },
+    {
+        'author': 1,
+        'problem': 1,
+    },
+).sort('created', 1)
+for comment in comments:
+    if comment['problem'] not in problems:
+        continue
+    key = f'{comment["author"]}:{comment["problem"]}'
+    # Keep the earliest one if there are duplicated comments
+    if key in keys:
+        continue
+    keys.add(key)
+    db['comment'].update_one(
+        {'_id': comment['_id']},
+        {'$set': {
+            'exclusiveKey': key
+        }},
+    )
+
+# Simple validation
+from mongo import engine
+for c in engine.Comment.objects():
+    c.validate()
@@ -0,0 +1,20 @@
+from mongo.config import config
+from pymongo import MongoClient
+
+client = MongoClient(config['MONGO']['HOST'])
+db = client[config['MONGO']['DB']]
+
+comments = list(db['comment'].find({}, {'liked': 1}))
+for comment in comments:
+    db['comment'].update_one(
+        {'_id': comment['_id']},
+        {'$set': {
+            'likeCount': len(comment.get('liked', []))
+        }},
+    )
+
+# Simple validation
+from mongo import engine
+for c in engine.Comment.objects():
+    c.validate()
+    assert c.like_count == len(c.liked)
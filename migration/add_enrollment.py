@@ -0,0 +1,33 @@
+from mongo.config import config
+from pymongo import MongoClient, UpdateOne
+
+client = MongoClient(config['MONGO']['HOST'])
+db = client[config['MONGO']['DB']]
+
+for course in db['course'].find({}, {'students': 1}):
+    students = course.get('students', [])
+    if len(students) == 0:
+        continue
+    db['enrollment'].bulk_write(
+        [
+            UpdateOne(
+                {
+                    'user': u,
+                    'course': course['_id']
+                },
+                {'$setOnInsert': {
+                    'user': u,
+                    'course': course['_id']
+                }},
+                upsert=True,
+            ) for u in students
+        ],
+        ordered=False,
+    )
+
+# Simple validation
+from mongo import engine
+
+engine.Enrollment.ensure_indexes()
+for c in engine.Course.objects():
+    assert engine.Enrollment.objects(course=c).count() == len(c.students)
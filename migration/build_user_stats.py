@@ -0,0 +1,10 @@
+from mongo import engine
+from mongo.user_stats import UserStats
+
+# Stats are also built lazily on first read, this script only warms them up
+UserStats.rebuild_all()
+
+# Simple validation
+for course in engine.Course.objects():
+    members = {course.teacher, *course.students}
+    assert UserStats.engine.objects(course=course).count() == len(members)
@@ -0,0 +1,74 @@
+import secrets
+from bson import ObjectId
+from mongo.config import config
+from pymongo import MongoClient, UpdateOne
+
+client = MongoClient(config['MONGO']['HOST'])
+db = client[config['MONGO']['DB']]
+
+# Notifications are now owned by their receiver. A notification could be
+# shared by several users, e.g. a new reply notifies both the comment and
+# the problem author, so the first receiver keeps it and each of others
+# gets a copy.
+users = list(db['user'].find({'notifs.0': {'$exists': True}}, {'notifs': 1}))
+existing = {n['_id'] for n in db['notif'].find({}, {'_id': 1})}
+# (user, old notification id) -> id of the notification owned by user
+owned = {}
+receivers = {}
+for user in users:
+    for notif_id in user['notifs']:
+        # Skip dangling references
+        if notif_id not in existing or (user['_id'], notif_id) in owned:
+            continue
+        if notif_id not in receivers:
+            receivers[notif_id] = user['_id']
+            owned[(user['_id'], notif_id)] = notif_id
+        else:
+            # Keep the creation time in id, so copies are sorted by time
+            # like the original in the inbox
+            owned[(user['_id'], notif_id)] = ObjectId(notif_id.binary[:4] +
+                                                      secrets.token_bytes(8))
+if receivers:
+    db['notif'].bulk_write([
+        UpdateOne({'_id': notif_id}, {'$set': {
+            'receiver': receiver
+        }}) for notif_id, receiver in receivers.items()
+    ])
+copies = {(k, v) for k, v in owned.items() if k[1] != v}
+originals = {
+    n['_id']: n
+    for n in db['notif'].find(
+        {'_id': {
+            '$in': [notif_id for (_, notif_id), _ in copies]
+        }})
+}
+if copies:
+    db['notif'].insert_many([{
+        **originals[notif_id],
+        '_id': new_id,
+        'receiver': user,
+    } for (user, notif_id), new_id in copies])
+# Other relations are read from the referencing documents
+db['user'].update_many(
+    {},
+    {'$unset': {
+        'problems': '',
+        'comments': '',
+        'likes': '',
+        'notifs': '',
+    }},
+)
+
+# Simple validation
+from mongo import engine
+for document in (engine.Comment, engine.Problem, engine.Notif):
+    document.ensure_indexes()
+for u in engine.User.objects():
+    u.validate()
+    assert 'comments' not in u.to_mongo()
+# Every notification a user had is owned by the user
+for (user, _), notif_id in owned.items():
+    assert db['notif'].count_documents({
+        '_id': notif_id,
+        'receiver': user,
+    }) == 1, (user, notif_id)
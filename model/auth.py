@@ -1,7 +1,9 @@
 # Standard library
 from functools import wraps
+from typing import Optional
+from bson import ObjectId
 # Related third party imports
-from flask import Blueprint, request, current_app
+from flask import Blueprint, request, current_app, after_this_request
 from flask.helpers import url_for
 # Local application
 from mongo import *
@@ -12,7 +14,13 @@ import secrets
 import csv
 import io
 
-__all__ = ['auth_api', 'login_required', 'identity_verify']
+__all__ = [
+    'auth_api',
+    'login_required',
+    'identity_verify',
+    'authenticate',
+    'InvalidTokenError',
+]
 
 auth_api = Blueprint('auth_api', __name__)
 
@@ -23,6 +31,70 @@ class InvalidTokenError(Exception):
     '''
 
 
+def load_course_claim(user: User, token: Optional[str]):
+    '''
+    Attach the course claim in `jwt` cookie to `user` if it's up to date,
+    otherwise refresh the cookie after this request
+    '''
+    if token is None:
+        return
+    payload = jwt_decode(token)
+    data = (payload or {}).get('data', {})
+    if data.get('_id') == str(user.id):
+        user.claim = User.verify_claim(data)
+    if user.claim is not None:
+        return
+
+    @after_this_request
+    def refresh_cookie(resp):
+        # Views which set `jwt` themselves have signed a fresh one
+        if not any(
+                c.startswith('jwt=')
+                for c in resp.headers.getlist('Set-Cookie')):
+            resp.set_cookie('jwt', user.cookie)
+        return resp
+
+
+def authenticate(token: Optional[str]) -> User:
+    '''
+    Get the user of a login token
+
+    Raises:
+        InvalidTokenError: Invalid, expired or inactive token
+    '''
+    if token is None:
+        raise InvalidTokenError('Token not found')
+    json = jwt_decode(token)
+    if json is None or not json.get('secret'):
+        raise InvalidTokenError('Invalid token')
+    cache = SessionCache()
+    session = cache.get(token)
+    if session is None:
+        generation = cache.generation(json['data'].get('_id'))
+        user = User(json['data'].get('_id'))
+        if not user:
+            raise InvalidTokenError('Invalid token')
+        session = cache.set(token, user, generation)
+    else:
+        # Skip loading user until the view needs it
+        user = User.lazy(
+            ObjectId(session['id']),
+            role=session['role'],
+            active=session['active'],
+        )
+    try:
+        if not secrets.compare_digest(
+                json['data'].get('userId'),
+                session['userId'],
+        ):
+            raise InvalidTokenError('Authorization expired')
+    except TypeError:
+        raise InvalidTokenError('Invalid token')
+    if not session['active']:
+        raise InvalidTokenError('Inactive user')
+    return user
+
+
 def login_required(func):
     '''Check if the user is login
 
@@ -36,24 +108,8 @@ def login_required(func):
     # TODO: provide more details about errors
     @Request.cookies(vars_dict={'token': 'piann'})
     def wrapper(token, *args, **kwargs):
-        if token is None:
-            raise InvalidTokenError('Token not found')
-        json = jwt_decode(token)
-        if json is None or not json.get('secret'):
-            raise InvalidTokenError('Invalid token')
-        user = User(json['data'].get('_id'))
-        if not user:
-            raise InvalidTokenError('Invalid token')
-        try:
-            if not secrets.compare_digest(
-                    json['data'].get('userId'),
-                    user.user_id,
-            ):
-                raise InvalidTokenError('Authorization expired')
-        except TypeError:
-            raise InvalidTokenError('Invalid token')
-        if not user.active:
-            raise InvalidTokenError('Inactive user')
+        user = authenticate(token)
+        load_course_claim(user, request.cookies.get('jwt'))
         kwargs['user'] = user
         return func(*args, **kwargs)
 
@@ -98,6 +154,9 @@ def session():
         Returns:
             - 200 Logout Success
         '''
+        token = request.cookies.get('piann')
+        if token is not None:
+            SessionCache().discard(token)
         cookies = {'jwt': None, 'piann': None}
         return HTTPResponse('Goodbye', cookies=cookies)
 
@@ -209,57 +268,32 @@ def batch_signup(user, csv_string, course):
     }
     if required_keys - {*user_data[0].keys()}:
         return HTTPError('Invalid csv format', 400)
-    users = {}
-    fails = []
-    exists = set()
+    rows = []
     for _u in user_data:
+        # get role
+        role = _u.get('role', engine.User.Role.STUDENT)
+        if role == '':
+            role = engine.User.Role.STUDENT
         try:
-            # Try to find user on system
-            new_user = User(
-                User.engine.objects.get(
-                    username=_u['username'],
-                    school=_u['school'],
-                ))
-            user_key = (_u['school'], _u['username'])
-            exists.add(user_key)
-            users[':'.join(user_key)] = new_user.pk
-            # add to course
-            if course:
-                course.add_student(new_user)
-        except DoesNotExist:
-            # get role
-            role = _u.get('role', engine.User.Role.STUDENT)
-            if role == '':
-                role = engine.User.Role.STUDENT
-            try:
-                role = int(role)
-            except ValueError:
-                return HTTPError('Role needs to be int', 400)
-            # Try to register a non-student user
-            # But the client is not admin
-            if role < engine.User.Role.STUDENT and user < 'admin':
-                return HTTPError('Only admins can change roles', 403)
-            # sign up a new user
-            try:
-                new_user = User.signup(
-                    username=_u['username'],
-                    password=_u['password'],
-                    display_name=_u['displayName'],
-                    school=_u['school'],
-                    course=getattr(course, 'obj', None),
-                    role=role,
-                )
-                users[':'.join((_u['school'], _u['username']))] = new_user.pk
-            except (ValidationError, ValueError) as e:
-                err = str(e)
-                fails.append({
-                    'username': _u['username'],
-                    'school': _u['school'],
-                    'err': err,
-                })
-                current_app.logger.error(
-                    f'fail to sign up for {_u["username"]}\n'
-                    f'error: {err}\n', )
+            role = int(role)
+        except ValueError:
+            return HTTPError('Role needs to be int', 400)
+        # Try to register a non-student user
+        # But the client is not admin
+        if role < engine.User.Role.STUDENT and user < 'admin':
+            return HTTPError('Only admins can change roles', 403)
+        rows.append({
+            'username': _u['username'],
+            'password': _u['password'],
+            'display_name': _u['displayName'],
+            'school': _u['school'],
+            'role': role,
+        })
+    users, exists, fails = User.batch_signup(
+        rows,
+        course=getattr(course, 'obj', None),
+    )
+    users = {':'.join(k): v for k, v in users.items()}
     if exists or fails:
         exists = [{
             'username': e[1],
@@ -1,6 +1,12 @@
 from functools import partial
+from urllib.parse import quote
 from typing import Iterable, Union, Optional
-from flask import Blueprint, send_file, request
+from flask import (
+    Blueprint,
+    Response,
+    request,
+    stream_with_context,
+)
 import dateutil.parser
 from .utils import *
 from .auth import *
@@ -18,19 +24,25 @@ def course_list(user):
     '''
     get a list of course with course name and teacher's name
     '''
-    cs = map(Course, engine.Course.objects)
+    enrolled = Course.enrolled_courses(user)
+    cs = [
+        c for c in map(Course, engine.Course.objects) if c.permission(
+            user=user,
+            req=Course.Permission.READ,
+            enrolled=c.id in enrolled,
+        )
+    ]
+    teachers = User.info_many(c.to_mongo()['teacher'] for c in cs)
+    teachers = {info['id']: info for info in teachers}
     cs = [{
         'id': c.id,
         'name': c.name,
-        'teacher': c.teacher.info,
+        'teacher': teachers.get(c.to_mongo()['teacher']),
         'description': c.description,
         'year': c.year,
         'semester': c.semester,
         'status': c.status,
-    } for c in cs if c.permission(
-        user=user,
-        req=Course.Permission.READ,
-    )]
+    } for c in cs]
     return HTTPResponse('here you are', data=cs)
 
 
@@ -46,8 +58,8 @@ def get_single_course(user, course):
     ret = {
         'name': course.name,
         'id': course.id,
-        'teacher': course.teacher.info,
-        'students': [s.info for s in course.students],
+        'teacher': User.info_many([course.to_mongo()['teacher']])[0],
+        'students': User.info_many(course.to_mongo().get('students', [])),
         'numOfProblems': len(comments_of_problems),
         'numOfComments': sum(map(len, comments_of_problems)),
         'description': course.description,
@@ -65,12 +77,13 @@ def get_single_course(user, course):
 def statistic(user, course):
     if not course.permission(user=user, req=Course.Permission.PARTICIPATE):
         return HTTPError('Not enough permission', 403)
-    users = map(User, course.students)
-    ret = []
-    for u in users:
-        s = u.statistic([course.obj])
-        s.update({'info': u.info})
-        ret.append(s)
+    users = course.to_mongo().get('students', [])
+    infos = {info['id']: info for info in User.info_many(users)}
+    stats = UserStats.course_statistic(course, users)
+    ret = [{
+        **s,
+        'info': infos.get(u),
+    } for u, s in zip(users, stats)]
     return HTTPResponse('ok', data=ret)
 
 
@@ -87,12 +100,44 @@ def oj_statistic(user: User, course: Course, pids: str):
         pids = [int(pid) for pid in pids.split(',')]
     except ValueError:
         return HTTPError('Invalid pid value', 400)
-    problems = [Problem(pid) for pid in pids]
-    if not all(problems):
+    courses = engine.Problem.objects(pk__in=pids).scalar('course')
+    courses = [*courses.no_dereference()]
+    if len(courses) != len({*pids}):
         return HTTPError('Problem not found', 404)
-    if any(p not in course.problems for p in problems):
+    if any(c.id != course.id for c in courses):
         return HTTPError(f'All problems must belong to {course}', 400)
-    return HTTPResponse(data=course.oj_statistic(problems))
+    return HTTPResponse(data=course.oj_statistic(pids))
+
+
+@course_api.get('/<course>/grade-matrix')
+@login_required
+@Request.args('pids', 'encoding')
+@Request.doc('course', Course)
+def get_grade_matrix(
+    user: User,
+    course: Course,
+    pids: Optional[str],
+    encoding: Optional[str],
+):
+    '''
+    Students × problems matrices in columnar arrays
+    '''
+    if not course.permission(user=user, req=Course.Permission.WRITE):
+        return HTTPError('Not enough permission', 403)
+    if encoding is None:
+        encoding = 'json'
+    if encoding not in GradeMatrix.ENCODINGS:
+        return HTTPError(f'Unsupported encoding {encoding}', 400)
+    if pids:
+        try:
+            pids = [int(pid) for pid in pids.split(',')]
+        except ValueError:
+            return HTTPError('Invalid pid value', 400)
+        cnt = engine.Problem.objects(pk__in=pids, course=course.id).count()
+        if cnt != len({*pids}):
+            return HTTPError(f'All problems must belong to {course}', 400)
+    matrix = GradeMatrix(course, pids or None)
+    return HTTPResponse(data=matrix.to_dict(encoding))
 
 
 @course_api.get('/<name>/permission')
@@ -195,30 +240,15 @@ def update_students(user, course, users):
     if action == 'insert':
         warning = [*({*course.students} & {*[u.obj for u in u_users]})]
         course.update(push_all__students=users)
+        course.enroll(u.pk for u in u_users if u)
     elif action == 'remove':
         warning = [*({*[u.obj for u in u_users]} - {*course.students})]
-        course.update(pull_all__students=users)
-        for user in u_users:
-            if user.obj in warning:
-                continue
-            for problem in course.problems:
-                if user == problem.author:
-                    problem.delete()
-            course.reload()
-            for comment in engine.Comment.objects(
-                    author=user.pk,
-                    problem__in=course.problems,
-            ):
-                Comment(comment).delete()
-            for comment in engine.Comment.objects(
-                    liked=user.pk,
-                    problem__in=course.problems,
-            ):
-                comment.update(pull__liked=user.obj)
-                user.update(pull__likes=comment)
+        # Problems, comments and likes are cleaned up in background
+        course.remove_students(u.pk for u in u_users
+                               if u and u.obj not in warning)
     # some users fail
     if len(warning):
-        warning = list(user.info for user in warning)
+        warning = User.info_many(warning)
         return HTTPError(
             'fail to update students',
             400,
@@ -253,16 +283,37 @@ def update_tags(user, course, push, pop, category):
 
 @course_api.get('/<course>/statistic-file')
 @login_required
+@Request.args('format', 'columns')
 @Request.doc('course', Course)
-def get_statistic_file(user, course: Course):
+def get_statistic_file(
+    user,
+    course: Course,
+    format: Optional[str],
+    columns: Optional[str],
+):
     if not course.permission(user=user, req=Course.Permission.WRITE):
         return HTTPError('Not enough permission', 403)
-    f = course.statistic_file()
-    return send_file(
-        f,
-        as_attachment=True,
-        max_age=30,
-        download_name=f'{course.name}-statistic.csv',
+    formats = {
+        'csv': (course.statistic_csv, 'text/csv'),
+        'ndjson': (course.statistic_ndjson, 'application/x-ndjson'),
+    }
+    format = format or 'csv'
+    if format not in formats:
+        return HTTPError(f'Unsupported format {format}', 400)
+    columns = [*filter(None, (columns or '').split(','))]
+    if any(c not in Course.STATISTIC_COLUMNS for c in columns):
+        return HTTPError('Invalid columns', 400)
+    gen, mimetype = formats[format]
+    # Rows are generated while sending, so the first byte doesn't wait
+    # for statistic of every student
+    return Response(
+        stream_with_context(gen(columns)),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': "attachment; filename*=UTF-8''"
+            f'{quote(course.name)}-statistic.{format}',
+            'Cache-Control': 'max-age=30',
+        },
     )
 
 
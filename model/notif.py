@@ -1,3 +1,5 @@
+from bson import ObjectId
+from bson.errors import InvalidId
 from flask import Blueprint
 
 from .utils import *
@@ -11,6 +13,51 @@ notif_api = Blueprint('notif_api', __name__)
 
 @notif_api.route('/', methods=['GET'])
 @login_required
-def get_notifs(user):
-    notifs = [Notif(notif).to_dict() for notif in user.notifs]
-    return HTTPResponse('success', data=notifs)
+@Request.args('cursor', 'limit')
+def get_notifs(user, cursor, limit):
+    '''
+    A page of notifications, pass `next` as `cursor` to get the next page.
+    Clients which send neither `cursor` nor `limit` get the whole list.
+    '''
+    if cursor is None and limit is None:
+        return HTTPResponse('success', data=Notif.all_of(user))
+    try:
+        if cursor is not None:
+            cursor = ObjectId(cursor)
+        if limit is not None:
+            limit = int(limit)
+    except (InvalidId, ValueError):
+        return HTTPError('Invalid cursor or limit', 400)
+    if limit is not None and limit <= 0:
+        return HTTPError('Invalid cursor or limit', 400)
+    notifs, next_cursor = Notif.inbox(user, cursor=cursor, limit=limit)
+    return HTTPResponse(
+        'success',
+        data={
+            'notifs': notifs,
+            'next': next_cursor,
+            'unread': Notif.unread_count(user),
+        },
+    )
+
+
+@notif_api.route('/unread-count', methods=['GET'])
+@login_required
+def get_unread_count(user):
+    return HTTPResponse(data={'unread': Notif.unread_count(user)})
+
+
+@notif_api.route('/read', methods=['PUT'])
+@login_required
+@Request.json('ids')
+def read_notifs(user, ids):
+    '''
+    Mark notifications as read, all of them if `ids` is not provided
+    '''
+    if ids is not None:
+        try:
+            ids = [ObjectId(_id) for _id in ids]
+        except (InvalidId, TypeError):
+            return HTTPError('Invalid notification ids', 400)
+    Notif.read_many(user, ids)
+    return HTTPResponse(data={'unread': Notif.unread_count(user)})
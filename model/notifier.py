@@ -1,14 +1,57 @@
 from functools import wraps
-from flask_socketio import Namespace, emit, send, join_room, leave_room
+from typing import Optional
+from flask import current_app, request
+from flask_socketio import (
+    Namespace,
+    SocketIO,
+    join_room,
+    leave_room,
+)
 import json
+from mongo import ObjectIdEncoder
+from mongo.event import notif_created, notif_read
+from .auth import authenticate, InvalidTokenError
 
 __all__ = ['fe_update', 'Notifier']
 
 
 class Notifier(Namespace):
+    '''
+    Rooms only live in the worker holding the socket, emits are published
+    to every worker by the message queue and delivered to local members
+    '''
     namespace = '/notifier'
+    # Server of the running app, which can push without a request context
+    server: Optional[SocketIO] = None
+
+    @classmethod
+    def setup(cls, socketio: SocketIO):
+        socketio.on_namespace(cls(cls.namespace))
+        cls.server = socketio
+
+    @staticmethod
+    def user_room(_id) -> str:
+        return f'user-{_id}'
+
+    def on_connect(self, auth=None):
+        '''
+        Sockets with a login cookie join the room of their user to receive
+        notifications, others can still subscribe topics
+        '''
+        token = request.cookies.get('piann')
+        if token is None:
+            return
+        try:
+            user = authenticate(token)
+        except InvalidTokenError as e:
+            current_app.logger.info(f'Socket login failed. [err={e}]')
+            return False
+        join_room(self.user_room(user.id))
 
     def on_subscribe(self, data):
+        # User rooms are only joined on connect after authentication
+        if data['topic'] == 'user':
+            return
         room = f"{data['topic']}-{data['id']}"
         join_room(room)
 
@@ -40,7 +83,11 @@ def fe_update(topic, *uris):
                 *(f'data/{uri}' for uri in uris),
             )
             pk = '-'.join(map(str, data))
-            emit(
+            if Notifier.server is None:
+                return ret
+            # Emit by the server so it goes through the message queue and
+            # reaches subscribers on every worker
+            Notifier.server.emit(
                 'refetch',
                 {
                     'topic': topic,
@@ -54,3 +101,35 @@ def fe_update(topic, *uris):
         return wrapper
 
     return decorator
+
+
+def push_notif(receiver, notif, **ks):
+    '''
+    Push a new notification with the change of unread count to its receiver
+    '''
+    if Notifier.server is None:
+        return
+    Notifier.server.emit(
+        'notif',
+        {
+            'notif': json.loads(json.dumps(notif, cls=ObjectIdEncoder)),
+            'unreadDelta': 1,
+        },
+        room=Notifier.user_room(receiver),
+        namespace=Notifier.namespace,
+    )
+
+
+def push_read(receiver, count, **ks):
+    if Notifier.server is None:
+        return
+    Notifier.server.emit(
+        'unread',
+        {'unreadDelta': -count},
+        room=Notifier.user_room(receiver),
+        namespace=Notifier.namespace,
+    )
+
+
+notif_created.connect(push_notif)
+notif_read.connect(push_read)
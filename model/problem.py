@@ -92,6 +92,35 @@ def get_single_problem(user, problem):
     )
 
 
+@problem_api.get('/<int:pid>/comments')
+@Request.args('after', 'limit')
+@login_required
+@Request.doc('pid', 'problem', Problem)
+def get_problem_comments(user, problem, after, limit):
+    '''
+    Get a page of comments under this problem, use `next` in the response
+    as `after` to get the next page
+    '''
+    if not problem.permission(user=user, req=Problem.Permission.READ):
+        return HTTPError('Not enough permission', 403)
+    try:
+        after = int(after or 0)
+        limit = int(limit or 20)
+    except ValueError:
+        return HTTPError('after and limit only accept integer', 400)
+    if not 0 < limit <= 100:
+        return HTTPError('limit should be in range [1, 100]', 400)
+    return HTTPResponse(
+        'here you are, bro',
+        data=Comment.thread(
+            problem=problem,
+            user=user,
+            after=after,
+            limit=limit,
+        ),
+    )
+
+
 @problem_api.get('/<int:pid>/io')
 @login_required
 @Request.doc('pid', 'problem', Problem)
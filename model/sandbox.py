@@ -1,5 +1,6 @@
 from flask import Blueprint
 from typing import Optional
+from datetime import timedelta
 from mongo import *
 from mongo import engine
 from .auth import *
@@ -77,3 +78,24 @@ def delete_one(url: str):
     sandbox = engine.Sandbox.objects(url=url).get()
     sandbox.delete()
     return HTTPResponse()
+
+
+@sandbox_api.get('/latency')
+@Request.args('window')
+def get_latency(window: Optional[str]):
+    '''
+    Get judge latency percentiles of each stage in last `window` seconds
+    '''
+    try:
+        window = timedelta(seconds=int(window or 3600))
+    except ValueError:
+        return HTTPError('window should be an integer', 400)
+    return HTTPResponse(data=Submission.latency_statistic(window))
+
+
+@sandbox_api.get('/rate-limit')
+def get_rate_limit():
+    '''
+    Get allowed and rejected count of submission rate limit
+    '''
+    return HTTPResponse(data=RateLimiter('submission').metrics())
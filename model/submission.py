@@ -109,25 +109,19 @@ def change_state(user, submission: Submission, state):
     if not comment.permission(user=user, req=Comment.Permission.UPDATE_STATE):
         return HTTPError('Permission denied.', 403)
     try:
-        submission.update(state=state)
+        previous_state = submission.update_state(state)
     except engine.ValidationError as ve:
         return HTTPError(
             'Invalid data',
             400,
             data=ve.to_dict(),
         )
-    is_accepted = lambda s: s.state == submission.State.ACCEPT
-    comment.update(acceptance=comment.Acceptance.
-                   ACCEPTED if any(filter(
-                       is_accepted,
-                       comment.submissions,
-                   )) else comment.Acceptance.REJECTED)
+    comment.on_state_changed_ins(state, previous_state)
     # notify the author of the creation
     info = Notif.types.Grade(
         comment=comment.pk,
         result=state,
         problem=comment.problem,
     )
-    notif = Notif.new(info)
-    comment.author.update(push__notifs=notif.pk)
+    Notif.new(info, comment.author)
     return HTTPResponse('ok')
@@ -12,7 +12,7 @@ user_api = Blueprint('user', __name__)
 @user_api.route('/', methods=['GET'])
 @login_required
 def get_all_user(user):
-    users = [u.info for u in map(User, engine.User.objects)]
+    users = User.info_many(engine.User.objects.scalar('id'))
     return HTTPResponse('here you are.', data=users)
 
 
@@ -23,6 +23,15 @@ def get_user(user, the_user):
     return HTTPResponse('here you are.', data=the_user.info)
 
 
+@user_api.get('/cache/stats')
+@identity_verify(engine.User.Role.ADMIN)
+def get_cache_stats(user):
+    '''
+    Get hit rate of user info cache
+    '''
+    return HTTPResponse('here you are.', data=UserInfoCache().stats())
+
+
 # TODO: statistic cause a lot of query, make a cache for better performance
 @user_api.route('/<student>/statistic', methods=['GET'])
 @Request.doc('student', 'student', User)
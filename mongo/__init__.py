@@ -14,6 +14,10 @@ from . import sandbox
 from . import token
 from . import task
 from . import requirement
+from . import rate_limit
+from . import cache
+from . import user_stats
+from . import grade_matrix
 
 from .engine import *
 from .user import *
@@ -31,6 +35,10 @@ from .sandbox import *
 from .token import *
 from .task import *
 from .requirement import *
+from .rate_limit import *
+from .cache import *
+from .user_stats import *
+from .grade_matrix import *
 
 __all__ = (
     *engine.__all__,
@@ -49,4 +57,8 @@ __all__ = (
     *token.__all__,
     *task.__all__,
     *requirement.__all__,
+    *rate_limit.__all__,
+    *cache.__all__,
+    *user_stats.__all__,
+    *grade_matrix.__all__,
 )
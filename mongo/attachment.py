@@ -68,17 +68,23 @@ class Attachment(MongoBase, engine=engine.Attachment):
         self.patch_notes.append(patch_note)
         self.save()
 
-        # TODO: make query faster
-        for problem in engine.Problem.objects(attachments__source=self.obj):
+        problems = engine.Problem.objects(attachments__source=self.obj).only(
+            'author',
+            'attachments',
+        ).no_dereference()
+        notifs = []
+        for problem in problems:
             for attachment in problem.attachments:
-                if self == attachment.source:
-                    info = Notif.types.AttachmentUpdate(
-                        attachment=self.obj,
-                        problem=problem,
-                        name=attachment.filename,
-                    )
-                    notif = Notif.new(info)
-                    problem.author.update(push__notifs=notif.pk)
+                if getattr(attachment.source, 'id', None) != self.id:
+                    continue
+                info = Notif.types.AttachmentUpdate(
+                    attachment=self.obj,
+                    problem=problem,
+                    name=attachment.filename,
+                )
+                notifs.append((info, problem.author.id))
+        # Notify every author with one insert
+        Notif.new_many(notifs)
 
     @classmethod
     def to_tag_list(cls, tags_str: Optional[str]):
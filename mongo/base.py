@@ -25,7 +25,29 @@ class MongoBase:
                 new.obj = new.engine(id=pk)
         return new
 
+    @classmethod
+    def lazy(cls, pk, **known):
+        '''
+        Wrap an existing document without fetching it, the document is
+        loaded on first access to a field other than its pk and `known`
+        '''
+        new = super().__new__(cls)
+        new.__dict__['_lazy'] = (pk, known)
+        return new
+
     def __getattr__(self, name):
+        lazy = self.__dict__.get('_lazy')
+        if lazy is not None:
+            pk, known = lazy
+            if name in ('pk', 'id'):
+                return pk
+            if name in known:
+                return known[name]
+            if name == 'obj':
+                obj = self.engine.objects(pk=pk).get()
+                del self.__dict__['_lazy']
+                self.__dict__['obj'] = obj
+                return obj
         return self.obj.__getattribute__(name)
 
     def __setattr__(self, name, value):
@@ -40,6 +62,9 @@ class MongoBase:
         return self.id == other.id
 
     def __bool__(self):
+        # Lazy wrapper is only created for existing document
+        if '_lazy' in self.__dict__:
+            return True
         try:
             return self._qs.filter(pk=self.pk, **self.qs_filter).__bool__()
         except engine.ValidationError:
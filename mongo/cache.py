@@ -0,0 +1,431 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+from bson import ObjectId
+from . import engine
+from .utils import get_redis_client, ObjectIdEncoder, RedisScript
+
+__all__ = (
+    'UserInfoCache',
+    'SessionCache',
+    'EnrollmentVersion',
+    'TokenCache',
+    'UnreadCounter',
+)
+
+# KEYS: counters, ARGV: deltas of each counter
+# Only existing counters are updated, the missing ones are counted from db
+# when they are read
+ADD_IF_EXISTS_SCRIPT = RedisScript('''
+for i = 1, #KEYS do
+    if redis.call('exists', KEYS[i]) == 1 then
+        redis.call('incrby', KEYS[i], ARGV[i])
+    end
+end
+return 0
+''')
+
+# KEYS: (entry, generation) pairs
+# ARGV: lifetime of entries, then (generation read before loading the
+#   value, value) pairs
+# An entry is written only if its generation is not changed, that is, it
+# isn't invalidated while the value is being loaded. Return the number of
+# entries written.
+SET_IF_GENERATION_SCRIPT = RedisScript('''
+local n = 0
+for i = 1, #KEYS, 2 do
+    local generation = redis.call('get', KEYS[i + 1]) or ''
+    if generation == ARGV[i + 1] then
+        redis.call('set', KEYS[i], ARGV[i + 2], 'EX', ARGV[1])
+        n = n + 1
+    end
+end
+return n
+''')
+
+# KEYS: counters, ARGV: lifetime of counters, initial value
+# A missing counter restarts from the initial value instead of 0, so it
+# never goes back to a value it had before
+BUMP_SCRIPT = RedisScript('''
+for i = 1, #KEYS do
+    redis.call('set', KEYS[i], ARGV[2], 'NX')
+    redis.call('incr', KEYS[i])
+    redis.call('expire', KEYS[i], ARGV[1])
+end
+return 0
+''')
+
+
+class UserInfoCache:
+    '''
+    Redis cache of `User.info`, entries are invalidated when the user
+    document is updated
+    '''
+    # Entry lifetime (seconds), only a safety net for missed invalidation
+    EX = 24 * 60 * 60
+
+    def __init__(self):
+        self._client = get_redis_client()
+
+    @staticmethod
+    def key(_id) -> str:
+        return f'user-info:{_id}'
+
+    @staticmethod
+    def generation_key(_id) -> str:
+        return f'user-info-gen:{_id}'
+
+    @property
+    def stats_key(self):
+        return 'user-info:stats'
+
+    @staticmethod
+    def dumps(info: Dict[str, Any]) -> str:
+        return json.dumps(info, cls=ObjectIdEncoder)
+
+    @staticmethod
+    def loads(raw: bytes) -> Dict[str, Any]:
+        info = json.loads(raw)
+        info['id'] = ObjectId(info['id'])
+        return info
+
+    def get_many(self, ids: Iterable[ObjectId]) -> List[Dict[str, Any]]:
+        '''
+        Get info of users in one multi-get, missed entries are loaded
+        with one query and written back. The result keeps the order of
+        `ids`, non-existent users are skipped.
+        '''
+        ids = [*ids]
+        if len(ids) == 0:
+            return []
+        raws = self._client.mget([self.key(_id) for _id in ids])
+        infos = {
+            _id: self.loads(raw)
+            for _id, raw in zip(ids, raws) if raw is not None
+        }
+        missed = [_id for _id in ids if _id not in infos]
+        if missed:
+            # Read generations before loading, so an invalidation during
+            # loading stops the stale info from being written back
+            generations = dict(
+                zip(
+                    missed,
+                    self._client.mget([*map(self.generation_key, missed)]),
+                ))
+            keys, args = [], [self.EX]
+            for user in engine.User.objects(pk__in=missed):
+                infos[user.id] = user.info
+                keys.extend((self.key(user.id), self.generation_key(user.id)))
+                args.extend((generations[user.id]
+                             or '', self.dumps(user.info)))
+            if keys:
+                SET_IF_GENERATION_SCRIPT(self._client, keys=keys, args=args)
+        hit = len(ids) - len(missed)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.hincrby(self.stats_key, 'hit', hit)
+        pipe.hincrby(self.stats_key, 'miss', len(missed))
+        pipe.execute()
+        return [infos[_id] for _id in ids if _id in infos]
+
+    def invalidate(self, *ids: ObjectId):
+        if not ids:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for _id in ids:
+            pipe.incr(self.generation_key(_id))
+            pipe.expire(self.generation_key(_id), self.EX)
+        pipe.delete(*map(self.key, ids))
+        pipe.execute()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            k.decode(): int(v)
+            for k, v in self._client.hgetall(self.stats_key).items()
+        }
+        hit, miss = stats.get('hit', 0), stats.get('miss', 0)
+        return {
+            'hit': hit,
+            'miss': miss,
+            'hitRate': hit / (hit + miss) if hit + miss else None,
+        }
+
+
+class SessionCache:
+    '''
+    Verified login sessions keyed by token digest. Redis is shared by
+    workers, and a small in-process LRU in front of it saves the round
+    trip for hot tokens.
+    '''
+    # Entry lifetime (seconds) in redis
+    EX = 60
+    # Entry lifetime (seconds) in process. Invalidation only clears the
+    # local entries of current process, so this bounds how long other
+    # processes may serve a stale session
+    LOCAL_EX = 5
+    LOCAL_SIZE = 1024
+    # Generation lifetime (seconds), it only needs to outlive a user load
+    GENERATION_EX = 24 * 60 * 60
+
+    _local: 'OrderedDict[str, tuple]' = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self._client = get_redis_client()
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def key(digest: str) -> str:
+        return f'session:{digest}'
+
+    @staticmethod
+    def user_key(_id) -> str:
+        return f'session-user:{_id}'
+
+    @staticmethod
+    def generation_key(_id) -> str:
+        return f'session-gen:{_id}'
+
+    def generation(self, _id) -> bytes:
+        '''
+        Read before loading the user, and pass it to `set`
+        '''
+        return self._client.get(self.generation_key(_id)) or b''
+
+    def _remember(self, digest: str, session: Dict[str, Any]):
+        with self._lock:
+            self._local[digest] = (time.monotonic() + self.LOCAL_EX, session)
+            self._local.move_to_end(digest)
+            while len(self._local) > self.LOCAL_SIZE:
+                self._local.popitem(last=False)
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._local.get(digest)
+            if entry is not None:
+                expires, session = entry
+                if expires > time.monotonic():
+                    self._local.move_to_end(digest)
+                    return session
+                del self._local[digest]
+        raw = self._client.get(self.key(digest))
+        if raw is None:
+            return None
+        session = json.loads(raw)
+        self._remember(digest, session)
+        return session
+
+    def set(self, token: str, user, generation: bytes) -> Dict[str, Any]:
+        '''
+        Cache the fields of `user` needed to authenticate `token`. It's not
+        cached if the sessions of user are invalidated after `generation`
+        was read.
+        '''
+        digest = self.digest(token)
+        session = {
+            'id': str(user.id),
+            'role': user.role,
+            'active': user.active,
+            'userId': user.user_id,
+        }
+        pipe = self._client.pipeline()
+        pipe.sadd(self.user_key(user.id), digest)
+        pipe.expire(self.user_key(user.id), self.EX)
+        pipe.execute()
+        if SET_IF_GENERATION_SCRIPT(
+                self._client,
+                keys=[self.key(digest),
+                      self.generation_key(user.id)],
+                args=[self.EX, generation,
+                      json.dumps(session)],
+        ):
+            self._remember(digest, session)
+        return session
+
+    def discard(self, token: str):
+        digest = self.digest(token)
+        with self._lock:
+            self._local.pop(digest, None)
+        self._client.delete(self.key(digest))
+
+    def invalidate(self, *ids: ObjectId):
+        '''
+        Drop every session of users
+        '''
+        if not ids:
+            return
+        for _id in ids:
+            # Bump generation first, so sessions being loaded are not
+            # written back
+            self._client.incr(self.generation_key(_id))
+            self._client.expire(self.generation_key(_id), self.GENERATION_EX)
+            user_key = self.user_key(_id)
+            digests = [d.decode() for d in self._client.smembers(user_key)]
+            self._client.delete(user_key, *map(self.key, digests))
+        ids = {*map(str, ids)}
+        with self._lock:
+            for digest, (_, session) in [*self._local.items()]:
+                if session['id'] in ids:
+                    del self._local[digest]
+
+
+class EnrollmentVersion:
+    '''
+    Per-user counter of course membership. It's bumped whenever the
+    courses or the role of a user change, so a course claim signed with an
+    older version is stale.
+    '''
+    # Counter lifetime (seconds), refreshed whenever it's read or bumped. A
+    # missing counter restarts from the clock, which makes every issued
+    # claim stale
+    EX = 30 * 24 * 60 * 60
+
+    def __init__(self):
+        self._client = get_redis_client()
+
+    @staticmethod
+    def key(_id) -> str:
+        return f'enrollment-version:{_id}'
+
+    def get(self, _id) -> Optional[int]:
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(self.key(_id))
+        pipe.expire(self.key(_id), self.EX)
+        raw, _ = pipe.execute()
+        return None if raw is None else int(raw)
+
+    def current(self, _id) -> int:
+        '''
+        Get the version of a user, initialize it if missing
+        '''
+        version = self.get(_id)
+        if version is None:
+            # Start from the clock instead of 0, so claims signed before
+            # the counter was lost can't match it again
+            self._client.set(self.key(_id),
+                             time.time_ns(),
+                             ex=self.EX,
+                             nx=True)
+            version = self.get(_id)
+        return version
+
+    def bump(self, *ids: ObjectId):
+        if not ids:
+            return
+        BUMP_SCRIPT(self._client,
+                    keys=[*map(self.key, ids)],
+                    args=[self.EX, time.time_ns()])
+
+
+class TokenCache:
+    '''
+    Signed JWTs keyed by user and a digest of the requested claims. Claims
+    read from the user document are covered by invalidation on update, the
+    others have to be in the digest.
+    '''
+    # Entry lifetime (seconds). A reused token expires at most this much
+    # earlier than a freshly signed one
+    EX = 60 * 60
+    # Generation lifetime (seconds), it only needs to outlive a token signing
+    GENERATION_EX = 24 * 60 * 60
+
+    def __init__(self):
+        self._client = get_redis_client()
+
+    @staticmethod
+    def digest(*claims) -> str:
+        raw = json.dumps(claims, sort_keys=True, cls=ObjectIdEncoder)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def key(_id, digest: str) -> str:
+        return f'jwt:{_id}:{digest}'
+
+    @staticmethod
+    def user_key(_id) -> str:
+        return f'jwt-user:{_id}'
+
+    @staticmethod
+    def generation_key(_id) -> str:
+        return f'jwt-gen:{_id}'
+
+    def generation(self, _id) -> bytes:
+        '''
+        Read before loading the claims, and pass it to `set`
+        '''
+        return self._client.get(self.generation_key(_id)) or b''
+
+    def get(self, _id, digest: str) -> Optional[str]:
+        token = self._client.get(self.key(_id, digest))
+        return None if token is None else token.decode()
+
+    def set(self, _id, digest: str, token: str, generation: bytes):
+        '''
+        Cache `token`, unless tokens of the user are invalidated after
+        `generation` was read
+        '''
+        pipe = self._client.pipeline()
+        pipe.sadd(self.user_key(_id), digest)
+        pipe.expire(self.user_key(_id), self.EX)
+        pipe.execute()
+        SET_IF_GENERATION_SCRIPT(
+            self._client,
+            keys=[self.key(_id, digest),
+                  self.generation_key(_id)],
+            args=[self.EX, generation, token],
+        )
+
+    def invalidate(self, *ids: ObjectId):
+        if not ids:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for _id in ids:
+            # Bump generation first, so tokens being signed are not
+            # written back
+            pipe.incr(self.generation_key(_id))
+            pipe.expire(self.generation_key(_id), self.GENERATION_EX)
+            pipe.smembers(self.user_key(_id))
+        keys = []
+        for _id, digests in zip(ids, pipe.execute()[2::3]):
+            keys.append(self.user_key(_id))
+            keys.extend(self.key(_id, d.decode()) for d in digests)
+        self._client.delete(*keys)
+
+
+class UnreadCounter:
+    '''
+    Count of unread notifications of each user
+    '''
+    EX = 24 * 60 * 60
+
+    def __init__(self):
+        self._client = get_redis_client()
+
+    @staticmethod
+    def key(_id) -> str:
+        return f'notif-unread:{_id}'
+
+    def get(self, _id) -> int:
+        raw = self._client.get(self.key(_id))
+        if raw is not None:
+            return int(raw)
+        cnt = engine.Notif.objects(
+            receiver=_id,
+            status=engine.Notif.Status.UNREAD,
+        ).count()
+        self._client.set(self.key(_id), cnt, ex=self.EX, nx=True)
+        return cnt
+
+    def add(self, deltas: Dict[ObjectId, int]):
+        deltas = {_id: d for _id, d in deltas.items() if d != 0}
+        if not deltas:
+            return
+        ADD_IF_EXISTS_SCRIPT(self._client,
+                             keys=[*map(self.key, deltas)],
+                             args=[*deltas.values()])
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import enum
+from typing import Any, Dict, Optional
 from . import engine
 from .base import MongoBase
 from .problem import Problem
@@ -8,13 +9,15 @@ from .user import User
 from .notif import Notif
 from .utils import (
     doc_required,
-    get_redis_client,
     logger,
+    run_in_background,
 )
 from .submission import *
 from .event import (
     submission_completed,
     comment_created,
+    comment_deleted,
+    comment_result_updated,
     reply_created,
     comment_liked,
     comment_unliked,
@@ -42,6 +45,8 @@ class TooManyComments(Exception):
 
 class Comment(MongoBase, engine=engine.Comment):
     __initialized = False
+    # Number of replies included in each comment of a thread page
+    REPLY_PREVIEW = 3
 
     class Permission(enum.Flag):
         READ = enum.auto()
@@ -57,11 +62,15 @@ class Comment(MongoBase, engine=engine.Comment):
         return super().__new__(cls, pk, *args, **kwargs)
 
     @classmethod
-    def on_submission_completed(cls, submission):
+    def on_submission_completed(cls, submission, previous_result=None, **ks):
         if submission.comment is None:
             return
         comment = cls(submission.comment)
-        comment.on_submission_completed_ins()
+        comment.on_submission_completed_ins(
+            submission,
+            previous_result=previous_result,
+        )
+        comment_result_updated.send(comment)
 
     @doc_required('user', User)
     def own_permission(self, user: User) -> 'Comment.Permission':
@@ -102,6 +111,161 @@ class Comment(MongoBase, engine=engine.Comment):
         _permission = self.own_permission(user=user)
         return bool(req & _permission)
 
+    @classmethod
+    @doc_required('problem', Problem)
+    @doc_required('user', User)
+    def thread(
+        cls,
+        problem: Problem,
+        user: User,
+        after: int = 0,
+        limit: int = 20,
+    ) -> Dict[str, Any]:
+        '''
+        Get a page of comments under `problem` which `user` can read,
+        sorted by floor. Related documents are fetched in batch, so the
+        number of queries doesn't depend on the page size.
+        '''
+        from .submission import Submission
+        query = {
+            'problem': problem.pk,
+            'depth': 0,
+            'status': cls.engine.Status.SHOW,
+            'floor__gt': after,
+        }
+        # Same as the read permission of `own_permission`
+        course = Course(problem.course)
+        if not (user == course.teacher or user >= 'admin') and problem.is_OJ:
+            query['author'] = user.pk
+        comments = cls.engine.objects(**query).order_by('floor').limit(limit)
+        # Latest submission only, `liked` and `replies` are unbounded
+        comments = comments.exclude('liked', 'replies')
+        comments = [*comments.fields(slice__submissions=-1).as_pymongo()]
+        ids = [c['_id'] for c in comments]
+        liked = {*cls.engine.objects(pk__in=ids, liked=user.pk).scalar('id')}
+        # Count replies of each floor and take the earliest ones in db, so
+        # popular floors don't load every reply
+        floors = [
+            *cls.engine._get_collection().aggregate([
+                {
+                    '$match': {
+                        'problem': problem.pk,
+                        'depth': 1,
+                        'status': cls.engine.Status.SHOW,
+                        'floor': {
+                            '$in': [c['floor'] for c in comments]
+                        },
+                    }
+                },
+                {
+                    '$sort': {
+                        'created': 1,
+                        '_id': 1,
+                    }
+                },
+                {
+                    '$group': {
+                        '_id': '$floor',
+                        'count': {
+                            '$sum': 1
+                        },
+                        'replies': {
+                            '$push': '$_id'
+                        },
+                    }
+                },
+                {
+                    '$project': {
+                        'count': 1,
+                        'replies': {
+                            '$slice': ['$replies', cls.REPLY_PREVIEW]
+                        },
+                    }
+                },
+            ])
+        ]
+        reply_counts = {f['_id']: f['count'] for f in floors}
+        replies = cls.engine.objects(
+            pk__in=[_id for f in floors
+                    for _id in f['replies']]).order_by('created',
+                                                       'id').exclude('liked')
+        replies = [*replies.as_pymongo()]
+        floor2replies = {}
+        for reply in replies:
+            floor2replies.setdefault(reply['floor'], []).append(reply)
+        submission_ids = [
+            c['submissions'][0] for c in comments if c.get('submissions')
+        ]
+        submissions = {
+            s['_id']: s
+            for s in Submission.engine.objects(pk__in=submission_ids).only(
+                'state',
+                'status',
+                'timestamp',
+                'result.judge_result',
+            ).as_pymongo()
+        }
+        # Only documents which haven't been backfilled need user lookups,
+        # the keys of a raw snapshot are the same as `User.info`
+        author_ids = {
+            d['author']
+            for d in (*comments, *replies) if 'authorSnapshot' not in d
+        }
+        authors = {u['id']: u for u in User.info_many(author_ids)}
+
+        def author_info(d):
+            return d.get('authorSnapshot') or authors.get(d['author'])
+
+        def submission_summary(_id):
+            s = submissions.get(_id)
+            if s is None:
+                return None
+            return {
+                'id': str(_id),
+                'state': s.get('state'),
+                'status': s.get('status'),
+                'timestamp': s['timestamp'].timestamp(),
+                'judge_result': s.get('result', {}).get('judge_result'),
+            }
+
+        def reply_summary(r):
+            return {
+                'id': str(r['_id']),
+                'title': r['title'],
+                'content': r['content'],
+                'author': author_info(r),
+                'likeCount': r.get('likeCount', 0),
+                'created': r['created'].timestamp(),
+                'updated': r['updated'].timestamp(),
+            }
+
+        def comment_summary(c):
+            latest = c.get('submissions')
+            preview = floor2replies.get(c['floor'], [])
+            return {
+                'id': str(c['_id']),
+                'title': c['title'],
+                'content': c['content'],
+                'floor': c['floor'],
+                'author': author_info(c),
+                'acceptance': c.get('acceptance'),
+                'likeCount': c.get('likeCount', 0),
+                'liked': c['_id'] in liked,
+                'created': c['created'].timestamp(),
+                'updated': c['updated'].timestamp(),
+                'submission':
+                submission_summary(latest[0]) if latest else None,
+                'replyCount': reply_counts.get(c['floor'], 0),
+                'replies': [*map(reply_summary, preview)],
+            }
+
+        ret = [*map(comment_summary, comments)]
+        return {
+            'comments': ret,
+            # `None` means there is no more comments
+            'next': ret[-1]['floor'] if len(ret) == limit else None,
+        }
+
     def to_dict(self):
         from .submission import Submission
         ret = self.to_mongo().to_dict()
@@ -110,23 +274,31 @@ class Comment(MongoBase, engine=engine.Comment):
         ret['submission'] = self.submission and Submission(
             self.submission).to_dict()
         ret['submissions'] = [s.pk for s in self.submissions]
-        ret['author'] = self.author.info
+        ret['author'] = self.author_info
         ret['replies'] = [str(r) for r in ret['replies']]
-        ret['liked'] = [l.info for l in self.liked]
+        ret['liked'] = User.info_many(ret['liked'])
         for k in (
                 '_id',
                 'problem',
                 'success',
                 'fail',
+                'exclusiveKey',
+                'authorSnapshot',
         ):
             if k in ret:
                 del ret[k]
         return ret
 
     def delete(self):
-        self.update(status=self.engine.Status.HIDDEN)
+        # Release the exclusive key so that author can comment again
+        self.update(
+            status=self.engine.Status.HIDDEN,
+            unset__exclusive_key=True,
+        )
         for reply in self.replies:
             reply.update(status=self.engine.Status.HIDDEN)
+            comment_deleted.send(Comment(reply))
+        comment_deleted.send(self)
         return self
 
     @doc_required('user', 'user', User)
@@ -134,33 +306,58 @@ class Comment(MongoBase, engine=engine.Comment):
         '''
         Like/Unlike a comment
         '''
-        # unlike
-        if user.obj in self.liked:
-            action = 'pull'
-            event = comment_unliked
-        else:
-            action = 'add_to_set'
-            event = comment_liked
-            # notify the author of the creation
-            info = Notif.types.Like(
-                comment=self.pk,
-                liked=user.pk,
-                problem=self.problem,
-            )
-            notif = Notif.new(info)
-            self.author.update(push__notifs=notif.pk)
-        self.update(**{f'{action}__liked': user.id})
-        user.update(**{f'{action}__likes': self.id})
-        self.reload()
-        user.reload()
-        event.send(self, user=user)
+        # Toggle in one conditional write, the membership check is done
+        # by the query so that concurrent requests can't double count
+        if not self.obj.modify(
+                query={'liked__ne': user.pk},
+                add_to_set__liked=user.pk,
+                inc__like_count=1,
+        ) and not self.obj.modify(
+                query={'liked': user.pk},
+                pull__liked=user.pk,
+                dec__like_count=1,
+        ):
+            return
+        # Statistic, requirements and notification are not on the request
+        # path
+        run_in_background(self.on_like_toggled, user)
         logger().info(
             f'User like/unlike comment [user={user.id}, comment={self.id}]')
 
+    def on_like_toggled(self, user: User):
+        '''
+        Send the signal of current like state of `user`. It may have been
+        toggled again before this runs, even by another process, so the
+        signal follows the state instead of the toggle. Handlers of both
+        signals are idempotent.
+        '''
+        if self.engine.objects(pk=self.pk, liked=user.pk).count():
+            comment_liked.send(self, user=user)
+            self.notify_liked(user)
+        else:
+            comment_unliked.send(self, user=user)
+
+    def notify_liked(self, user: User):
+        '''
+        Notify the author that `user` liked this comment
+        '''
+        info = Notif.types.Like(
+            comment=self.pk,
+            liked=user.pk,
+            problem=self.problem,
+        )
+        Notif.new(info, self.author)
+
     def submit(self, code=None):
         '''
         rejudge current submission
         '''
+        self.reset_submission(code).submit()
+
+    def reset_submission(self, code=None) -> Submission:
+        '''
+        Clear the result of current submission before rejudging it
+        '''
         from .submission import Submission
         if not self.is_comment:
             raise NotAComment
@@ -171,29 +368,86 @@ class Comment(MongoBase, engine=engine.Comment):
         submission.clear()
         if code is not None:
             submission.update(code=code)
-        submission.submit()
+        return submission
 
-    def on_submission_completed_ins(self):
+    def on_submission_completed_ins(self, submission, previous_result=None):
+        '''
+        Fold the verdict of a completed submission into this comment,
+        `previous_result` is the judge result before it was rejudged
+        '''
         if not self.is_comment:
             raise NotAComment
-        from .submission import Submission
-        self.reload('submissions')
-        if self.submission is None:
-            raise SubmissionNotFound
-        if self.submission.result is None:
+        if submission.result is None:
+            return
+        counter = 'fail' if submission.result.stderr else 'success'
+        counter = {f'inc__{counter}': 1}
+        if not self.problem.is_OJ:
+            self.fold_acceptance(
+                {'acceptance': self.Acceptance.NOT_TRY},
+                self.Acceptance.PENDING,
+                **counter,
+            )
             return
-        if self.submission.result.stderr:
-            self.update(inc__fail=1)
+        AC = submission.engine.JudgeResult.AC
+        # AC is sticky, any accepted submission accepts the comment
+        if submission.result.judge_result == AC:
+            self.update(acceptance=self.Acceptance.ACCEPTED, **counter)
+            return
+        self.fold_acceptance(
+            {'acceptance__ne': self.Acceptance.ACCEPTED},
+            self.Acceptance.REJECTED,
+            **counter,
+        )
+        # An AC submission was rejudged as non-AC
+        if previous_result == AC:
+            self.recompute_acceptance()
+
+    def on_state_changed_ins(self, state: int, previous_state: int):
+        '''
+        Fold the state of a manually graded submission into this comment
+        '''
+        from .submission import Submission
+        ACCEPT = Submission.engine.State.ACCEPT
+        if state == ACCEPT:
+            self.update(acceptance=self.Acceptance.ACCEPTED)
+        elif previous_state == ACCEPT:
+            self.recompute_acceptance()
         else:
-            self.update(inc__success=1)
-        # Process OJ problem
+            self.fold_acceptance(
+                {'acceptance__ne': self.Acceptance.ACCEPTED},
+                self.Acceptance.REJECTED,
+            )
+        comment_result_updated.send(self)
+
+    def fold_acceptance(self, query, acceptance: int, **ks):
+        '''
+        Set `acceptance` if this comment matches `query`, other updates
+        in `ks` are always applied. Only one write if matched.
+        '''
+        if self.engine.objects(
+                pk=self.pk,
+                **query,
+        ).update_one(acceptance=acceptance, **ks):
+            return
+        if ks:
+            self.update(**ks)
+
+    def recompute_acceptance(self):
+        '''
+        Recompute acceptance from all submissions, only needed when an
+        accepted submission might be changed into non-accepted
+        '''
+        from .submission import Submission
         if self.problem.is_OJ:
-            # FIXME: There might exists unfinished submissions, their `result` will be `None`
-            is_ac = lambda s: s.result.judge_result == Submission.engine.JudgeResult.AC
-            self.update(acceptance=self.Acceptance.ACCEPTED if any(
-                map(is_ac, self.submissions)) else self.Acceptance.REJECTED)
-        elif self.acceptance == self.Acceptance.NOT_TRY:
-            self.update(acceptance=self.Acceptance.PENDING)
+            query = {'result__judge_result': Submission.engine.JudgeResult.AC}
+        else:
+            query = {'state': Submission.engine.State.ACCEPT}
+        accepted = Submission.engine.objects(
+            comment=self.pk,
+            **query,
+        ).only('id').first() is not None
+        self.update(acceptance=self.Acceptance.ACCEPTED if accepted else self.
+                    Acceptance.REJECTED)
 
     @classmethod
     @doc_required('author', User)
@@ -205,47 +459,49 @@ class Comment(MongoBase, engine=engine.Comment):
         author: User,
         **ks,
     ):
-        redis = get_redis_client()
-        # Ensure that comment field is sync with db
-        with redis.lock(f'{author}-{target}'):
-            target.reload('comments')
-            # check if allow multiple comments
-            if not target.allow_multiple_comments:
-                comments = map(
-                    lambda c: author == c.author,
-                    filter(lambda c: c.show, target.comments),
-                )
-                if any(comments):
-                    raise TooManyComments
-            # Ensure the height field is correct
-            with redis.lock(str(target)):
-                target.reload('height')
-                # create new commment
-                comment = cls.add(
-                    floor=target.height + 1,
-                    depth=0,
-                    author=author,
-                    problem=target,
-                    **ks,
-                )
-                submission = comment.new_submission(code)
-                submission.submit()
-                comment.update(push__submissions=submission.obj)
-                # append to problem
-                target.update(
-                    push__comments=comment.obj,
-                    inc__height=1,
-                )
+        # TODO: solve circular import between submission and comment
+        from .submission import Submission
+        # Only set if the problem allows one comment per author, the unique
+        # index on it rejects the second one
+        exclusive_key = None
+        if not target.allow_multiple_comments:
+            exclusive_key = f'{author.id}:{target.id}'
+        # Check rate limit before any comment is created
+        Submission.throttle(problem=target, user=author)
+        # Allocate floor, `height` is the max floor of this problem
+        floor = engine.Problem.objects(pk=target.pk).modify(
+            inc__height=1,
+            new=True,
+        ).height
+        try:
+            comment = cls.add(
+                floor=floor,
+                depth=0,
+                author=author,
+                problem=target,
+                exclusive_key=exclusive_key,
+                **ks,
+            )
+        except engine.NotUniqueError:
+            # Give the floor back if no one has taken a later one
+            engine.Problem.objects(
+                pk=target.pk,
+                height=floor,
+            ).update_one(dec__height=1)
+            raise TooManyComments
+        target.update(push__comments=comment.obj)
+        submission = comment.new_submission(code, throttle=False)
+        submission.submit()
+        comment.update(push__submissions=submission.obj)
         # notify relevant user
         info = Notif.types.NewComment(problem=target.pk)
         if target.author != comment.author:
-            notif = Notif.new(info)
-            target.author.update(push__notifs=notif.pk)
+            Notif.new(info, target.author)
         comment_created.send(comment.reload())
         logger().info(f'Comment created [comment={comment.id}]')
         return comment
 
-    def new_submission(self, code: str):
+    def new_submission(self, code: str, throttle: bool = True):
         '''
         Create submission attached to this comment
         '''
@@ -258,6 +514,7 @@ class Comment(MongoBase, engine=engine.Comment):
             user=self.author,
             comment=self,
             code=code,
+            throttle=throttle,
         )
         return submission
 
@@ -289,10 +546,7 @@ class Comment(MongoBase, engine=engine.Comment):
         authors = {target.author, target.problem.author} - {
             reply.author,
         }
-        if authors:
-            notif = Notif.new(info)
-        for author in authors:
-            author.update(push__notifs=notif.pk)
+        Notif.new_many((info, author) for author in authors)
         reply_created.send(reply.reload())
         logger().info(f'Reply created [comment={target.id}, reply={reply.id}]')
         return reply
@@ -308,6 +562,7 @@ class Comment(MongoBase, engine=engine.Comment):
         floor: int,
         depth: int,
         problem: Problem,
+        exclusive_key: Optional[str] = None,
     ):
         if not problem.permission(user=author, req=Problem.Permission.SUBMIT):
             raise PermissionError(f'{author} cannot submit to {problem}')
@@ -318,9 +573,8 @@ class Comment(MongoBase, engine=engine.Comment):
             floor=floor,
             depth=depth,
             problem=problem.id,
+            exclusive_key=exclusive_key,
         ).save()
-        # append to author's
-        author.update(push__comments=comment)
         return cls(comment)
 
     def add_new_submission(self, code):
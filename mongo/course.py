@@ -1,11 +1,27 @@
 from __future__ import annotations
 import csv
-import tempfile
+import io
+import json
 import enum
-from typing import List, TYPE_CHECKING, Set, Union
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TYPE_CHECKING,
+    Set,
+    Tuple,
+    Union,
+)
+from bson import ObjectId
+from pymongo import UpdateOne
 from . import engine
 from .base import MongoBase
+from .cache import EnrollmentVersion, TokenCache
 from .user import User
+from .user_stats import UserStats, STAT_KEYS
 from .utils import *
 
 __all__ = ['Course']
@@ -15,6 +31,10 @@ if TYPE_CHECKING:
 
 
 class Course(MongoBase, engine=engine.Course):
+    # Lease (redis key, lifetime in seconds) of resuming purges
+    RESUME_PURGES_LEASE = 'course-resume-purges'
+    RESUME_PURGES_LEASE_EX = 60 * 60
+
     class Permission(enum.Flag):
         READ = enum.auto()
         WRITE = enum.auto()
@@ -38,24 +58,46 @@ class Course(MongoBase, engine=engine.Course):
         return (tag in tags)
 
     @doc_required('user', User)
-    def own_permission(self, user: User) -> 'Course.Permission':
+    def own_permission(
+        self,
+        user: User,
+        enrolled: Optional[bool] = None,
+    ) -> 'Course.Permission':
+        '''
+        `enrolled` can be provided if it's already known, otherwise it's
+        looked up when needed. Both are read from `user.claim` if the user
+        carries a verified course claim.
+        '''
         _permission = self.Permission(0)
+        # A verified course claim answers membership without any query
+        if user.claim is not None:
+            role = user.claim.get(str(self.pk))
+            is_teacher = role == 'teacher'
+            enrolled = role == 'student'
+        else:
+            is_teacher = user == self.teacher
         # course's teacher and admins can do anything
-        if user == self.teacher or user >= 'admin':
+        if is_teacher or user >= 'admin':
             _permission |= ( \
                 self.Permission.READ |
                 self.Permission.WRITE |
                 self.Permission.PARTICIPATE
             )
         # course's students can participate, or everyone can participate if the course is public
-        elif user in self.students or self.status == self.engine.Status.PUBLIC:
+        elif self.status == self.engine.Status.PUBLIC or (
+                self.is_enrolled(user) if enrolled is None else enrolled):
             _permission |= (self.Permission.READ | self.Permission.PARTICIPATE)
         elif self.status == self.engine.Status.READONLY:
             _permission |= self.Permission.READ
         return _permission
 
     @doc_required('user', 'user', User)
-    def permission(self, user: User, req: 'Course.Permission') -> bool:
+    def permission(
+        self,
+        user: User,
+        req: 'Course.Permission',
+        enrolled: Optional[bool] = None,
+    ) -> bool:
         '''
         check user's permission, `req` is a set of required
         permissions
@@ -64,14 +106,221 @@ class Course(MongoBase, engine=engine.Course):
             a `bool` value denotes whether user has these
             permissions 
         '''
-        _permission = self.own_permission(user=user)
+        _permission = self.own_permission(user=user, enrolled=enrolled)
         return bool(req & _permission)
 
+    def is_enrolled(self, user) -> bool:
+        user = getattr(user, 'pk', user)
+        query = engine.Enrollment.objects(course=self.pk, user=user)
+        return query.only('id').first() is not None
+
+    @staticmethod
+    def enrolled_courses(user, courses: Optional[Iterable] = None) -> Set:
+        '''
+        Ids of courses (in `courses` if provided) which `user` is
+        enrolled in
+        '''
+        query = {'user': getattr(user, 'pk', user)}
+        if courses is not None:
+            query['course__in'] = [getattr(c, 'pk', c) for c in courses]
+        enrollments = engine.Enrollment.objects(**query).only('course')
+        return {e['course'] for e in enrollments.as_pymongo()}
+
+    def enroll(self, users: Iterable):
+        '''
+        Add enrollments of `users` (ids or documents), existing ones are
+        ignored
+        '''
+        users = [getattr(u, 'pk', u) for u in users]
+        if len(users) == 0:
+            return
+        engine.Enrollment._get_collection().bulk_write(
+            [
+                UpdateOne(
+                    {
+                        'user': u,
+                        'course': self.pk
+                    },
+                    {'$setOnInsert': {
+                        'user': u,
+                        'course': self.pk
+                    }},
+                    upsert=True,
+                ) for u in users
+            ],
+            ordered=False,
+        )
+        EnrollmentVersion().bump(*users)
+
+    def unenroll(self, users: Iterable):
+        users = [getattr(u, 'pk', u) for u in users]
+        engine.Enrollment.objects(course=self.pk, user__in=users).delete()
+        EnrollmentVersion().bump(*users)
+
     def add_student(self, user: User):
-        user.update(add_to_set__courses=self.obj)
-        self.update(add_to_set__students=user.obj)
+        self.add_students([user])
         return self.reload('students')
 
+    def add_students(self, users: Iterable):
+        '''
+        Add `users` (ids or documents) to this course with one update on
+        each side
+        '''
+        users = [getattr(u, 'pk', u) for u in users]
+        if len(users) == 0:
+            return
+        engine.User.objects(pk__in=users).update(add_to_set__courses=self.pk)
+        # Rejoined students cancel their pending purge
+        self.update(
+            add_to_set__students=users,
+            pull_all__pending_purge=users,
+        )
+        # Bulk update skips the hooks of `engine.User.update`
+        TokenCache().invalidate(*users)
+        self.enroll(users)
+
+    def remove_students(self, users: Iterable):
+        '''
+        Remove `users` (ids or documents) from this course. Their problems,
+        comments and likes in this course are cleaned up in background, the
+        pending purge is recorded on course so that it can be resumed if the
+        worker dies.
+        '''
+        users = [getattr(u, 'pk', u) for u in users]
+        if len(users) == 0:
+            return
+        self.update(
+            pull_all__students=users,
+            add_to_set__pending_purge=users,
+        )
+        engine.User.objects(pk__in=users).update(pull__courses=self.pk)
+        TokenCache().invalidate(*users)
+        self.unenroll(users)
+        run_in_background(self.purge_students, users)
+
+    def purge_students(self, users: List):
+        '''
+        Delete problems, hide comments and pull likes of `users` in this
+        course with set-based updates. Only users whose purge is still
+        pending are purged.
+        '''
+        users = self.pending_students(users)
+        if len(users) == 0:
+            return
+        Status = engine.Comment.Status
+        problems = [
+            *engine.Problem.objects(
+                course=self.pk,
+                author__in=users,
+            ).only('attachments')
+        ]
+        deleted = [p.pk for p in problems]
+        pids = engine.Problem.objects(
+            course=self.pk,
+            pk__nin=deleted,
+        ).scalar('pid')
+        pids = [*pids]
+        # Statistic of these users has to be rebuilt
+        affected = {*users}
+        # Comments under deleted problems are deleted with them
+        comments = engine.Comment.objects(problem__in=deleted).only(
+            'author',
+            'liked',
+        ).as_pymongo()
+        for c in comments:
+            affected.add(c['author'])
+            affected.update(c.get('liked', []))
+        engine.Problem.objects(pk__in=deleted).delete()
+        # Hide comments and their replies, release exclusive keys so that
+        # they can comment again after rejoining
+        comments = engine.Comment.objects(
+            author__in=users,
+            problem__in=pids,
+        ).only(
+            'liked',
+            'replies',
+        ).as_pymongo()
+        hidden, replies = [], []
+        for c in comments:
+            hidden.append(c['_id'])
+            replies.extend(c.get('replies', []))
+            affected.update(c.get('liked', []))
+        engine.Comment.objects(pk__in=hidden).update(
+            status=Status.HIDDEN,
+            unset__exclusive_key=True,
+        )
+        replies = engine.Comment.objects(pk__in=replies)
+        affected.update(r.id
+                        for r in replies.scalar('author').no_dereference())
+        replies.update(status=Status.HIDDEN)
+        # Pull likes, one update for each user
+        liked = engine.Comment.objects(liked__in=users, problem__in=pids)
+        affected.update(c.id for c in liked.scalar('author').no_dereference())
+        for user in users:
+            engine.Comment.objects(
+                liked=user,
+                problem__in=pids,
+            ).update(
+                pull__liked=user,
+                dec__like_count=1,
+            )
+        # Missing statistic is built when it's read
+        engine.UserStats.objects(
+            course=self.pk,
+            user__in=[*affected],
+        ).delete()
+        # Remove attachment files from GridFS
+        for problem in problems:
+            for attachment in problem.attachments:
+                attachment.file.delete()
+        self.update(pull_all__pending_purge=users)
+        logger().info(f'Students purged [course={self.pk}, '
+                      f'users={len(users)}, problems={len(deleted)}]')
+
+    @classmethod
+    def resume_purges(cls):
+        '''
+        Purge students whose removal was not cleaned up, skip those who
+        have rejoined the course. Every worker calls it on start, but only
+        the one holding the lease does the work.
+        '''
+        client = get_redis_client()
+        if not client.set(
+                cls.RESUME_PURGES_LEASE,
+                1,
+                nx=True,
+                ex=cls.RESUME_PURGES_LEASE_EX,
+        ):
+            return
+        try:
+            cls._resume_purges()
+        finally:
+            client.delete(cls.RESUME_PURGES_LEASE)
+
+    @classmethod
+    def _resume_purges(cls):
+        courses = engine.Course.objects(
+            pending_purge__0__exists=True).only('pending_purge').as_pymongo()
+        for c in courses:
+            cls(c['_id']).purge_students(c['pending_purge'])
+
+    def pending_students(self, users: Iterable) -> List[ObjectId]:
+        '''
+        Users in `users` whose purge is pending and who haven't rejoined
+        this course. Rejoined ones are dropped from the pending list.
+        '''
+        course = engine.Course.objects(pk=self.pk).only(
+            'students',
+            'pending_purge',
+        ).as_pymongo().first()
+        students = {*course.get('students', [])}
+        pending = {*course.get('pending_purge', [])}
+        users = [u for u in users if u in pending]
+        rejoined = [u for u in users if u in students]
+        if len(rejoined) != 0:
+            self.update(pull_all__pending_purge=rejoined)
+        return [u for u in users if u not in students]
+
     @classmethod
     @doc_required('teacher', User)
     def add(
@@ -104,67 +353,362 @@ class Course(MongoBase, engine=engine.Course):
     def get_by_name(cls, name: str) -> 'Course':
         return cls(cls.engine.objects.get(name=name))
 
-    def statistic_file(self):
-        f = tempfile.TemporaryFile('w+')
-        statistic_fields = [
-            *User('0' * 24).statistic().keys(),
+    # Number of students whose statistic are fetched in one batch
+    STATISTIC_BATCH_SIZE = 100
+    # Optional column groups of statistic export
+    STATISTIC_COLUMNS = ('oj', 'task')
+
+    def statistic_fields(self, columns: Iterable[str] = ()) -> List[str]:
+        fields = [
+            'username',
+            *(k for k in STAT_KEYS if k != 'execInfo'),
             'success',
             'fail',
         ]
-        statistic_fields.remove('execInfo')
+        if 'oj' in columns:
+            fields.extend(('ojAcCount', 'ojTryCount'))
+        if 'task' in columns:
+            fields.extend(f'task:{t}' for t in self.task_ids())
+        return fields
+
+    def task_ids(self) -> List:
+        return [*engine.Task.objects(course=self.id).scalar('id')]
+
+    def statistic_rows(
+        self,
+        columns: Iterable[str] = (),
+        batch_size: Optional[int] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        '''
+        Yield one statistic row per student, students are fetched in
+        batches so that memory usage doesn't grow with course size
+        '''
+        batch_size = batch_size or self.STATISTIC_BATCH_SIZE
+        students = self.to_mongo().get('students', [])
+        oj_pids = []
+        if 'oj' in columns:
+            oj_pids = [
+                *engine.Problem.objects(__raw__={
+                    'course': self.id,
+                    'extra._cls': 'OJProblem',
+                }).scalar('pid')
+            ]
+        tasks = []
+        if 'task' in columns:
+            tasks = [*engine.Task.objects(course=self.id)]
+        for i in range(0, len(students), batch_size):
+            batch = students[i:i + batch_size]
+            infos = {info['id']: info for info in User.info_many(batch)}
+            stats = UserStats.course_statistic(self, batch)
+            progress = {
+                task.id: self.task_progress(task, batch)
+                for task in tasks
+            }
+            oj_stats = {}
+            if oj_pids:
+                oj_stats = self.oj_statistic(oj_pids, students=batch)
+                oj_stats = {s['info']['id']: s for s in oj_stats['users']}
+            for u, stat in zip(batch, stats):
+                if u not in infos:
+                    continue
+                exec_info = stat.pop('execInfo')
+                row = {
+                    'username': infos[u]['username'],
+                    # update every other info to its length
+                    **{k: len(v)
+                       for k, v in stat.items()},
+                    **{
+                        k: sum(info[k] for info in exec_info)
+                        for k in ('success', 'fail')
+                    },
+                }
+                if 'oj' in columns:
+                    overview = oj_stats.get(u, {}).get('overview', {})
+                    row['ojAcCount'] = overview.get('acCount', 0)
+                    row['ojTryCount'] = overview.get('tryCount', 0)
+                for task in tasks:
+                    row[f'task:{task.id}'] = '/'.join(
+                        map(str, progress[task.id][u]))
+                yield row
+
+    @staticmethod
+    def task_progress(
+        task: engine.Task,
+        students: List[ObjectId],
+    ) -> Dict[ObjectId, Tuple[int, int]]:
+        '''
+        Progress of students in a task, same as `Task.progress`, but records
+        of them are read in one query
+        '''
+        reqs = task.to_mongo().get('requirements', [])
+        if len(reqs) == 0 or len(students) == 0:
+            return {u: (0, len(reqs)) for u in students}
+        records = [
+            r.get('records', {})
+            for r in engine.Requirement._get_collection().find(
+                {'_id': {
+                    '$in': reqs
+                }},
+                {f'records.{u}.completed_at': 1
+                 for u in students},
+            )
+        ]
+        return {
+            u: (
+                sum(
+                    rs.get(str(u), {}).get('completed_at') is not None
+                    for rs in records),
+                len(reqs),
+            )
+            for u in students
+        }
+
+    def statistic_csv(self, columns: Iterable[str] = ()) -> Iterator[str]:
+        '''
+        Yield statistic of students as csv lines
+        '''
+        buf = io.StringIO()
         writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                'username',
-                *statistic_fields,
-            ],
+            buf,
+            fieldnames=self.statistic_fields(columns),
         )
+
+        def flush():
+            line = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return line
+
         writer.writeheader()
-        for u in self.students:
-            stat = User(u).statistic([self.obj])
-            # extract exec info
-            exec_info = stat.pop('execInfo')
-            # update every other info to its length
-            stat = {k: len(v) for k, v in stat.items()}
-            stat.update({
-                k: sum(info[k] for info in exec_info)
-                for k in ['success', 'fail']
-            })
-            writer.writerow({
-                **stat,
-                **{
-                    'username': u.username,
-                },
-            })
-        f.seek(0)
-        return f
-
-    # FIXME: This method may has performance issue
-    def oj_statistic(self, problems: List[Problem]):
-        student_stats = [{
-            'info': s.info,
-            **s.oj_statistic(problems)
-        } for s in map(User, self.students)]
-        overview = {}
-        for problem in problems:
-            p_stat = {
+        yield flush()
+        for row in self.statistic_rows(columns):
+            writer.writerow(row)
+            yield flush()
+
+    def statistic_ndjson(self, columns: Iterable[str] = ()) -> Iterator[str]:
+        '''
+        Yield statistic of students as newline delimited json
+        '''
+        for row in self.statistic_rows(columns):
+            yield json.dumps(row) + '\n'
+
+    def oj_submission_pipeline(self, pids: List[int], students: List):
+        '''
+        Aggregate submissions of `pids` into per (user, problem) result of
+        the first comment and AC count of each problem
+        '''
+        judge_result = {'$ifNull': ['$result.judge_result', -1]}
+        return [
+            {
+                '$match': {
+                    'problem': {
+                        '$in': pids
+                    }
+                }
+            },
+            {
+                '$facet': {
+                    'tries': [
+                        {
+                            '$match': {
+                                'user': {
+                                    '$in': students
+                                },
+                                'comment': {
+                                    '$ne': None
+                                },
+                            }
+                        },
+                        {
+                            '$group': {
+                                '_id': '$comment',
+                                'user': {
+                                    '$first': '$user'
+                                },
+                                'problem': {
+                                    '$first': '$problem'
+                                },
+                                'tryCount': {
+                                    '$sum': 1
+                                },
+                                'ac': {
+                                    '$max': {
+                                        '$eq': [judge_result, 0]
+                                    }
+                                },
+                                'judged': {
+                                    '$max': {
+                                        '$ne': [judge_result, -1]
+                                    }
+                                },
+                            }
+                        },
+                        # Only the first comment of each user counts
+                        {
+                            '$sort': {
+                                '_id': 1
+                            }
+                        },
+                        {
+                            '$group': {
+                                '_id': {
+                                    'user': '$user',
+                                    'problem': '$problem',
+                                },
+                                'commentId': {
+                                    '$first': '$_id'
+                                },
+                                'tryCount': {
+                                    '$first': '$tryCount'
+                                },
+                                'ac': {
+                                    '$first': '$ac'
+                                },
+                                'judged': {
+                                    '$first': '$judged'
+                                },
+                            }
+                        },
+                    ],
+                    'acCount': [
+                        {
+                            '$match': {
+                                'result.judge_result': 0
+                            }
+                        },
+                        {
+                            '$group': {
+                                '_id': '$problem',
+                                'count': {
+                                    '$sum': 1
+                                },
+                            }
+                        },
+                    ],
+                }
+            },
+        ]
+
+    @staticmethod
+    def evaluate_oj_submissions(submissions: List[dict], students: List):
+        '''
+        Pure python version of `oj_submission_pipeline` for backends
+        which can't run it
+        '''
+        students = {*students}
+        comments = {}
+        ac_count = {}
+        for s in submissions:
+            judge_result = (s.get('result') or {}).get('judge_result')
+            if judge_result is None:
+                judge_result = -1
+            if judge_result == 0:
+                ac_count[s['problem']] = ac_count.get(s['problem'], 0) + 1
+            if s['user'] not in students or s.get('comment') is None:
+                continue
+            c = comments.setdefault(
+                s['comment'], {
+                    '_id': {
+                        'user': s['user'],
+                        'problem': s['problem'],
+                    },
+                    'commentId': s['comment'],
+                    'tryCount': 0,
+                    'ac': False,
+                    'judged': False,
+                })
+            c['tryCount'] += 1
+            c['ac'] |= judge_result == 0
+            c['judged'] |= judge_result != -1
+        tries = {}
+        for _id in sorted(comments):
+            c = comments[_id]
+            tries.setdefault(tuple(c['_id'].values()), c)
+        return {
+            'tries': [*tries.values()],
+            'acCount': [{
+                '_id': k,
+                'count': v
+            } for k, v in ac_count.items()],
+        }
+
+    def oj_statistic(
+        self,
+        problems: List[Union[Problem, int]],
+        students: Optional[List] = None,
+    ):
+        '''
+        OJ statistic of students in this course, computed by one
+        aggregation over submissions
+        '''
+        pids = [getattr(p, 'pid', p) for p in problems]
+        if students is None:
+            students = self.to_mongo().get('students', [])
+        pipeline = self.oj_submission_pipeline(pids, students)
+        try:
+            result = next(engine.Submission.objects.aggregate(pipeline))
+        except NotImplementedError:
+            submissions = engine.Submission.objects(problem__in=pids).only(
+                'problem',
+                'user',
+                'comment',
+                'result.judge_result',
+            ).as_pymongo()
+            result = self.evaluate_oj_submissions(submissions, students)
+        tries = {(t['_id']['user'], t['_id']['problem']): t
+                 for t in result['tries']}
+        ac_count = {c['_id']: c['count'] for c in result['acCount']}
+        no_try_result = {
+            'commentId': None,
+            'result': User.OJProblemResult.NO_TRY,
+            'tryCount': 0,
+        }
+        overview = {
+            str(pid): {
                 'tryCount': 0,
                 'acUser': 0,
                 'tryUser': 0,
+                'acCount': ac_count.get(pid, 0),
+            }
+            for pid in pids
+        }
+        student_stats = []
+        for info in User.info_many(students):
+            user_stat = {'info': info}
+            ac_cnt, try_cnt = 0, 0
+            for pid in pids:
+                t = tries.get((info['id'], pid))
+                if t is None:
+                    p_stat = no_try_result
+                elif t['ac']:
+                    p_stat = {
+                        'commentId': t['commentId'],
+                        'result': User.OJProblemResult.PASS,
+                        'tryCount': t['tryCount'],
+                    }
+                else:
+                    p_stat = {
+                        'commentId':
+                        t['commentId'],
+                        'result':
+                        User.OJProblemResult.FAIL
+                        if t['judged'] else User.OJProblemResult.NO_TRY,
+                        'tryCount':
+                        t['tryCount'],
+                    }
+                user_stat[str(pid)] = p_stat
+                is_ac = p_stat['result'] == User.OJProblemResult.PASS
+                tried = p_stat['result'] != User.OJProblemResult.NO_TRY
+                ac_cnt += is_ac
+                try_cnt += p_stat['tryCount']
+                overview[str(pid)]['tryCount'] += p_stat['tryCount']
+                overview[str(pid)]['acUser'] += is_ac
+                overview[str(pid)]['tryUser'] += tried
+            user_stat['overview'] = {
+                'acCount': ac_cnt,
+                'tryCount': try_cnt,
             }
-            p_stat['acCount'] = len(
-                engine.Submission.objects(
-                    problem=problem.pk,
-                    result__judge_result=0,  # AC
-                ))
-            for s_stat in student_stats:
-                s_stat = s_stat[str(problem.pid)]
-                p_stat['tryCount'] += s_stat['tryCount']
-                is_ac = s_stat['result'] == User.OJProblemResult.PASS
-                p_stat['acUser'] += is_ac
-                tried = s_stat['result'] != User.OJProblemResult.NO_TRY
-                p_stat['tryUser'] += tried
-            overview[str(problem.pid)] = p_stat
+            student_stats.append(user_stat)
         return {
             'overview': overview,
             'users': student_stats,
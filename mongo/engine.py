@@ -23,6 +23,72 @@ def _connect():
 _connect()
 
 
+class AuthorSnapshot(EmbeddedDocument):
+    '''
+    Copy of the author's public info, so that serializing documents
+    doesn't need to fetch users
+    '''
+    # `User` fields copied into the snapshot
+    SOURCES = ('username', 'display_name', 'school', 'role', 'md5')
+
+    id = ObjectIdField()
+    username = StringField()
+    display_name = StringField(db_field='displayName')
+    school = StringField()
+    role = IntField()
+    md5 = StringField()
+
+    @classmethod
+    def from_user(cls, user: 'User') -> 'AuthorSnapshot':
+        return cls(
+            id=user.id,
+            **{k: getattr(user, k)
+               for k in cls.SOURCES},
+        )
+
+    @property
+    def info(self):
+        return {
+            'username': self.username,
+            'displayName': self.display_name,
+            'school': self.school,
+            'role': self.role,
+            'md5': self.md5,
+            'id': self.id,
+        }
+
+
+class AuthorSnapshotMixin:
+    '''
+    Fill `author_snapshot` before the document is saved, the document
+    should declare `author` and `author_snapshot` fields
+    '''
+    def clean(self):
+        if self.author_snapshot is not None:
+            return
+        # Read the raw value, accessing `self.author` caches the
+        # dereferenced user in this document
+        author = self._data.get('author')
+        if author is None:
+            return
+        if not isinstance(author, User):
+            author = User.objects(pk=getattr(author, 'id', author)).get()
+        self.author_snapshot = AuthorSnapshot.from_user(author)
+
+    @property
+    def author_info(self):
+        # Fallback for documents which haven't been backfilled
+        if self.author_snapshot is None:
+            from .cache import UserInfoCache
+            author = self._data.get('author')
+            infos = UserInfoCache().get_many([getattr(author, 'id', author)])
+            if not infos:
+                return None
+            # Same shape as the snapshot, which doesn't have email
+            return {k: v for k, v in infos[0].items() if k != 'email'}
+        return self.author_snapshot.info
+
+
 class User(Document):
     class Role(Enum):
         ADMIN = 0
@@ -54,18 +120,36 @@ class User(Document):
         choices=Role.choices(),
     )
     courses = ListField(ReferenceField('Course'), default=[])
-    # problems this user created
-    problems = ListField(ReferenceField('Problem'), default=[])
-    # comments this user wrote
-    comments = ListField(ReferenceField('Comment'), default=[])
-    # comments this user liked
-    likes = ListField(
-        ReferenceField('Comment'),
-        default=[],
-        de_field='likedComments',
-    )
-    # notification list
-    notifs = ListField(ReferenceField('Notif'), default=[])
+    # Documents which may not have been migrated still contain
+    # `problems`, `comments`, `likes` and `notifs`
+    meta = {'strict': False}
+
+    # Relations below are read from the referencing side so that the
+    # size of user document stays constant
+    @property
+    def problems(self):
+        '''
+        Problems this user created
+        '''
+        return Problem.objects(author=self.pk).order_by('pid')
+
+    @property
+    def comments(self):
+        '''
+        Comments (including replies) this user wrote
+        '''
+        return Comment.objects(author=self.pk).order_by('created')
+
+    @property
+    def likes(self):
+        '''
+        Comments this user liked
+        '''
+        return Comment.objects(liked=self.pk)
+
+    @property
+    def notifs(self):
+        return Notif.objects(receiver=self.pk).order_by('id')
 
     @classmethod
     def email_hash(cls, email: str):
@@ -83,13 +167,62 @@ class User(Document):
             self.check_email(ks['email'])
             ks['md5'] = self.email_hash((ks['email'] or ''))
         super().update(**ks)
+        # Strip operators, e.g. `set__display_name` -> `display_name`
+        fields = {k.split('__')[-1] for k in ks}
+        if not fields.isdisjoint(self.INFO_FIELDS):
+            from .cache import UserInfoCache
+            UserInfoCache().invalidate(self.id)
+        if not fields.isdisjoint(self.SESSION_FIELDS):
+            from .cache import SessionCache
+            SessionCache().invalidate(self.id)
+        if not fields.isdisjoint(self.CLAIM_FIELDS):
+            from .cache import EnrollmentVersion
+            EnrollmentVersion().bump(self.id)
+        if not fields.isdisjoint(self.TOKEN_FIELDS):
+            from .cache import TokenCache
+            TokenCache().invalidate(self.id)
+        if not fields.isdisjoint(AuthorSnapshot.SOURCES):
+            self.reload(*AuthorSnapshot.SOURCES)
+            self.refresh_author_snapshot()
+
+    def refresh_author_snapshot(self):
+        '''
+        Update the author snapshot of every document this user wrote
+        '''
+        snapshot = AuthorSnapshot.from_user(self)
+        for document in (Problem, Comment, Attachment):
+            document.objects(author=self.pk).update(author_snapshot=snapshot)
 
     def save(self, *args, **ks):
         self.check_email(self.email)
         self.md5 = self.email_hash((self.email or ''))
+        created = self._created or self.pk is None
         super().save(*args, **ks)
+        # A new user hasn't written anything
+        if not created:
+            self.refresh_author_snapshot()
+        from .cache import (
+            EnrollmentVersion,
+            SessionCache,
+            TokenCache,
+            UserInfoCache,
+        )
+        UserInfoCache().invalidate(self.id)
+        SessionCache().invalidate(self.id)
+        TokenCache().invalidate(self.id)
+        EnrollmentVersion().bump(self.id)
         return self.reload()
 
+    # Fields included in `info`
+    INFO_FIELDS = ('username', 'display_name', 'school', 'role', 'email',
+                   'md5')
+    # Fields cached in login sessions
+    SESSION_FIELDS = ('role', 'active', 'user_id')
+    # Fields signed into the course claim of JWT
+    CLAIM_FIELDS = ('role', 'courses')
+    # Fields which can be signed into JWT
+    TOKEN_FIELDS = (*INFO_FIELDS, 'courses', 'user_id')
+
     @property
     def info(self):
         return {
@@ -123,6 +256,8 @@ class Course(Document):
     OJ_problem_tags = ListField(StringField(max_length=16), default=list)
     students = ListField(ReferenceField('User'), default=[])
     problems = ListField(ReferenceField('Problem'), default=[])
+    # Removed students whose data is not purged yet
+    pending_purge = ListField(ReferenceField('User'), default=list)
     year = IntField(required=True)
     semester = IntField(required=True)
     description = StringField(default='', max_length=10**4)
@@ -132,6 +267,24 @@ class Course(Document):
     )
 
 
+class Enrollment(Document):
+    '''
+    A student in a course, mirrors `Course.students` so that membership
+    can be checked without loading the student list
+    '''
+    meta = {
+        'indexes': [
+            {
+                'fields': ['user', 'course'],
+                'unique': True,
+            },
+            'course',
+        ]
+    }
+    user = ReferenceField('User', required=True)
+    course = ReferenceField('Course', required=True)
+
+
 class Tag(Document):
     class Category(Enum):
         COURSE = 0
@@ -143,7 +296,7 @@ class Tag(Document):
     categories = ListField(IntField(choices=Category.choices()), default=[])
 
 
-class Comment(Document):
+class Comment(AuthorSnapshotMixin, Document):
     class Status(Enum):
         HIDDEN = 0
         SHOW = 1
@@ -154,17 +307,33 @@ class Comment(Document):
         PENDING = 2
         NOT_TRY = 3
 
-    meta = {'indexes': ['floor', 'created', 'updated']}
+    meta = {
+        'indexes': [
+            'floor',
+            'created',
+            'updated',
+            ('problem', 'floor'),
+            'author',
+            'liked',
+        ]
+    }
     title = StringField(required=True, max_length=128)
     floor = IntField(required=True)
     content = StringField(required=True, max_length=5000000)
     author = ReferenceField('User', required=True)
+    author_snapshot = EmbeddedDocumentField(
+        AuthorSnapshot,
+        default=None,
+        db_field='authorSnapshot',
+    )
     problem = ReferenceField('Problem', required=True)
     submissions = ListField(ReferenceField('Submission'), default=[])
     # 0 is direct comment, 1 is reply of comments
     depth = IntField(default=0, choice=[0, 1])
     # those who like this comment
     liked = ListField(ReferenceField('User'), default=[])
+    # always equals to `len(liked)`, maintained in the same write
+    like_count = IntField(default=0, db_field='likeCount')
     status = IntField(
         default=Status.SHOW,
         choices=Status.choices(),
@@ -182,6 +351,13 @@ class Comment(Document):
         default=Acceptance.NOT_TRY,
         choices=Acceptance.choices(),
     )
+    # "<author>:<problem>" if the problem only allows one comment
+    # per user, it's unset after the comment is deleted
+    exclusive_key = StringField(
+        unique=True,
+        sparse=True,
+        db_field='exclusiveKey',
+    )
 
     @property
     def is_comment(self):
@@ -203,11 +379,16 @@ class Comment(Document):
         return self.submissions[-1] if len(self.submissions) else None
 
 
-class Attachment(Document):
+class Attachment(AuthorSnapshotMixin, Document):
     filename = StringField(max_length=64, required=True)
     description = StringField(max_length=5000000, required=True)
     file = FileField(required=True)
     author = ReferenceField('User', requried=True)
+    author_snapshot = EmbeddedDocumentField(
+        AuthorSnapshot,
+        default=None,
+        db_field='authorSnapshot',
+    )
     created = DateTimeField(default=datetime.now)
     updated = DateTimeField(default=datetime.now)
     size = IntField(default=0)
@@ -226,7 +407,7 @@ class Attachment(Document):
         return {
             'filename': self.filename,
             'description': self.description,
-            'author': self.author.info,
+            'author': self.author_info,
             'created': self.created.timestamp(),
             'updated': self.updated.timestamp(),
             'id': self.id,
@@ -238,7 +419,7 @@ class Attachment(Document):
         }
 
 
-class Problem(Document):
+class Problem(AuthorSnapshotMixin, Document):
     class Type(Enum):
         class OJProblem(EmbeddedDocument):
             input = StringField(max_length=5000000, required=True)
@@ -260,13 +441,18 @@ class Problem(Document):
         def delete(self):
             return self.file.delete
 
-    meta = {'indexes': [{'fields': ['$title']}, 'timestamp']}
+    meta = {'indexes': [{'fields': ['$title']}, 'timestamp', 'author']}
     pid = SequenceField(required=True, primary_key=True)
     height = IntField(default=0)
     title = StringField(max_length=64, required=True)
     course = ReferenceField('Course', reuired=True)
     description = StringField(max_length=5000000, required=True)
     author = ReferenceField('User', requried=True)
+    author_snapshot = EmbeddedDocumentField(
+        AuthorSnapshot,
+        default=None,
+        db_field='authorSnapshot',
+    )
     tags = ListField(StringField(max_length=16), default=[])
     attachments = ListField(
         EmbeddedDocumentField(ProblemAttachment),
@@ -305,7 +491,7 @@ class Problem(Document):
 
 
 class Submission(Document):
-    meta = {'allow_inheritance': True}
+    meta = {'allow_inheritance': True, 'indexes': ['comment']}
 
     # TODO: Use more meaningful names for status, state and result
 
@@ -315,6 +501,21 @@ class Submission(Document):
         stderr = StringField(max_length=10**6, default='')
         judge_result = IntField(default=None)
 
+    class Trace(EmbeddedDocument):
+        '''
+        Timestamps of each stage of the latest judge attempt
+        '''
+        # the submission is created for the first attempt, or rejudge is
+        # requested for later ones
+        created = DateTimeField()
+        queued = DateTimeField()
+        dispatched = DateTimeField()
+        # url of the sandbox which judges this submission
+        sandbox = StringField()
+        completed = DateTimeField()
+        # all `submission_completed` handlers finished
+        handled = DateTimeField()
+
     class JudgeResult(Enum):
         AC = 0
         WA = 1
@@ -344,6 +545,7 @@ class Submission(Document):
         default=State.PENDING,
         choices=State.choices(),
     )
+    trace = EmbeddedDocumentField(Trace, default=None)
 
 
 class Notif(Document):
@@ -352,12 +554,17 @@ class Notif(Document):
             DICT_FEILDS = {'type': 'type_name'}
             meta = {'allow_inheritance': True}
 
+            # This regular expression finds the zero-length position
+            # whose next character is an uppercase letter.
+            TYPE_NAME_SEP = re.compile(r'(?<!^)(?=[A-Z])')
+
+            @classmethod
+            def get_type_name(cls) -> str:
+                return cls.TYPE_NAME_SEP.sub('_', cls.__name__).upper()
+
             @property
             def type_name(self) -> str:
-                # This regular expression finds the zero-length position
-                # whose next character is an uppercase letter.
-                return re.compile(r'(?<!^)(?=[A-Z])').sub(
-                    '_', self.__class__.__name__).upper()
+                return self.get_type_name()
 
             def to_dict(self) -> dict:
                 def resolve(attrs: List[str]):
@@ -433,6 +640,10 @@ class Notif(Document):
         READ = 1
         HIDDEN = 2
 
+    # Inbox of a user, newest first. `_id` grows with creation time, so it
+    # serves as both the order and the page cursor
+    meta = {'indexes': [{'fields': ['receiver', '-id']}]}
+    receiver = ReferenceField(User)
     status = IntField(
         default=Status.UNREAD,
         choices=Status.choices(),
@@ -634,6 +845,65 @@ class Task(Document):
         return p, q
 
 
+class UserStats(Document):
+    '''
+    Materialized statistic of a user in a course, only comments under
+    normal (non-OJ) problems are recorded, except replies
+    '''
+    class CommentEntry(EmbeddedDocument):
+        id = ObjectIdField(required=True)
+        pid = IntField(required=True)
+        floor = IntField(required=True)
+        acceptance = IntField()
+        success = IntField(default=0)
+        fail = IntField(default=0)
+
+    class ReplyEntry(EmbeddedDocument):
+        id = ObjectIdField(required=True)
+        pid = IntField(required=True)
+        floor = IntField(required=True)
+
+    class LikeEntry(EmbeddedDocument):
+        id = ObjectIdField(required=True)
+        pid = IntField(required=True)
+        floor = IntField(required=True)
+        # author of the liked comment
+        staree = ObjectIdField(required=True)
+
+    class StarEntry(EmbeddedDocument):
+        '''
+        `user` likes `comment` written by the owner of stats
+        '''
+        comment = ObjectIdField(required=True)
+        user = ObjectIdField(required=True)
+
+    meta = {
+        'collection': 'user_stats',
+        'indexes': [
+            {
+                'fields': ['user', 'course'],
+                'unique': True,
+            },
+            'course',
+        ],
+    }
+    user = ReferenceField('User', required=True)
+    course = ReferenceField('Course', required=True)
+    # pids of problems this user created
+    problems = ListField(IntField(), default=[])
+    comments = ListField(EmbeddedDocumentField(CommentEntry), default=[])
+    replies = ListField(EmbeddedDocumentField(ReplyEntry), default=[])
+    # comments this user liked
+    likes = ListField(EmbeddedDocumentField(LikeEntry), default=[])
+    # likes of this user's comments
+    stars = ListField(EmbeddedDocumentField(StarEntry), default=[])
+    # Increased by every event, a rebuild only writes if no event comes
+    # while it's loading
+    version = IntField(default=0)
+    # A placeholder inserted by a rebuild which hasn't been written
+    stale = BooleanField()
+
+
 # register delete rule. execute here to resolve `NotRegistered`
 # exception caused by two-way reference
 # see detailed info at https://github.com/MongoEngine/mongoengine/issues/1707
@@ -643,15 +913,15 @@ User.register_delete_rule(Course, 'students', PULL)
 User.register_delete_rule(Comment, 'author', CASCADE)
 User.register_delete_rule(Submission, 'user', CASCADE)
 User.register_delete_rule(Comment, 'liked', PULL)
+User.register_delete_rule(Notif, 'receiver', CASCADE)
+User.register_delete_rule(Enrollment, 'user', CASCADE)
+Course.register_delete_rule(Enrollment, 'course', CASCADE)
 Problem.register_delete_rule(Course, 'problems', PULL)
-Problem.register_delete_rule(User, 'problems', PULL)
 Problem.register_delete_rule(Comment, 'problem', CASCADE)
 Problem.register_delete_rule(Submission, 'problem', NULLIFY)
 Submission.register_delete_rule(Comment, 'submissions', PULL)
 Comment.register_delete_rule(Comment, 'replies', PULL)
 Comment.register_delete_rule(Submission, 'comment', CASCADE)
-Comment.register_delete_rule(User, 'comments', PULL)
-Comment.register_delete_rule(User, 'likes', PULL)
 Comment.register_delete_rule(Problem, 'comments', PULL)
 Requirement.register_delete_rule(Task, 'requirements', PULL)
 Task.register_delete_rule(Requirement, 'task', CASCADE)
@@ -3,7 +3,12 @@ from blinker import signal
 requirement_added = signal('requirement_added')
 submission_completed = signal('submission_completed')
 comment_created = signal('comment_created')
+comment_deleted = signal('comment_deleted')
+comment_result_updated = signal('comment_result_updated')
 reply_created = signal('reply_created')
 comment_liked = signal('comment_be_liked')
 comment_unliked = signal('comment_unliked')
 task_time_changed = signal('task_time_changed')
+problem_created = signal('problem_created')
+notif_created = signal('notif_created')
+notif_read = signal('notif_read')
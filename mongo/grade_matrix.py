@@ -0,0 +1,130 @@
+import base64
+from typing import Any, Dict, List, Optional
+import numpy as np
+from . import engine
+from .user import User
+
+__all__ = ('GradeMatrix', )
+
+Acceptance = engine.Comment.Acceptance
+
+
+class GradeMatrix:
+    '''
+    Students × problems matrices of a course, built from one bulk fetch of
+    comments. Each cell holds the best acceptance, the number of tries and
+    the number of likes of the student's comments under that problem.
+    '''
+    ENCODINGS = ('json', 'base64')
+    PERCENTILES = (25, 50, 75)
+
+    def __init__(self, course, problems: Optional[List[int]] = None):
+        self.students = course.to_mongo().get('students', [])
+        if problems is None:
+            problems = engine.Problem.objects(
+                course=course.id).order_by('pid').scalar('pid')
+        self.problems = [*problems]
+        shape = (len(self.students), len(self.problems))
+        self.acceptance = np.full(shape, Acceptance.NOT_TRY, dtype=np.int8)
+        self.tries = np.zeros(shape, dtype=np.int32)
+        self.likes = np.zeros(shape, dtype=np.int32)
+        self._load()
+
+    def _load(self):
+        comments = engine.Comment.objects(
+            problem__in=self.problems,
+            author__in=self.students,
+            depth=0,
+            status=engine.Comment.Status.SHOW,
+        ).only(
+            'author',
+            'problem',
+            'acceptance',
+            'like_count',
+            'submissions',
+        ).as_pymongo()
+        row_of = {u: i for i, u in enumerate(self.students)}
+        col_of = {pid: i for i, pid in enumerate(self.problems)}
+        cells = [(
+            row_of[c['author']],
+            col_of[c['problem']],
+            c.get('acceptance', Acceptance.NOT_TRY),
+            len(c.get('submissions', [])),
+            c.get('likeCount', 0),
+        ) for c in comments]
+        if len(cells) == 0:
+            return
+        rows, cols, acceptance, tries, likes = map(np.array, zip(*cells))
+        idx = (rows, cols)
+        # Smaller acceptance is better, keep the best one if a student
+        # has many comments under the same problem
+        np.minimum.at(self.acceptance, idx, acceptance.astype(np.int8))
+        np.add.at(self.tries, idx, tries)
+        np.add.at(self.likes, idx, likes)
+
+    def summary(self) -> Dict[str, Dict[str, np.ndarray]]:
+        accepted = self.acceptance == Acceptance.ACCEPTED
+        ac_count = accepted.sum(axis=1)
+        student_cnt = len(self.students)
+        if student_cnt:
+            ac_rate = accepted.mean(axis=0)
+            percentiles = np.percentile(ac_count, self.PERCENTILES)
+        else:
+            ac_rate = np.zeros(len(self.problems))
+            percentiles = np.zeros(len(self.PERCENTILES))
+        return {
+            'problems': {
+                'acUser': accepted.sum(axis=0),
+                'tryUser': (self.tries > 0).sum(axis=0),
+                'tryCount': self.tries.sum(axis=0),
+                'acRate': ac_rate,
+            },
+            'students': {
+                'acCount': ac_count,
+                'tryCount': self.tries.sum(axis=1),
+                'likeCount': self.likes.sum(axis=1),
+            },
+            # percentiles of students' AC count
+            'percentiles': {
+                str(p): v
+                for p, v in zip(self.PERCENTILES, percentiles.tolist())
+            },
+        }
+
+    @staticmethod
+    def encode(arr: np.ndarray, encoding: str = 'json') -> Any:
+        '''
+        Encode an array as nested lists, or as little-endian raw bytes in
+        base64 with its dtype and shape
+        '''
+        if encoding == 'base64':
+            arr = np.ascontiguousarray(arr, arr.dtype.newbyteorder('<'))
+            return {
+                'dtype': arr.dtype.str,
+                'shape': arr.shape,
+                'data': base64.b64encode(arr.tobytes()).decode(),
+            }
+        return arr.tolist()
+
+    def to_dict(self, encoding: str = 'json') -> Dict[str, Any]:
+        if encoding not in self.ENCODINGS:
+            raise ValueError(f'Unsupported encoding {encoding}')
+        infos = {
+            info['id']: info['username']
+            for info in User.info_many(self.students)
+        }
+        summary = self.summary()
+        for k in ('problems', 'students'):
+            summary[k] = {
+                name: self.encode(arr, encoding)
+                for name, arr in summary[k].items()
+            }
+        return {
+            'students': self.students,
+            'usernames': [infos.get(u) for u in self.students],
+            'problems': self.problems,
+            'acceptance': self.encode(self.acceptance, encoding),
+            'tries': self.encode(self.tries, encoding),
+            'likes': self.encode(self.likes, encoding),
+            'summary': summary,
+        }
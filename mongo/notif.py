@@ -1,26 +1,184 @@
+from collections import Counter
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from bson import ObjectId
 from . import engine
 from .base import MongoBase
+from .cache import UnreadCounter
+from .event import notif_created, notif_read
+from .user import User
 
 __all__ = ['Notif']
 
 
+def compile_serializer(info_cls) -> Tuple[str, List[Tuple[str, str, str]]]:
+    '''
+    Turn `DICT_FEILDS` of a notification type into (key, field, attribute)
+    triples which read from raw documents
+    '''
+    fields = []
+    for key, path in info_cls.DICT_FEILDS.items():
+        if path == 'type_name':
+            continue
+        field, _, attr = path.partition('.')
+        fields.append((key, field, attr))
+    return info_cls.get_type_name(), fields
+
+
 class Notif(MongoBase, engine=engine.Notif):
     types = engine.Notif.Type
+    PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+    # Serializers keyed by `_cls` of info
+    SERIALIZERS = {
+        info_cls._class_name: compile_serializer(info_cls)
+        for info_cls in engine.Notif.Type.choices()
+    }
+
+    @classmethod
+    def new(cls, info, receiver):
+        return cls.new_many([(info, receiver)])[0]
+
+    @classmethod
+    def new_many(cls, notifs: Iterable[Tuple[Any, Any]]) -> List['Notif']:
+        '''
+        Create notifications from (info, receiver) pairs with one insert
+        '''
+        notifs = [(info, getattr(r, 'pk', r)) for info, r in notifs]
+        if len(notifs) == 0:
+            return []
+        docs = [
+            cls.engine(id=ObjectId(), info=info, receiver=receiver)
+            for info, receiver in notifs
+        ]
+        for doc in docs:
+            doc.validate()
+        raws = [doc.to_mongo().to_dict() for doc in docs]
+        cls.engine._get_collection().insert_many(raws)
+        UnreadCounter().add(Counter(r for _, r in notifs))
+        # Serialize only if someone is going to push them
+        if notif_created.receivers:
+            for raw, item in zip(raws, cls.serialize_many(raws)):
+                notif_created.send(raw['receiver'], notif=item)
+        return [*map(cls, docs)]
+
+    @classmethod
+    def unread_count(cls, user) -> int:
+        return UnreadCounter().get(getattr(user, 'pk', user))
 
     @classmethod
-    def new(cls, info):
-        notif = cls.engine(info=info).save()
-        return cls(notif)
+    def inbox(
+        cls,
+        user,
+        cursor: Optional[ObjectId] = None,
+        limit: Optional[int] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[ObjectId]]:
+        '''
+        A page of visible notifications of `user`, newest first. Return
+        serialized notifications and the cursor of next page.
+        '''
+        limit = min(limit or cls.PAGE_SIZE, cls.MAX_PAGE_SIZE)
+        query = {
+            'receiver': getattr(user, 'pk', user),
+            'status__ne': engine.Notif.Status.HIDDEN,
+        }
+        if cursor is not None:
+            query['pk__lt'] = cursor
+        # Fetch one more to know whether there is a next page
+        docs = [
+            *cls.engine.objects(**query).order_by('-id').limit(limit +
+                                                               1).as_pymongo()
+        ]
+        next_cursor = docs[limit - 1]['_id'] if len(docs) > limit else None
+        return cls.serialize_many(docs[:limit]), next_cursor
+
+    @classmethod
+    def all_of(cls, user) -> List[Dict[str, Any]]:
+        '''
+        All notifications of `user` without id and status, oldest first.
+        It's the response of inbox before pagination.
+        '''
+        docs = cls.engine.objects(
+            receiver=getattr(user, 'pk', user)).order_by('id').as_pymongo()
+        return [{k: v
+                 for k, v in item.items() if k not in ('id', 'status')}
+                for item in cls.serialize_many([*docs])]
+
+    @classmethod
+    def serialize_many(cls, docs: List[Dict[str, Any]]) -> List[Dict]:
+        '''
+        Serialize raw notification documents, users are fetched in batch
+        '''
+        users = {
+            doc['info'][field]
+            for doc in docs
+            for _, field, attr in cls.SERIALIZERS[doc['info']['_cls']][1]
+            if attr == 'info' and field in doc['info']
+        }
+        users = {info['id']: info for info in User.info_many(users)}
+        ret = []
+        for doc in docs:
+            info = doc['info']
+            type_name, fields = cls.SERIALIZERS[info['_cls']]
+            item = {
+                'id': doc['_id'],
+                'status': doc.get('status', engine.Notif.Status.UNREAD),
+                'type': type_name,
+            }
+            for key, field, attr in fields:
+                value = info.get(field)
+                item[key] = users.get(value) if attr == 'info' else value
+            ret.append(item)
+        return ret
+
+    @classmethod
+    def read_many(cls, user, ids: Optional[List[ObjectId]] = None) -> int:
+        '''
+        Mark unread notifications of `user` as read, all of them if `ids`
+        is not provided. Return the count of notifications marked.
+        '''
+        user = getattr(user, 'pk', user)
+        query = {
+            'receiver': user,
+            'status': engine.Notif.Status.UNREAD,
+        }
+        if ids is not None:
+            query['pk__in'] = ids
+        cnt = cls.engine.objects(**query).update(
+            status=engine.Notif.Status.READ)
+        UnreadCounter().add({user: -cnt})
+        if cnt:
+            notif_read.send(user, count=cnt)
+        return cnt
 
     def read(self):
         if self.status == engine.Notif.Status.UNREAD:
-            self.update(status=engine.Notif.Status.READ)
+            self.read_many(self.to_mongo()['receiver'], [self.pk])
             self.reload()
 
     def hide(self):
-        if self.status != engine.Notif.Status.HIDDEN:
+        if self.status == engine.Notif.Status.HIDDEN:
+            return
+        # Hiding an unread notification also decreases the counter
+        cnt = self.engine.objects(
+            pk=self.pk,
+            status=engine.Notif.Status.UNREAD,
+        ).update(status=engine.Notif.Status.HIDDEN)
+        if cnt:
+            receiver = self.to_mongo()['receiver']
+            UnreadCounter().add({receiver: -cnt})
+            notif_read.send(receiver, count=cnt)
+        else:
             self.update(status=engine.Notif.Status.HIDDEN)
-            self.reload()
+        self.reload()
 
     def to_dict(self):
-        return self.info.to_dict()
+        # Serialize like the inbox, so users are read from cache
+        item = self.serialize_many([self.to_mongo().to_dict()])[0]
+        return {k: v for k, v in item.items() if k not in ('id', 'status')}
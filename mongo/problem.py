@@ -8,6 +8,7 @@ from .base import MongoBase
 from .course import Course
 from .user import User
 from .utils import doc_required, get_redis_client
+from .event import problem_created
 from zipfile import ZipFile
 import tempfile
 import io
@@ -96,9 +97,10 @@ class Problem(MongoBase, engine=engine.Problem):
                 '_id',
                 'isTemplate',
                 'author',
+                'authorSnapshot',
                 'course',
         ):
-            del p[field]
+            p.pop(field, None)
         # field name conversion
         p['default_code'] = p.pop('defaultCode')
         p['allow_multiple_comments'] = p.pop('allowMultipleComments')
@@ -134,6 +136,32 @@ class Problem(MongoBase, engine=engine.Problem):
                 raise ValueError(
                     'Exist tag that is not allowed to use in this course')
         self.obj.update(**ks)
+        if ks.get('allow_multiple_comments') == False:
+            self.lock_comments()
+
+    def lock_comments(self):
+        '''
+        Set exclusive key of comments created while multiple comments were
+        allowed, the earliest comment of each author holds it
+        '''
+        comments = [
+            *engine.Comment.objects(
+                problem=self.pk,
+                depth=0,
+                status=engine.Comment.Status.SHOW,
+            ).order_by('created').only('author', 'exclusive_key').as_pymongo()
+        ]
+        locked = {c['author'] for c in comments if 'exclusiveKey' in c}
+        for c in comments:
+            if c['author'] in locked:
+                continue
+            locked.add(c['author'])
+            try:
+                engine.Comment.objects(pk=c['_id']).update_one(
+                    set__exclusive_key=f'{c["author"]}:{self.pk}')
+            except engine.NotUniqueError:
+                # Another comment of this author just took it
+                pass
 
     def to_dict(self):
         '''
@@ -148,10 +176,11 @@ class Problem(MongoBase, engine=engine.Problem):
             'version_number': att.version_number,
         } for att in self.attachments]
         ret['timestamp'] = ret['timestamp'].timestamp()
-        ret['author'] = self.author.info
+        ret['author'] = self.author_info
         ret['comments'] = [str(c) for c in ret['comments']]
-        for k in ('_id', 'height'):
-            del ret[k]
+        for k in ('_id', 'height', 'authorSnapshot'):
+            if k in ret:
+                del ret[k]
         if self.is_OJ:
             for k in ('input', 'output'):
                 del ret['extra'][k]
@@ -232,9 +261,13 @@ class Problem(MongoBase, engine=engine.Problem):
             f'can not find a attachment named [{filename}]')
 
     def rejudge(self):
+        '''
+        Rejudge submissions of all comments, tokens are assigned in batch
+        '''
         from .comment import Comment
-        for comment in self.comments:
-            Comment(comment).submit()
+        from .submission import Submission
+        Submission.submit_many(
+            [Comment(comment).reset_submission() for comment in self.comments])
 
     def get_file(self):
         # Extract problem attachments
@@ -368,5 +401,6 @@ class Problem(MongoBase, engine=engine.Problem):
         ).save()
         # update reference
         course.update(push__problems=p)
-        author.update(push__problems=p)
-        return cls(p)
+        problem = cls(p)
+        problem_created.send(problem)
+        return problem
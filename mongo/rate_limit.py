@@ -0,0 +1,126 @@
+import math
+import time
+from typing import Dict, Optional, Tuple
+from .utils import get_redis_client, logger, RedisScript
+from .config import config
+
+__all__ = (
+    'RateLimiter',
+    'RateLimitExceeded',
+)
+
+# KEYS: metrics hash, then one bucket per scope
+# ARGV: now, then (scope, rate, burst) for each bucket
+# All buckets are consumed together or none of them is. Return
+# 0 if consumed, otherwise "<scope>:<seconds to wait>" (as a string,
+# because lua numbers are truncated to integer by redis)
+CONSUME_SCRIPT = RedisScript('''
+local now = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+local limited = nil
+for i = 2, #KEYS do
+    local j = 3 * (i - 2) + 2
+    local rate = tonumber(ARGV[j + 1])
+    local burst = tonumber(ARGV[j + 2])
+    local bucket = redis.call('hmget', KEYS[i], 'tokens', 'ts')
+    local t = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    t = math.min(burst, t + math.max(0, now - ts) * rate)
+    tokens[i] = t
+    if t < 1 and (1 - t) / rate > wait then
+        wait = (1 - t) / rate
+        limited = ARGV[j]
+    end
+end
+if limited then
+    redis.call('hincrby', KEYS[1], 'rejected:' .. limited, 1)
+    return limited .. ':' .. tostring(wait)
+end
+for i = 2, #KEYS do
+    local j = 3 * (i - 2) + 2
+    local ttl = math.ceil(tonumber(ARGV[j + 2]) / tonumber(ARGV[j + 1])) + 1
+    redis.call('hset', KEYS[i], 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('expire', KEYS[i], ttl)
+end
+redis.call('hincrby', KEYS[1], 'allowed', 1)
+return 0
+''')
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, name: str, scope: str, retry_after: float) -> None:
+        self.name = name
+        self.scope = scope
+        # seconds
+        self.retry_after = math.ceil(retry_after)
+        super().__init__(f'Too many {name}, retry after '
+                         f'{self.retry_after} seconds')
+
+
+class RateLimiter:
+    '''
+    Token bucket rate limiter stored in redis, budgets are read from
+    `RATE_LIMIT.<name>.<scope>` in config if not provided
+    '''
+    def __init__(
+        self,
+        name: str,
+        budgets: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        self.name = name
+        self._budgets = budgets
+        self._client = get_redis_client()
+
+    @property
+    def metrics_key(self):
+        return f'rate-limit:{self.name}'
+
+    def bucket_key(self, scope: str, _id) -> str:
+        return f'rate-limit:{self.name}:{scope}:{_id}'
+
+    def budget(self, scope: str) -> Optional[Tuple[float, float]]:
+        '''
+        Return (rate, burst) of the scope, `None` means unlimited
+        '''
+        if self._budgets is not None:
+            return self._budgets.get(scope)
+        budget = config.get(f'RATE_LIMIT.{self.name}.{scope}')
+        if budget is None:
+            return None
+        return float(budget['rate']), float(budget['burst'])
+
+    def consume(self, **subjects):
+        '''
+        Take one token from each subject's bucket, e.g.
+        `consume(user=user.id, course=course.id)`. Subjects without
+        budget are not limited.
+
+        Raises:
+            RateLimitExceeded: Any of the buckets is empty
+        '''
+        keys = [self.metrics_key]
+        args = [time.time()]
+        for scope, _id in subjects.items():
+            budget = self.budget(scope)
+            if budget is None:
+                continue
+            keys.append(self.bucket_key(scope, _id))
+            args.extend((scope, *budget))
+        if len(keys) == 1:
+            return
+        result = CONSUME_SCRIPT(self._client, keys=keys, args=args)
+        if result != 0:
+            scope, wait = result.decode().rsplit(':', 1)
+            logger().info(f'Rate limited [name={self.name}, '
+                          f'scope={scope}, id={subjects[scope]}]')
+            raise RateLimitExceeded(self.name, scope, float(wait))
+
+    def metrics(self) -> Dict[str, int]:
+        '''
+        Count of allowed and rejected (by scope) requests
+        '''
+        return {
+            k.decode(): int(v)
+            for k, v in self._client.hgetall(self.metrics_key).items()
+        }
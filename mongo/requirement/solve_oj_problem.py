@@ -55,7 +55,7 @@ class SolveOJProblem(MongoBase, engine=engine.SolveOJProblem):
         ))
 
     @classmethod
-    def on_submission_completed(cls, submission):
+    def on_submission_completed(cls, submission, **ks):
         if not cls.is_valid_submission(submission):
             return
         tasks = Task.filter(course=submission.problem.course)
@@ -1,21 +1,77 @@
-import io
-import tempfile
+import time
 from abc import ABC, abstractmethod
-from zipfile import ZipFile
+from typing import Dict, Iterable, List, Optional
 import requests as rq
 from . import engine
-from .utils import doc_required, logger, drop_none
+from .utils import (
+    Enum,
+    doc_required,
+    drop_none,
+    get_redis_client,
+    logger,
+    RedisScript,
+)
 from .submission import Submission
 from .problem import Problem
-from .token import Token
+from .token import Token, TokenExistError, TOKEN_EX
+from .event import submission_completed
 from .config import config
 
 __all__ = (
     'ISandbox',
     'Sandbox',
+    'SandboxHealth',
     'SandboxNotFound',
 )
 
+# (connect, read) timeout of requests sent to sandbox
+REQUEST_TIMEOUT = (3, 10)
+
+# KEYS: health hash, probe key
+# ARGV: ok (0/1), latency ('' if unknown), now, alpha, error threshold,
+#   min failures, cooldown, default latency
+# Update EWMA of error rate and latency, and the state of circuit
+# (0: closed, 1: open). Return 1 if the circuit is opened.
+RECORD_SCRIPT = RedisScript('''
+local ok = ARGV[1] == '1'
+local now = tonumber(ARGV[3])
+local alpha = tonumber(ARGV[4])
+local health = redis.call(
+    'hmget', KEYS[1], 'state', 'error_rate', 'latency', 'failures', 'opened_at')
+local state = tonumber(health[1]) or 0
+local error_rate = tonumber(health[2]) or 0
+local latency = tonumber(health[3]) or tonumber(ARGV[8])
+local failures = tonumber(health[4]) or 0
+local opened_at = tonumber(health[5]) or 0
+local half_open = state == 1 and now - opened_at >= tonumber(ARGV[7])
+if ok then
+    error_rate = (1 - alpha) * error_rate
+    failures = 0
+else
+    error_rate = alpha + (1 - alpha) * error_rate
+    failures = failures + 1
+end
+if ARGV[2] ~= '' then
+    latency = alpha * tonumber(ARGV[2]) + (1 - alpha) * latency
+end
+redis.call('hset', KEYS[1],
+    'error_rate', tostring(error_rate),
+    'latency', tostring(latency),
+    'failures', failures)
+redis.call('del', KEYS[2])
+if ok then
+    redis.call('hset', KEYS[1], 'state', 0)
+    return 0
+end
+-- A failed probe or too many errors open the circuit
+if half_open or (error_rate >= tonumber(ARGV[5])
+        and failures >= tonumber(ARGV[6])) then
+    redis.call('hset', KEYS[1], 'state', 1, 'opened_at', tostring(now))
+    return 1
+end
+return 0
+''')
+
 
 class SandboxNotFound(Exception):
     pass
@@ -28,6 +84,19 @@ class ISandbox(ABC):
     def send(self, submission: Submission) -> bool:
         raise NotImplementedError
 
+    def send_many(self, submissions: List[Submission]) -> List[str]:
+        '''
+        Send submissions one by one, return ids of those which are still
+        pending
+        '''
+        pending = []
+        for submission in submissions:
+            try:
+                self.send(submission=submission)
+            except TokenExistError as e:
+                pending.append(e.id)
+        return pending
+
     @classmethod
     def use(cls, _cls):
         if not _cls is None and not issubclass(_cls, ISandbox):
@@ -35,22 +104,266 @@ class ISandbox(ABC):
         cls.cls = _cls
 
 
+class SandboxHealth:
+    '''
+    Health of a sandbox, shared between workers through redis. It keeps
+    the EWMA of error rate and request latency, tracks in-flight
+    submissions and works as a circuit breaker which takes a failing
+    sandbox out of rotation.
+    '''
+    class State(Enum):
+        CLOSED = 0
+        OPEN = 1
+        HALF_OPEN = 2
+
+    # Smoothing factor of EWMA
+    ALPHA = 0.2
+    # Open the circuit when the error rate reaches this value...
+    ERROR_THRESHOLD = 0.4
+    # ...after at least this many consecutive failures
+    MIN_FAILURES = 3
+    # Seconds an open circuit waits before letting a probe request pass
+    COOLDOWN = 30
+    # Latency (seconds) assumed for a sandbox without any record
+    DEFAULT_LATENCY = 1.0
+
+    def __init__(self, url: str):
+        self.url = url
+        self._client = get_redis_client()
+
+    @property
+    def key(self):
+        return f'sandbox-health:{self.url}'
+
+    @property
+    def inflight_key(self):
+        return f'sandbox-inflight:{self.url}'
+
+    @property
+    def probe_key(self):
+        return f'sandbox-probe:{self.url}'
+
+    @staticmethod
+    def dispatch_key(submission_id):
+        return f'sandbox-dispatch:{submission_id}'
+
+    @classmethod
+    def snapshots(
+        cls,
+        urls: Iterable[str],
+        now: Optional[float] = None,
+    ) -> List[Dict]:
+        '''
+        Load health of many sandboxes in one round trip
+        '''
+        if now is None:
+            now = time.time()
+        urls = [*urls]
+        pipe = get_redis_client().pipeline(transaction=False)
+        for url in urls:
+            health = cls(url)
+            pipe.hgetall(health.key)
+            pipe.zcount(health.inflight_key, now - TOKEN_EX, '+inf')
+        results = pipe.execute()
+        return [
+            cls.parse(url, results[2 * i], results[2 * i + 1], now)
+            for i, url in enumerate(urls)
+        ]
+
+    @classmethod
+    def parse(
+        cls,
+        url: str,
+        raw: Dict[bytes, bytes],
+        inflight: int,
+        now: float,
+    ) -> Dict:
+        raw = {k.decode(): v.decode() for k, v in raw.items()}
+        state = int(raw.get('state', cls.State.CLOSED))
+        opened_at = float(raw.get('opened_at', 0))
+        if state == cls.State.OPEN and now - opened_at >= cls.COOLDOWN:
+            state = cls.State.HALF_OPEN
+        return {
+            'url': url,
+            'state': state,
+            'errorRate': float(raw.get('error_rate', 0)),
+            'latency': float(raw.get('latency', cls.DEFAULT_LATENCY)),
+            'failures': int(raw.get('failures', 0)),
+            'openedAt': opened_at,
+            'inflight': inflight,
+        }
+
+    def snapshot(self, now: Optional[float] = None) -> Dict:
+        return self.snapshots([self.url], now)[0]
+
+    def record(
+        self,
+        ok: bool,
+        latency: Optional[float] = None,
+        now: Optional[float] = None,
+    ):
+        '''
+        Record the result of a request sent to this sandbox
+        '''
+        if now is None:
+            now = time.time()
+        opened = RECORD_SCRIPT(
+            self._client,
+            keys=[self.key, self.probe_key],
+            args=[
+                int(ok),
+                '' if latency is None else latency,
+                now,
+                self.ALPHA,
+                self.ERROR_THRESHOLD,
+                self.MIN_FAILURES,
+                self.COOLDOWN,
+                self.DEFAULT_LATENCY,
+            ],
+        )
+        if opened:
+            logger().warning(f'Sandbox circuit opened [url={self.url}]')
+
+    def try_probe(self) -> bool:
+        '''
+        Only one request can pass through a half-open circuit
+        '''
+        return bool(
+            self._client.set(self.probe_key, 1, nx=True, ex=self.COOLDOWN))
+
+    def dispatch(self, submission_id, now: Optional[float] = None):
+        if now is None:
+            now = time.time()
+        submission_id = str(submission_id)
+        pipe = self._client.pipeline()
+        pipe.zadd(self.inflight_key, {submission_id: now})
+        # Drop submissions whose token has already expired
+        pipe.zremrangebyscore(self.inflight_key, '-inf', now - TOKEN_EX)
+        pipe.set(self.dispatch_key(submission_id), self.url, ex=TOKEN_EX)
+        pipe.execute()
+
+    def release(self, submission_id):
+        submission_id = str(submission_id)
+        pipe = self._client.pipeline()
+        pipe.zrem(self.inflight_key, submission_id)
+        pipe.delete(self.dispatch_key(submission_id))
+        pipe.execute()
+
+    @classmethod
+    def score(cls, health: Dict) -> float:
+        '''
+        Weighted least-outstanding-requests, lower is better
+        '''
+        return (health['inflight'] + 1) * health['latency'] * \
+            (1 + health['errorRate'])
+
+    @classmethod
+    def route(
+        cls,
+        sandboxes: Iterable[engine.Sandbox],
+        now: Optional[float] = None,
+    ) -> List[engine.Sandbox]:
+        '''
+        Return sandboxes in the order they should be tried, sandboxes
+        with open circuit are excluded
+        '''
+        sandboxes = {sb.url: sb for sb in sandboxes}
+        healths = cls.snapshots(sandboxes.keys(), now)
+        closed = sorted(
+            (h for h in healths if h['state'] == cls.State.CLOSED),
+            key=cls.score,
+        )
+        # Let a probe go first, so a recovered sandbox can rejoin
+        probes = [
+            h for h in healths
+            if h['state'] == cls.State.HALF_OPEN and cls(h['url']).try_probe()
+        ]
+        return [sandboxes[h['url']] for h in (*probes, *closed)]
+
+    @classmethod
+    def on_submission_completed(cls, submission, **ks):
+        pipe = get_redis_client().pipeline()
+        pipe.get(cls.dispatch_key(submission.id))
+        pipe.delete(cls.dispatch_key(submission.id))
+        url, _ = pipe.execute()
+        if url is not None:
+            cls(url.decode()).release(submission.id)
+
+
 # TODO: Inherit MongoBase
 class Sandbox(ISandbox):
-    def get_loading(self, sandbox: engine.Sandbox) -> float:
-        resp = rq.get(f'{sandbox.url}/status')
-        if not resp.ok:
-            return 1
-        return resp.json()['load']
-
     @doc_required('submission', Submission)
     def send(self, submission: Submission) -> bool:
-        try:
-            target = min(engine.Sandbox.objects, key=self.get_loading)
-        # engine.Sandbox.objects is empty
-        except ValueError:
+        targets = SandboxHealth.route(engine.Sandbox.objects)
+        # No sandbox or all of them are unavailable
+        if len(targets) == 0:
+            raise SandboxNotFound
+        return self.send_to(targets, submission)
+
+    def send_to(
+        self,
+        targets: List[engine.Sandbox],
+        submission: Submission,
+    ) -> bool:
+        '''
+        Try `targets` in order until one of them receives the submission
+        '''
+        submission_id = str(submission.id)
+        for target in targets:
+            token = Token(target.token).assign(submission_id)
+            if self.post(target, submission, token):
+                return True
+        return False
+
+    def send_many(self, submissions: List[Submission]) -> List[str]:
+        '''
+        Send submissions to the best sandbox with tokens assigned in one
+        call. Once it fails to receive one, the rest are sent to other
+        sandboxes one by one. Return ids of submissions which are still
+        pending.
+        '''
+        targets = SandboxHealth.route(engine.Sandbox.objects)
+        if len(targets) == 0:
             raise SandboxNotFound
-        token = Token(target.token).assign(str(submission.id))
+        target, others = targets[0], targets[1:]
+        assigned = Token(target.token).assign_many(
+            str(submission.id) for submission in submissions)
+        pending = []
+        for submission in submissions:
+            submission_id = str(submission.id)
+            if not assigned[submission_id]:
+                pending.append(submission_id)
+                continue
+            if target is not None:
+                if self.post(target, submission, target.token):
+                    continue
+                target = None
+            else:
+                # Take back the token of the failed sandbox
+                Token(targets[0].token).verify(submission_id)
+            try:
+                self.send_to(others, submission)
+            except TokenExistError as e:
+                pending.append(e.id)
+        return pending
+
+    def post(
+        self,
+        target: engine.Sandbox,
+        submission: Submission,
+        token: str,
+    ) -> bool:
+        '''
+        Send a submission with assigned `token` to `target`. Return `False`
+        if it doesn't reach the sandbox, the token is taken back then.
+        '''
+        submission_id = str(submission.id)
+        health = SandboxHealth(target.url)
+        health.dispatch(submission_id)
+        # Record it before sending, the judge result may come back
+        # before the request returns
+        submission.dispatched(target.url)
+        start = time.monotonic()
         try:
             resp = rq.post(
                 f'{target.url}/{submission.id}',
@@ -59,14 +372,32 @@ class Sandbox(ISandbox):
                     'src': submission.code,
                     'token': token,
                 },
+                timeout=REQUEST_TIMEOUT,
             )
+        except rq.exceptions.ConnectionError as e:
+            # The request didn't reach the sandbox, try next one
+            logger().error(f'Submit {submission} to {target.url}: {e}')
+            ok = False
         except rq.exceptions.RequestException as e:
-            logger().error(f'Submit {self}: {e}')
-            return False
+            # The sandbox may be judging it, sending it to another one
+            # would judge it twice. Leave it to the token expiration.
+            logger().error(f'Submit {submission} to {target.url}: {e}')
+            health.record(False, time.monotonic() - start)
+            return True
         else:
+            ok = resp.status_code < 500
             if not resp.ok:
                 logger().warning(f'Got sandbox resp: {resp.text}')
+        health.record(ok, time.monotonic() - start)
+        if ok:
             return True
+        # Take back the token
+        health.release(submission_id)
+        Token(token).verify(submission_id)
+        return False
+
+
+submission_completed.connect(SandboxHealth.on_submission_completed)
 
 
 def init():
@@ -80,8 +411,16 @@ def init():
         logger().warning('Sandbox url and token are required. Won\'t create')
         return
     args = dict(
-        url=url,
-        token=token,
-        alias=alias,
+        set__token=token,
+        set__alias=alias,
     )
-    engine.Sandbox(**drop_none(args)).save()
+    # Register it or update the existing one, it runs on every start of
+    # every worker
+    try:
+        engine.Sandbox.objects(url=url).update_one(
+            upsert=True,
+            **drop_none(args),
+        )
+    except engine.NotUniqueError:
+        # Another worker has inserted it
+        engine.Sandbox.objects(url=url).update_one(**drop_none(args))
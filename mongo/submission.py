@@ -1,4 +1,5 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta
 import base64
 from . import engine
 from .base import MongoBase
@@ -7,14 +8,45 @@ from .problem import Problem
 from .comment import Comment
 from .utils import (
     doc_required,
-    get_redis_client,
     logger,
 )
 from .token import TokenExistError
+from .rate_limit import RateLimiter
 from .event import submission_completed
 
 __all__ = ('Submission', )
 
+# Judge stages and their (start, end) timestamps
+STAGES = {
+    'queue': ('created', 'queued'),
+    'dispatch': ('queued', 'dispatched'),
+    'judge': ('dispatched', 'completed'),
+    'handle': ('completed', 'handled'),
+    'total': ('queued', 'handled'),
+}
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if len(values) == 0:
+        return None
+    rank = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(rank)]
+
+
+def summarize(stages: Dict[str, List[float]]) -> Dict:
+    ret = {}
+    for stage, values in stages.items():
+        values = sorted(values)
+        ret[stage] = {
+            'count': len(values),
+            **{f'p{p}': percentile(values, p)
+               for p in (50, 95, 99)},
+        }
+    return ret
+
 
 class Submission(MongoBase, engine=engine.Submission):
     class Pending(Exception):
@@ -81,10 +113,7 @@ class Submission(MongoBase, engine=engine.Submission):
         '''
         prepara data for submit code to sandbox and then send it
         '''
-        # nonexistent id
-        if not self:
-            raise engine.DoesNotExist(f'{self}')
-        self.update(status=self.engine.Status.PENDING)
+        self.queue()
         # send submission to snadbox for judgement
         from .sandbox import ISandbox
         try:
@@ -92,37 +121,149 @@ class Submission(MongoBase, engine=engine.Submission):
         except TokenExistError as e:
             raise self.Pending(e.id)
 
+    @classmethod
+    def submit_many(cls, submissions: List['Submission']):
+        '''
+        Send many submissions to sandbox, their tokens are assigned in one
+        call. Raise `Pending` if any of them is still pending, after the
+        others are sent.
+        '''
+        for submission in submissions:
+            submission.queue()
+        from .sandbox import ISandbox
+        pending = ISandbox.cls().send_many(submissions)
+        if len(pending) != 0:
+            raise cls.Pending(pending[0])
+
+    def queue(self):
+        '''
+        Start a new judge attempt
+        '''
+        # nonexistent id
+        if not self:
+            raise engine.DoesNotExist(f'{self}')
+        now = datetime.now()
+        # Rejudge starts a new attempt, it doesn't wait since creation
+        first = self.trace is None and self.result is None
+        self.update(
+            status=self.engine.Status.PENDING,
+            trace=self.engine.Trace(
+                created=self.timestamp if first else now,
+                queued=now,
+            ),
+        )
+
+    def update_state(self, state: int) -> int:
+        '''
+        Update the state of a manually graded submission and return the
+        previous one
+        '''
+        previous = self.engine.objects(pk=self.pk).modify(state=state)
+        if previous is None:
+            raise engine.DoesNotExist(f'{self}')
+        self.obj.state = state
+        return previous.state
+
     def complete(
         self,
         judge_result,
         files: List = [],
         stderr: str = '',
         stdout: str = '',
-    ):
+    ) -> bool:
         '''
-        judgement complete
+        judgement complete, return `False` if the submission has
+        already been completed (e.g. a retried callback)
         '''
-        with get_redis_client().lock(f'{self}'):
-            result = self.engine.Result(
-                stdout=stdout,
-                stderr=stderr,
-                judge_result=judge_result,
-            )
-            self.update(
-                result=result,
-                status=self.engine.Status.COMPLETE,
-            )
-            files = [self.new_file(
-                f,
-                filename=f.filename,
-            ) for f in files]
-            self.reload('result', 'status')
-            self.result.files = files
-            self.save()
-            submission_completed.send(self.reload())
-            logger().info(f'Submission judge complete [submission={self.id}]')
+        # Skip uploading files of a duplicated result, the conditional
+        # write below still decides when they race
+        if not self.engine.objects(
+                pk=self.pk,
+                status=self.engine.Status.PENDING,
+        ).count():
+            logger().info(
+                f'Ignore duplicated judge result [submission={self.id}]')
+            return False
+        files = [self.new_file(
+            f,
+            filename=f.filename,
+        ) for f in files]
+        result = self.engine.Result(
+            stdout=stdout,
+            stderr=stderr,
+            judge_result=judge_result,
+        )
+        # Assign after construction, passing proxies to the constructor
+        # will wrap them into another `GridFSProxy`
+        result.files = files
+        # The result can only be replaced by completing a pending submission,
+        # which is serialized by the conditional write below
+        previous_result = getattr(self.result, 'judge_result', None)
+        # Only a pending submission can be completed
+        completed = self.obj.modify(
+            query={'status': self.engine.Status.PENDING},
+            result=result,
+            status=self.engine.Status.COMPLETE,
+            trace__completed=datetime.now(),
+        )
+        if not completed:
+            for f in files:
+                f.delete()
+            logger().info(
+                f'Ignore duplicated judge result [submission={self.id}]')
+            return False
+        submission_completed.send(self, previous_result=previous_result)
+        self.update(trace__handled=datetime.now())
+        logger().info(f'Submission judge complete [submission={self.id}]')
         return True
 
+    def dispatched(self, sandbox: str):
+        '''
+        Record which sandbox this submission is sent to, a completed one
+        is not changed
+        '''
+        self.engine.objects(
+            pk=self.pk,
+            status=self.engine.Status.PENDING,
+        ).update_one(
+            trace__dispatched=datetime.now(),
+            trace__sandbox=sandbox,
+        )
+
+    @classmethod
+    def latency_statistic(cls, window: timedelta) -> Dict:
+        '''
+        Return p50/p95/p99 (in seconds) of each judge stage for judge
+        attempts queued in last `window`, and those per sandbox
+        '''
+        submissions = cls.engine.objects(trace__queued__gte=datetime.now() -
+                                         window).only('trace').as_pymongo()
+        overall = {stage: [] for stage in STAGES}
+        sandboxes = {}
+        for submission in submissions:
+            trace = submission['trace']
+            durations = {
+                stage: (trace[end] - trace[start]).total_seconds()
+                for stage, (start, end) in STAGES.items()
+                if trace.get(start) is not None and trace.get(end) is not None
+            }
+            sandbox = sandboxes.setdefault(
+                trace.get('sandbox'),
+                {stage: []
+                 for stage in STAGES},
+            )
+            for stage, duration in durations.items():
+                overall[stage].append(duration)
+                sandbox[stage].append(duration)
+        return {
+            'window': window.total_seconds(),
+            'stages': summarize(overall),
+            'sandboxes': {
+                url: summarize(stages)
+                for url, stages in sandboxes.items() if url is not None
+            },
+        }
+
     def get_file(self, filename):
         if self.result is None:
             raise self.Pending(self.id)
@@ -155,15 +296,22 @@ class Submission(MongoBase, engine=engine.Submission):
         user: User,
         comment: Optional[Comment],
         code: str,
+        throttle: bool = True,
     ) -> 'Submission':
         '''
         Insert a new submission into db
 
+        Args:
+            throttle: Whether to consume the submission rate limit,
+                pass `False` if the caller has already done it
+
         Returns:
             The created submission
         '''
         if not problem.permission(user=user, req=Problem.Permission.SUBMIT):
             raise PermissionError(f'{user} cannot submit to {problem}')
+        if throttle:
+            cls.throttle(problem=problem, user=user)
         submission = cls.engine(
             problem=problem.id,
             user=user.id,
@@ -171,3 +319,18 @@ class Submission(MongoBase, engine=engine.Submission):
             code=code,
         ).save()
         return cls(submission)
+
+    @staticmethod
+    @doc_required('problem', Problem)
+    @doc_required('user', User)
+    def throttle(problem: Problem, user: User):
+        '''
+        Consume the submission budget of user and course
+
+        Raises:
+            RateLimitExceeded: User or course has submitted too many times
+        '''
+        RateLimiter('submission').consume(
+            user=user.id,
+            course=problem.course.id,
+        )
@@ -1,11 +1,24 @@
 import secrets
-from .utils import get_redis_client
+from typing import Dict, Iterable
+from .utils import get_redis_client, RedisScript
 
 __all__ = (
     'TokenExistError',
     'Token',
 )
 
+# Token lifetime (seconds) of a pending submission
+TOKEN_EX = 600
+# Delete the key only if it holds the given token, so that
+# verification is done in a single round trip and a token
+# can never be consumed twice
+VERIFY_SCRIPT = RedisScript('''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+''')
+
 
 class TokenExistError(Exception):
     def __init__(self, _id: str) -> None:
@@ -30,19 +43,28 @@ class Token:
         generate a random one
         '''
         # only accept one pending submission
-        if self._client.exists(submission_id):
+        if not self._client.set(submission_id, self.val, nx=True, ex=TOKEN_EX):
             raise TokenExistError(submission_id)
-        self._client.set(submission_id, self.val, ex=600)
         return self.val
 
+    def assign_many(self, submission_ids: Iterable[str]) -> Dict[str, bool]:
+        '''
+        assign this token to many submissions in one pipelined call,
+        return a dict which maps each submission id to whether the
+        token was assigned (`False` means it still has a pending one)
+        '''
+        submission_ids = [*submission_ids]
+        pipe = self._client.pipeline(transaction=False)
+        for submission_id in submission_ids:
+            pipe.set(submission_id, self.val, nx=True, ex=TOKEN_EX)
+        results = pipe.execute()
+        return {
+            submission_id: bool(result)
+            for submission_id, result in zip(submission_ids, results)
+        }
+
     def verify(self, submission_id):
-        # no token found
-        if not self._client.exists(submission_id):
-            return False
-        # get submission token
-        s_token = self._client.get(submission_id).decode('ascii')
-        result = secrets.compare_digest(s_token, self.val)
-        # delete if success
-        if result is True:
-            self._client.delete(submission_id)
-        return result
+        # compare and delete atomically
+        return VERIFY_SCRIPT(self._client,
+                             keys=[submission_id],
+                             args=[self.val]) == 1
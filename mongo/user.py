@@ -1,16 +1,21 @@
 from __future__ import annotations
 from datetime import datetime, timedelta
 from typing import (
-    Container,
+    Any,
+    Dict,
     Iterable,
     List,
     Optional,
+    Tuple,
     TYPE_CHECKING,
 )
 from hmac import compare_digest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from . import engine
 from .utils import *
 from .base import *
+from .cache import EnrollmentVersion, TokenCache
 from .config import config
 import jwt
 
@@ -33,6 +38,10 @@ class User(MongoBase, engine=engine.User):
         FAIL = 1
         NO_TRY = 2
 
+    # Verified course claim of current request, which maps course ids to
+    # the user's role in them. `None` means membership has to be queried.
+    claim: Optional[Dict[str, str]] = None
+
     @classmethod
     def signup(
         cls,
@@ -65,6 +74,84 @@ class User(MongoBase, engine=engine.User):
             Course(course).add_student(user)
         return user.reload()
 
+    @classmethod
+    def batch_signup(
+        cls,
+        rows: List[Dict[str, Any]],
+        course=None,
+    ) -> Tuple[Dict[Tuple[str, str], ObjectId], List[Tuple[str, str]],
+               List[Dict[str, str]]]:
+        '''
+        Sign up many users with one insert, and add them to `course` with
+        one update on each side. Each row contains `username`, `password`,
+        `display_name`, `school` and `role`, users who already exist are
+        only added to the course.
+
+        Returns:
+            ids of users keyed by (school, username), keys of users who
+            already exist, and the rows failed to sign up with errors
+        '''
+        usernames = [*{row['username'] for row in rows}]
+        existing = cls.engine.objects(username__in=usernames).only(
+            'username',
+            'school',
+        )
+        users = {(u.get('school', ''), u['username']): u['_id']
+                 for u in existing.as_pymongo()}
+        exists = []
+        fails = []
+        docs = []
+        for row in rows:
+            key = (row['school'], row['username'])
+            if key in users:
+                exists.append(key)
+                continue
+            try:
+                if len(row['password']) == 0:
+                    raise ValueError('password cannot be empty')
+                user_id = hash_id(row['username'], row['password'])
+                doc = cls.engine(
+                    id=ObjectId(),
+                    username=row['username'],
+                    user_id=user_id,
+                    user_id2=user_id,
+                    display_name=row['display_name'] or row['username'],
+                    school=row['school'] or '',
+                    role=row['role'],
+                    md5=cls.engine.email_hash(''),
+                )
+                doc.validate()
+            except (engine.ValidationError, ValueError) as e:
+                fails.append(cls._signup_error(row, str(e)))
+                continue
+            users[key] = doc.id
+            docs.append((row, doc))
+        if docs:
+            try:
+                cls.engine._get_collection().insert_many(
+                    [doc.to_mongo() for _, doc in docs],
+                    ordered=False,
+                )
+            except BulkWriteError as e:
+                for err in e.details['writeErrors']:
+                    row, _ = docs[err['index']]
+                    del users[(row['school'], row['username'])]
+                    fails.append(cls._signup_error(row, err['errmsg']))
+        if course is not None:
+            from .course import Course
+            Course(course).add_students(users.values())
+        return users, [*dict.fromkeys(exists)], fails
+
+    @staticmethod
+    def _signup_error(row: Dict[str, Any], err: str) -> Dict[str, str]:
+        logger().error(f'fail to sign up for {row["username"]}\n'
+                       f'error: {err}\n')
+        return {
+            'username': row['username'],
+            'school': row['school'],
+            'err': err,
+        }
+
     @classmethod
     def formated_email(cls, email: str):
         return email.lower().strip()
@@ -116,6 +203,15 @@ class User(MongoBase, engine=engine.User):
         obj = cls.engine.objects.get(email=cls.formated_email(email))
         return cls(obj)
 
+    @classmethod
+    def info_many(cls, users: Iterable) -> List[Dict[str, Any]]:
+        '''
+        Get info of many users (ids, documents or `User`s) from cache,
+        the order is kept and non-existent users are skipped
+        '''
+        from .cache import UserInfoCache
+        return UserInfoCache().get_many(getattr(u, 'id', u) for u in users)
+
     @property
     def cookie(
         self,
@@ -147,7 +243,40 @@ class User(MongoBase, engine=engine.User):
             ]
         if any(key not in WHITELIST for key in keys):
             raise ValueError('Unallowed key found')
-        return self.jwt(*keys)
+        return self.jwt(*keys, course_claim=True)
+
+    def course_claim(self, version: Optional[int] = None) -> Dict[str, Any]:
+        '''
+        Roles of the user in courses it teaches or is enrolled in, with
+        the enrollment version they are read at
+        '''
+        # Read version first, a change during the queries makes this claim
+        # stale instead of wrong
+        if version is None:
+            version = EnrollmentVersion().current(self.pk)
+        teaching = engine.Course.objects(teacher=self.pk).only('id')
+        courses = {str(c['_id']): 'teacher' for c in teaching.as_pymongo()}
+        enrollments = engine.Enrollment.objects(user=self.pk).only('course')
+        for e in enrollments.as_pymongo():
+            courses.setdefault(str(e['course']), 'student')
+        return {
+            'version': version,
+            'courses': courses,
+        }
+
+    @staticmethod
+    def verify_claim(data: Dict[str, Any]) -> Optional[Dict[str, str]]:
+        '''
+        Get courses from the course claim of JWT payload `data`, `None` if
+        it's missing or signed with an outdated enrollment version
+        '''
+        claim = data.get('courseClaim')
+        if not isinstance(claim, dict):
+            return None
+        version = EnrollmentVersion().get(data.get('_id'))
+        if version is None or claim.get('version') != version:
+            return None
+        return claim.get('courses')
 
     @property
     def secret(self):
@@ -205,11 +334,40 @@ class User(MongoBase, engine=engine.User):
     def __le__(self, value):
         return not self > value
 
-    def jwt(self, *keys, secret=False, **kwargs):
+    def jwt(self, *keys, secret=False, course_claim=False, **kwargs):
+        '''
+        Sign `keys` of user document into a JWT. Tokens are reused until the
+        claims change, except secret (login) ones and those with relations
+        not stored in user document.
+        '''
         if not self:
             return ''
-        user = self.reload().to_mongo()
+        relations = {*keys} & {'problems', 'comments', 'likes', 'notifs'}
+        cache = TokenCache()
+        digest = None
+        version = None
+        if course_claim:
+            version = EnrollmentVersion().current(self.pk)
+        # Login tokens are credentials, never keep them in redis
+        if not relations and not secret:
+            digest = cache.digest(sorted(keys), version, kwargs)
+            token = cache.get(self.pk, digest)
+            if token is not None:
+                return token
+            # Read before loading claims, an invalidation during signing
+            # stops the stale token from being cached
+            generation = cache.generation(self.pk)
+        projection = {k: 1 for k in keys if k not in relations}
+        user = self.engine._get_collection().find_one(
+            {'_id': self.pk},
+            projection,
+        ) or {}
         data = {k: user.get(k) for k in keys}
+        # Relations not stored in user document
+        for k in relations:
+            data[k] = [d.pk for d in getattr(self.obj, k).only('pk')]
+        if course_claim:
+            data['courseClaim'] = self.course_claim(version)
         data.update(kwargs)
         payload = {
             'iss': JWT_ISS,
@@ -217,12 +375,15 @@ class User(MongoBase, engine=engine.User):
             'secret': secret,
             'data': data
         }
-        return jwt.encode(
+        token = jwt.encode(
             payload,
             JWT_SECRET,
             algorithm='HS256',
             json_encoder=ObjectIdEncoder,
         )
+        if digest is not None:
+            cache.set(self.pk, digest, token, generation)
+        return token
 
     def change_password(self, password):
         user_id = hash_id(self.username, password)
@@ -236,100 +397,18 @@ class User(MongoBase, engine=engine.User):
             self.update(inc__success=1)
 
     def liked_amount(self):
-        return sum(len(c.liked) for c in self.comments)
+        return self.comments.sum('like_count')
 
     def statistic(
         self,
-        courses: Optional[Container[engine.Course]] = None,
+        courses: Optional[Iterable[engine.Course]] = None,
         full: bool = False,
     ):
         '''
         return user's statistic data in courses
         '''
-        def include(course):
-            return True if courses is None else course in courses
-
-        def include_problem(problem):
-            return problem.online and include(problem.course)
-
-        def include_comment(comment):
-            return all((
-                comment.is_comment,
-                comment.show,
-                not comment.problem.is_OJ,
-                include(comment.problem.course),
-            ))
-
-        def include_reply(reply):
-            return not reply.is_comment and reply.show and include(
-                reply.problem.course)
-
-        ret = {}
-        # all problems
-        ret['problems'] = [{
-            'course': {
-                'name': p.course.name,
-                'id': p.course.id
-            },
-            'pid': p.pid,
-            'referenceCount': p.reference_count,
-        } for p in filter(include_problem, self.problems)]
-        # liked comments
-        ret['likes'] = [{
-            'id': c.id,
-            'course': {
-                'name': c.problem.course.name,
-                'id': c.problem.course.id
-            },
-            'pid': c.problem.pid,
-            'floor': c.floor,
-            'staree': c.author.info,
-        } for c in filter(include_comment, self.likes)]
-        # comments
-        ret['comments'] = [{
-            'id': c.id,
-            'course': {
-                'name': c.problem.course.name,
-                'id': c.problem.course.id
-            },
-            'pid': c.problem.pid,
-            'floor': c.floor,
-            'acceptance': c.acceptance,
-        } for c in filter(include_comment, self.comments)]
-        ret['replies'] = [{
-            'id': c.id,
-            'course': {
-                'name': c.problem.course.name,
-                'id': c.problem.course.id
-            },
-            'pid': c.problem.pid,
-            'floor': c.floor,
-        } for c in filter(include_reply, self.comments)]
-        # comments be liked
-        ret['liked'] = [{
-            'id': c.id,
-            'course': {
-                'name': c.problem.course.name,
-                'id': c.problem.course.id
-            },
-            'pid': c.problem.pid,
-            'floor': c.floor,
-            'starers': [u.info for u in c.liked],
-        } for c in filter(include_comment, self.comments)
-                        if full or len(c.liked)]
-        # success & fail
-        ret['execInfo'] = [{
-            'id': c.id,
-            'course': {
-                'name': c.problem.course.name,
-                'id': c.problem.course.id
-            },
-            'pid': c.problem.pid,
-            'floor': c.floor,
-            'success': c.success,
-            'fail': c.fail,
-        } for c in filter(include_comment, self.comments)]
-        return ret
+        from .user_stats import UserStats
+        return UserStats.statistic(self, courses=courses, full=full)
 
     def oj_statistic(self, problems: List['Problem']):
         '''
@@ -0,0 +1,541 @@
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from bson import ObjectId
+from . import engine
+from .base import MongoBase
+from .user import User
+from .event import (
+    comment_created,
+    comment_deleted,
+    comment_liked,
+    comment_result_updated,
+    comment_unliked,
+    problem_created,
+    reply_created,
+)
+from .utils import logger
+
+__all__ = ('UserStats', )
+
+# Keys of statistic, in the order of the csv columns
+STAT_KEYS = (
+    'problems',
+    'likes',
+    'comments',
+    'replies',
+    'liked',
+    'execInfo',
+)
+
+
+def to_id(doc) -> Any:
+    '''
+    Get id from a document, a `MongoBase`, a reference or an id
+    '''
+    return getattr(doc, 'id', doc)
+
+
+def raw(doc, field: str) -> Any:
+    '''
+    Read the raw value of a reference field without dereferencing it
+    '''
+    return to_id(doc.to_mongo().get(field))
+
+
+class UserStats(MongoBase, engine=engine.UserStats):
+    '''
+    Statistic of a user in a course, which is updated incrementally by
+    events. A document is built from scratch when it's read for the first
+    time, so events only update existing documents.
+    '''
+    __initialized = False
+    # Times a rebuild loads again when events keep coming
+    REBUILD_ATTEMPTS = 3
+
+    def __new__(cls, *args, **kwargs):
+        cls.register_event_listener()
+        return super().__new__(cls, *args, **kwargs)
+
+    @classmethod
+    def register_event_listener(cls):
+        if cls.__initialized:
+            return
+        cls.__initialized = True
+        comment_created.connect(cls.on_comment_created)
+        comment_deleted.connect(cls.on_comment_deleted)
+        comment_result_updated.connect(cls.on_comment_result_updated)
+        reply_created.connect(cls.on_reply_created)
+        comment_liked.connect(cls.on_liked)
+        comment_unliked.connect(cls.on_unliked)
+        problem_created.connect(cls.on_problem_created)
+        logger().debug(f'Event listener registered [class={cls.__name__}]')
+
+    @classmethod
+    def of(cls, user, course):
+        return cls.engine.objects(user=to_id(user), course=to_id(course))
+
+    @classmethod
+    def is_recorded(cls, comment) -> bool:
+        '''
+        Whether a comment is recorded in `comments`, `likes` and `stars`
+        '''
+        return comment.is_comment and not comment.problem.is_OJ
+
+    @classmethod
+    def on_comment_created(cls, comment, **ks):
+        if not cls.is_recorded(comment):
+            return
+        entry = cls.engine.CommentEntry(
+            id=comment.id,
+            pid=comment.problem.pid,
+            floor=comment.floor,
+            acceptance=comment.acceptance,
+            success=comment.success,
+            fail=comment.fail,
+        )
+        cls.of(
+            raw(comment, 'author'),
+            raw(comment.problem, 'course'),
+        ).update_one(push__comments=entry, inc__version=1)
+
+    @classmethod
+    def on_reply_created(cls, reply, **ks):
+        entry = cls.engine.ReplyEntry(
+            id=reply.id,
+            pid=reply.problem.pid,
+            floor=reply.floor,
+        )
+        cls.of(
+            raw(reply, 'author'),
+            raw(reply.problem, 'course'),
+        ).update_one(push__replies=entry, inc__version=1)
+
+    @classmethod
+    def on_comment_deleted(cls, comment, **ks):
+        course = raw(comment.problem, 'course')
+        cls.of(raw(comment, 'author'), course).update_one(
+            __raw__={
+                '$pull': {
+                    'comments': {
+                        'id': comment.id
+                    },
+                    'replies': {
+                        'id': comment.id
+                    },
+                    'stars': {
+                        'comment': comment.id
+                    },
+                },
+                '$inc': {
+                    'version': 1
+                },
+            })
+        cls.engine.objects(
+            course=course,
+            likes__id=comment.id,
+        ).update(__raw__={
+            '$pull': {
+                'likes': {
+                    'id': comment.id
+                }
+            },
+            '$inc': {
+                'version': 1
+            },
+        })
+
+    @classmethod
+    def on_comment_result_updated(cls, comment, **ks):
+        if not cls.is_recorded(comment):
+            return
+        result = comment.engine.objects(pk=comment.pk).only(
+            'success',
+            'fail',
+            'acceptance',
+        ).get()
+        cls.of(
+            raw(comment, 'author'),
+            raw(comment.problem, 'course'),
+        ).filter(comments__id=comment.id).update_one(
+            set__comments__S__success=result.success,
+            set__comments__S__fail=result.fail,
+            set__comments__S__acceptance=result.acceptance,
+            inc__version=1,
+        )
+
+    @classmethod
+    def on_liked(cls, comment, user, **ks):
+        if not cls.is_recorded(comment):
+            return
+        course = raw(comment.problem, 'course')
+        entry = cls.engine.LikeEntry(
+            id=comment.id,
+            pid=comment.problem.pid,
+            floor=comment.floor,
+            staree=raw(comment, 'author'),
+        )
+        # Keep likes sorted by comment like a rebuild does
+        cls.of(user, course).filter(likes__id__ne=comment.id).update_one(
+            __raw__={
+                '$push': {
+                    'likes': {
+                        '$each': [entry.to_mongo()],
+                        '$sort': {
+                            'id': 1
+                        },
+                    }
+                },
+                '$inc': {
+                    'version': 1
+                },
+            })
+        star = cls.engine.StarEntry(comment=comment.id, user=user.id)
+        cls.of(raw(comment, 'author'), course).update_one(
+            add_to_set__stars=star,
+            inc__version=1,
+        )
+
+    @classmethod
+    def on_unliked(cls, comment, user, **ks):
+        course = raw(comment.problem, 'course')
+        cls.of(user, course).update_one(__raw__={
+            '$pull': {
+                'likes': {
+                    'id': comment.id
+                }
+            },
+            '$inc': {
+                'version': 1
+            },
+        })
+        cls.of(raw(comment, 'author'), course).update_one(
+            __raw__={
+                '$pull': {
+                    'stars': {
+                        'comment': comment.id,
+                        'user': user.id,
+                    }
+                },
+                '$inc': {
+                    'version': 1
+                },
+            })
+
+    @classmethod
+    def on_problem_created(cls, problem, **ks):
+        cls.of(
+            raw(problem, 'author'),
+            raw(problem, 'course'),
+        ).update_one(add_to_set__problems=problem.pid, inc__version=1)
+
+    @classmethod
+    def rebuild(cls, user, course) -> engine.UserStats:
+        '''
+        Build the statistic of `user` in `course` from scratch. It's written
+        only if no event updates the document while it's loading, or it's
+        loaded again.
+        '''
+        user, course = to_id(user), to_id(course)
+        for _ in range(cls.REBUILD_ATTEMPTS):
+            # Insert a placeholder if missing, so that events coming during
+            # loading bump its version
+            version = cls.of(user, course).modify(
+                upsert=True,
+                new=True,
+                set_on_insert__stale=True,
+                set_on_insert__version=0,
+            ).version
+            stats = cls.load_from_scratch(user, course)
+            # Documents built before versioning don't have it
+            versions = [version, None] if version == 0 else [version]
+            doc = cls.of(user, course).filter(version__in=versions).modify(
+                new=True,
+                unset__stale=True,
+                inc__version=1,
+                **{f'set__{k}': v
+                   for k, v in stats.items()},
+            )
+            if doc is not None:
+                logger().info(
+                    f'Rebuild user stats [user={user}, course={course}]')
+                return doc
+        # Keep the placeholder stale, so next read builds it again
+        logger().warning(f'Rebuild user stats conflicted [user={user}, '
+                         f'course={course}]')
+        return cls.of(user, course).get()
+
+    @classmethod
+    def load_from_scratch(cls, user, course) -> Dict[str, List]:
+        '''
+        Load fields of the statistic of `user` in `course` from documents
+        '''
+        problems = engine.Problem.objects(course=course).only(
+            'author',
+            'extra',
+        ).as_pymongo()
+        problems = {p['_id']: p for p in problems}
+        normal = [
+            pid for pid, p in problems.items()
+            if p.get('extra', {}).get('_cls') != 'OJProblem'
+        ]
+        comments = engine.Comment.objects(
+            author=user,
+            problem__in=[*problems],
+            status=engine.Comment.Status.SHOW,
+        ).order_by('created').only(
+            'problem',
+            'floor',
+            'depth',
+            'acceptance',
+            'success',
+            'fail',
+            'liked',
+        ).as_pymongo()
+        entries, replies, stars = [], [], []
+        for c in comments:
+            if c['depth'] != 0:
+                replies.append(
+                    cls.engine.ReplyEntry(
+                        id=c['_id'],
+                        pid=c['problem'],
+                        floor=c['floor'],
+                    ))
+                continue
+            if c['problem'] not in normal:
+                continue
+            entries.append(
+                cls.engine.CommentEntry(
+                    id=c['_id'],
+                    pid=c['problem'],
+                    floor=c['floor'],
+                    acceptance=c.get('acceptance'),
+                    success=c.get('success', 0),
+                    fail=c.get('fail', 0),
+                ))
+            stars.extend(
+                cls.engine.StarEntry(comment=c['_id'], user=u)
+                for u in c.get('liked', []))
+        likes = engine.Comment.objects(
+            liked=user,
+            depth=0,
+            status=engine.Comment.Status.SHOW,
+            problem__in=normal,
+        ).order_by('id').only(
+            'problem',
+            'floor',
+            'author',
+        ).as_pymongo()
+        likes = [
+            cls.engine.LikeEntry(
+                id=c['_id'],
+                pid=c['problem'],
+                floor=c['floor'],
+                staree=c['author'],
+            ) for c in likes
+        ]
+        own_problems = sorted(pid for pid, p in problems.items()
+                              if p['author'] == user)
+        return {
+            'problems': own_problems,
+            'comments': entries,
+            'replies': replies,
+            'likes': likes,
+            'stars': stars,
+        }
+
+    @classmethod
+    def rebuild_all(cls):
+        '''
+        Rebuild statistic of every member in every course
+        '''
+        for course in engine.Course.objects.as_pymongo():
+            members = {course['teacher'], *course.get('students', [])}
+            for user in members:
+                cls.rebuild(user, course['_id'])
+
+    @classmethod
+    def load(cls, pairs: Iterable[Tuple[ObjectId, ObjectId]]):
+        '''
+        Load stats of (user, course) pairs in one query, build the missing
+        ones
+        '''
+        # Deduplicate but keep the order
+        pairs = [*dict.fromkeys((to_id(u), to_id(c)) for u, c in pairs)]
+        if len(pairs) == 0:
+            return []
+        users = {u for u, _ in pairs}
+        courses = {c for _, c in pairs}
+        docs = cls.engine.objects(
+            user__in=[*users],
+            course__in=[*courses],
+        ).no_dereference()
+        docs = {(to_id(d.user), to_id(d.course)): d
+                for d in docs if not d.stale}
+        for pair in pairs:
+            if pair not in docs:
+                docs[pair] = cls.rebuild(*pair)
+        return [docs[pair] for pair in pairs]
+
+    @classmethod
+    def render(
+        cls,
+        docs: List[engine.UserStats],
+        full: bool = False,
+    ) -> Dict[ObjectId, Dict[str, List]]:
+        '''
+        Serialize stats and group them by user, related documents are
+        fetched in batch
+        '''
+        courses = {to_id(d.course) for d in docs}
+        courses = {
+            c['_id']: {
+                'name': c['name'],
+                'id': c['_id'],
+            }
+            for c in engine.Course.objects(
+                pk__in=[*courses]).only('name').as_pymongo()
+        }
+        problems = {pid for d in docs for pid in d.problems}
+        problems = {
+            p['_id']: p
+            for p in engine.Problem.objects(pk__in=[*problems]).only(
+                'hidden',
+                'reference_count',
+            ).as_pymongo()
+        }
+        users = {
+            *(s.user for d in docs for s in d.stars),
+            *(like.staree for d in docs for like in d.likes),
+        }
+        users = {info['id']: info for info in User.info_many(users)}
+        ret = {}
+        for d in docs:
+            stat = ret.setdefault(to_id(d.user), {k: [] for k in STAT_KEYS})
+            course = courses.get(to_id(d.course))
+            for pid in d.problems:
+                # visibility and reference count change often, read them
+                # from problems
+                problem = problems.get(pid)
+                if problem is None or problem.get('hidden'):
+                    continue
+                stat['problems'].append({
+                    'course':
+                    course,
+                    'pid':
+                    pid,
+                    'referenceCount':
+                    problem.get('reference_count', 0),
+                })
+            stat['likes'].extend({
+                'id': like.id,
+                'course': course,
+                'pid': like.pid,
+                'floor': like.floor,
+                'staree': users.get(like.staree),
+            } for like in d.likes)
+            stat['comments'].extend({
+                'id': c.id,
+                'course': course,
+                'pid': c.pid,
+                'floor': c.floor,
+                'acceptance': c.acceptance,
+            } for c in d.comments)
+            stat['replies'].extend({
+                'id': r.id,
+                'course': course,
+                'pid': r.pid,
+                'floor': r.floor,
+            } for r in d.replies)
+            stars = {}
+            for s in d.stars:
+                stars.setdefault(s.comment, []).append(s.user)
+            stat['liked'].extend({
+                'id':
+                c.id,
+                'course':
+                course,
+                'pid':
+                c.pid,
+                'floor':
+                c.floor,
+                'starers':
+                [users[u] for u in stars.get(c.id, []) if u in users],
+            } for c in d.comments if full or c.id in stars)
+            stat['execInfo'].extend({
+                'id': c.id,
+                'course': course,
+                'pid': c.pid,
+                'floor': c.floor,
+                'success': c.success,
+                'fail': c.fail,
+            } for c in d.comments)
+        return ret
+
+    @classmethod
+    def courses_of(cls, user: User) -> List[ObjectId]:
+        '''
+        Courses the user joined, followed by other courses where the user
+        has problems, comments or likes
+        '''
+        joined = user.to_mongo().get('courses', [])
+        user = user.id
+        problems = engine.Comment._get_collection().distinct(
+            'problem',
+            {'$or': [{
+                'author': user
+            }, {
+                'liked': user
+            }]},
+        )
+        others = engine.Problem._get_collection().distinct(
+            'course',
+            {'$or': [{
+                'author': user
+            }, {
+                '_id': {
+                    '$in': problems
+                }
+            }]},
+        )
+        return [*joined, *sorted({*others} - {*joined})]
+
+    @classmethod
+    def statistic(
+        cls,
+        user: User,
+        courses: Optional[Iterable] = None,
+        full: bool = False,
+    ) -> Dict[str, List]:
+        '''
+        Statistic of a user in `courses` in their order, default to all
+        courses the user joined or has any activity in
+        '''
+        if courses is None:
+            courses = cls.courses_of(user)
+        docs = cls.load((user.id, c) for c in courses)
+        empty = {k: [] for k in STAT_KEYS}
+        return cls.render(docs, full=full).get(user.id, empty)
+
+    @classmethod
+    def course_statistic(
+        cls,
+        course,
+        users: Iterable,
+        full: bool = False,
+    ) -> List[Dict[str, List]]:
+        '''
+        Statistic of many users in a course, in the order of `users`
+        '''
+        users = [*map(to_id, users)]
+        docs = cls.load((u, course) for u in users)
+        stats = cls.render(docs, full=full)
+        return [stats.get(u, {k: [] for k in STAT_KEYS}) for u in users]
+
+
+UserStats.register_event_listener()
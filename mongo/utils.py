@@ -1,11 +1,14 @@
 import hashlib
 import json
+import queue
+import threading
 from functools import wraps
 from typing import (
     Any,
     Callable,
     Optional,
     Dict,
+    List,
 )
 from bson import ObjectId
 import redis
@@ -19,8 +22,11 @@ __all__ = [
     'to_bool',
     'ObjectIdEncoder',
     'get_redis_client',
+    'get_redis_url',
+    'RedisScript',
     'logger',
     'drop_none',
+    'run_in_background',
 ]
 
 
@@ -157,5 +163,66 @@ def get_redis_client():
         return redis.Redis(connection_pool=redis_pool)
 
 
+class RedisScript:
+    '''
+    A lua script registered once and run by any redis client, it's loaded
+    into the server when the server doesn't have it
+    '''
+    def __init__(self, script: str):
+        self.script = script
+        self._registered = None
+
+    def __call__(self, client, keys: List = [], args: List = []):
+        if self._registered is None:
+            self._registered = client.register_script(self.script)
+        return self._registered(keys=keys, args=args, client=client)
+
+
+def get_redis_url() -> Optional[str]:
+    '''
+    URL of the redis server, `None` in testing environment because there is
+    only a fake server in the process
+    '''
+    if config['TESTING'] == True:
+        return None
+    return f'redis://{config["REDIS"]["HOST"]}:{config["REDIS"]["PORT"]}/0'
+
+
 def drop_none(d: Dict):
     return {k: v for k, v in d.items() if v is not None}
+
+
+# Tasks run by the background worker in order
+background_tasks = queue.Queue()
+background_worker = None
+background_worker_lock = threading.Lock()
+
+
+def background_loop():
+    while True:
+        func, args, ks = background_tasks.get()
+        try:
+            func(*args, **ks)
+        except Exception as e:
+            logger().error(f'Background task failed [func={func}]: {e!r}')
+
+
+def run_in_background(func: Callable[..., Any], *args, **ks):
+    '''
+    Queue `func` to the background worker of this process, so the caller
+    does not need to wait for side effects. Tasks are run one by one in
+    the order they are queued. In testing environment it is called
+    synchronously to keep tests deterministic.
+    '''
+    if config['TESTING'] == True:
+        func(*args, **ks)
+        return
+    global background_worker
+    with background_worker_lock:
+        if background_worker is None or not background_worker.is_alive():
+            background_worker = threading.Thread(
+                target=background_loop,
+                daemon=True,
+            )
+            background_worker.start()
+    background_tasks.put((func, args, ks))
@@ -13,6 +13,7 @@ from typing import (
 import pytest
 from tests import utils
 from mongo import *
+from mongo import engine
 from flask.testing import FlaskClient
 import jwt
 
@@ -292,6 +293,43 @@ def test_token_refresh(client: FlaskClient):
     # TODO: check cookie value
 
 
+def test_cached_session_is_invalidated(client: FlaskClient):
+    u = utils.user.lazy_signup()
+    token = u.secret
+    client.set_cookie('test.test', 'piann', token)
+    rv = client.get('/user')
+    assert rv.status_code == 200
+    assert SessionCache().get(token)['id'] == str(u.id)
+    # Changing password expires the token even if the session is cached
+    u.change_password('an0ther_passw0rd')
+    assert SessionCache().get(token) is None
+    rv = client.get('/user')
+    assert rv.status_code == 302
+    # So does deactivating
+    token = u.secret
+    client.set_cookie('test.test', 'piann', token)
+    assert client.get('/user').status_code == 200
+    u.update(active=False)
+    assert client.get('/user').status_code == 302
+    # Logout drops the session
+    u.update(active=True)
+    assert client.get('/user').status_code == 200
+    client.get('/auth/session')
+    assert SessionCache().get(token) is None
+
+
+def test_session_loaded_before_invalidation_is_not_cached():
+    u = utils.user.lazy_signup()
+    token = u.secret
+    cache = SessionCache()
+    generation = cache.generation(u.id)
+    loaded = User(u.id)
+    # Password is changed while the request is loading user
+    u.change_password('an0ther_passw0rd')
+    cache.set(token, loaded, generation)
+    assert cache.get(token) is None
+
+
 def test_update_email(forge_client: Callable[[str, Optional[str]],
                                              FlaskClient]):
     password = 'password'
@@ -483,3 +521,24 @@ class TestBatchSignup:
         rv_json = rv.get_json()
         assert rv.status_code == 200, rv_json
         assert User.get_by_username(u_data['username'])
+
+
+def test_stale_course_claim_is_refreshed(client: FlaskClient):
+    c = utils.course.lazy_add(status=engine.Course.Status.PRIVATE)
+    u = utils.user.lazy_signup()
+    client.set_cookie('test.test', 'piann', u.secret)
+    client.set_cookie('test.test', 'jwt', u.cookie)
+    rv = client.get(f'/course/{c.id}/permission')
+    assert rv.get_json()['data'] == 0
+    # Up-to-date claim is not signed again
+    assert 'jwt=' not in rv.headers.get('Set-Cookie', '')
+    c.add_student(u)
+    rv = client.get(f'/course/{c.id}/permission')
+    assert rv.get_json()['data'] == (Course.Permission.READ
+                                     | Course.Permission.PARTICIPATE).value
+    cookie = next(h for h in rv.headers.getlist('Set-Cookie')
+                  if h.startswith('jwt='))
+    token = cookie.split(';')[0][len('jwt='):]
+    assert User.verify_claim(jwt_decode(token)['data']) == {
+        str(c.id): 'student'
+    }
@@ -1,8 +1,10 @@
+import json
 from datetime import timedelta, datetime
 from typing import Callable, Optional
 import pytest
 import mongomock.gridfs
 from flask.testing import FlaskClient
+from bson import ObjectId
 from mongo import *
 from mongo import requirement
 from mongo import engine
@@ -25,6 +27,7 @@ class TestCourse(BaseTester):
         assert rv.status_code == 200
         cid = Course.get_by_name('course_108-1').pk
         users = [str(User.get_by_username('student1').pk)]
+        assert Course(cid).is_enrolled(ObjectId(users[0]))
         rv = client.patch(
             f'/course/{cid}/student/remove',
             json={
@@ -32,6 +35,7 @@ class TestCourse(BaseTester):
             },
         )
         assert rv.status_code == 200
+        assert not Course(cid).is_enrolled(ObjectId(users[0]))
         rv = client.get('/problem/2')
         assert rv.status_code == 404
 
@@ -216,6 +220,71 @@ class TestCourseStatistic:
         for key in keys:
             assert statistic[0][key] == []
 
+    def test_stream_statistic_file(
+        self,
+        forge_client: Callable[[str, Optional[str]], FlaskClient],
+    ):
+        c = utils.course.lazy_add()
+        student = utils.user.lazy_signup(username='student')
+        c.add_student(student)
+        task = utils.task.lazy_add(course=c)
+        client = forge_client(c.teacher.username)
+        rv = client.get(
+            f'/course/{c.id}/statistic-file',
+            query_string={
+                'format': 'ndjson',
+                'columns': 'oj,task',
+            },
+        )
+        assert rv.status_code == 200
+        assert rv.is_streamed
+        rows = [json.loads(line) for line in rv.data.decode().splitlines()]
+        assert len(rows) == 1
+        assert rows[0]['username'] == 'student'
+        assert rows[0]['ojAcCount'] == 0
+        assert rows[0][f'task:{task.id}'] == '0/0'
+
+    @pytest.mark.parametrize(
+        'query',
+        (
+            {
+                'format': 'xlsx'
+            },
+            {
+                'columns': 'password'
+            },
+        ),
+    )
+    def test_statistic_file_with_invalid_args(
+        self,
+        forge_client: Callable[[str, Optional[str]], FlaskClient],
+        query,
+    ):
+        c = utils.course.lazy_add()
+        client = forge_client(c.teacher.username)
+        rv = client.get(f'/course/{c.id}/statistic-file', query_string=query)
+        assert rv.status_code == 400, rv.get_json()
+
+    def test_get_grade_matrix(
+        self,
+        forge_client: Callable[[str, Optional[str]], FlaskClient],
+    ):
+        c = utils.course.lazy_add()
+        student = utils.user.lazy_signup(username='student')
+        c.add_student(student)
+        p = utils.problem.lazy_add(course=c, author=c.teacher, is_oj=True)
+        client = forge_client(c.teacher.username)
+        rv = client.get(f'/course/{c.id}/grade-matrix')
+        rv_json = rv.get_json()
+        assert rv.status_code == 200, rv_json
+        data = rv_json['data']
+        assert data['problems'] == [p.pid]
+        assert data['tries'] == [[0]]
+        # Students can't read it
+        client = forge_client(student.username)
+        rv = client.get(f'/course/{c.id}/grade-matrix')
+        assert rv.status_code == 403
+
     @pytest.mark.parametrize('pids', ('', None, 'no-a-number'))
     def test_oj_statistic_missing_pid(
         self,
@@ -0,0 +1,166 @@
+from flask.testing import FlaskClient
+from mongo import *
+from model import Notifier
+from tests import utils
+
+
+def test_notif_inbox_pagination(forge_client):
+    p = utils.problem.lazy_add()
+    u = utils.user.lazy_signup()
+    infos = [Notif.types.NewComment(problem=p.pk) for _ in range(5)]
+    notifs = Notif.new_many((info, u) for info in infos)
+    notifs[0].hide()
+    client: FlaskClient = forge_client(u.username)
+    rv = client.get('/notif?limit=3')
+    assert rv.status_code == 200, rv.get_json()
+    data = rv.get_json()['data']
+    assert data['unread'] == 4
+    assert [n['id']
+            for n in data['notifs']] == [str(n.id) for n in notifs[:0:-1][:3]]
+    assert data['notifs'][0] == {
+        'id': str(notifs[-1].id),
+        'status': 0,
+        'type': 'NEW_COMMENT',
+        'problem_id': p.pk,
+    }
+    rv = client.get(f'/notif?limit=3&cursor={data["next"]}')
+    data = rv.get_json()['data']
+    # The hidden one is skipped
+    assert [n['id'] for n in data['notifs']] == [str(notifs[1].id)]
+    assert data['next'] is None
+    rv = client.get('/notif?cursor=invalid')
+    assert rv.status_code == 400
+
+
+def test_notif_list_without_cursor(forge_client):
+    p = utils.problem.lazy_add()
+    u = utils.user.lazy_signup()
+    infos = [Notif.types.NewComment(problem=p.pk) for _ in range(3)]
+    notifs = Notif.new_many((info, u) for info in infos)
+    notifs[0].hide()
+    client: FlaskClient = forge_client(u.username)
+    rv = client.get('/notif')
+    assert rv.status_code == 200, rv.get_json()
+    # Same as the response before pagination
+    assert rv.get_json()['data'] == [n.to_dict() for n in notifs]
+
+
+def test_read_notifs(forge_client):
+    c = utils.comment.lazy_add_comment()
+    u = utils.user.lazy_signup()
+    notifs = Notif.new_many(
+        (Notif.types.Like(comment=c.pk, liked=c.author, problem=c.problem), u)
+        for _ in range(3))
+    client: FlaskClient = forge_client(u.username)
+    rv = client.get('/notif?limit=20')
+    data = rv.get_json()['data']
+    assert data['notifs'][0]['liked']['id'] == str(c.author.id)
+    rv = client.put('/notif/read', json={'ids': [str(notifs[0].id)]})
+    assert rv.get_json()['data']['unread'] == 2
+    # Notifications of others are not affected
+    Notif.new(Notif.types.NewComment(problem=c.problem), c.author)
+    rv = client.put('/notif/read', json={})
+    assert rv.get_json()['data']['unread'] == 0
+    rv = client.get('/notif/unread-count')
+    assert rv.get_json()['data']['unread'] == 0
+    assert Notif.unread_count(c.author) == 1
+
+
+def test_notif_is_pushed_to_receiver(config_app):
+    app = config_app()
+    p = utils.problem.lazy_add()
+    u = utils.user.lazy_signup()
+    client = app.test_client()
+    client.set_cookie('test.test', 'piann', u.secret)
+    socket = Notifier.server.test_client(
+        app,
+        namespace=Notifier.namespace,
+        flask_test_client=client,
+    )
+    assert socket.is_connected(Notifier.namespace)
+    anonymous = Notifier.server.test_client(
+        app,
+        namespace=Notifier.namespace,
+    )
+    # Subscribing a user room doesn't work
+    anonymous.emit(
+        'subscribe',
+        {
+            'topic': 'user',
+            'id': str(u.id)
+        },
+        namespace=Notifier.namespace,
+    )
+    notif = Notif.new(Notif.types.NewComment(problem=p.pk), u)
+    Notif.new(Notif.types.NewComment(problem=p.pk), p.author)
+    received = socket.get_received(Notifier.namespace)
+    assert [r['name'] for r in received] == ['notif']
+    assert received[0]['args'][0] == {
+        'notif': {
+            'id': str(notif.id),
+            'status': 0,
+            'type': 'NEW_COMMENT',
+            'problem_id': p.pk,
+        },
+        'unreadDelta': 1,
+    }
+    notif.read()
+    received = socket.get_received(Notifier.namespace)
+    assert received[0]['name'] == 'unread'
+    assert received[0]['args'][0] == {'unreadDelta': -1}
+    assert anonymous.get_received(Notifier.namespace) == []
+
+
+def test_socket_with_invalid_token_is_refused(config_app):
+    app = config_app()
+    client = app.test_client()
+    client.set_cookie('test.test', 'piann', 'invalid')
+    socket = Notifier.server.test_client(
+        app,
+        namespace=Notifier.namespace,
+        flask_test_client=client,
+    )
+    assert not socket.is_connected(Notifier.namespace)
+
+
+def test_fe_update_is_emitted_to_subscribers(config_app):
+    app = config_app()
+    p = utils.problem.lazy_add()
+    course = p.course
+    client = app.test_client()
+    client.set_cookie('test.test', 'piann', User(p.author).secret)
+    socket = Notifier.server.test_client(
+        app,
+        namespace=Notifier.namespace,
+    )
+    socket.emit(
+        'subscribe',
+        {
+            'topic': 'PROBLEM',
+            'id': str(course.id)
+        },
+        namespace=Notifier.namespace,
+    )
+    rv = client.post(
+        '/problem',
+        json={
+            'title': 'new problem',
+            'description': '',
+            'tags': [],
+            'course': str(course.id),
+            'defaultCode': '',
+            'hidden': False,
+            'isTemplate': False,
+            'allowMultipleComments': True,
+        },
+    )
+    assert rv.status_code == 200, rv.get_json()
+    received = socket.get_received(Notifier.namespace)
+    assert received == [{
+        'name': 'refetch',
+        'args': [{
+            'topic': 'PROBLEM',
+            'id': str(course.id)
+        }],
+        'namespace': Notifier.namespace,
+    }]
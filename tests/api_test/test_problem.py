@@ -533,3 +533,61 @@ class TestComment(ProblemTester):
         json = rv.get_json()
         assert rv.status_code == 200
         assert json['data']['author']['username'] == 'teacher1'
+
+    def test_get_comment_thread(
+        self,
+        forge_client: Callable[[str, Optional[str]], FlaskClient],
+    ):
+        problem = utils.problem.lazy_add(allow_multiple_comments=True)
+        comments = [
+            utils.comment.lazy_add_comment(problem=problem) for _ in range(5)
+        ]
+        replies = [
+            utils.comment.lazy_add_reply(comment=comments[0])
+            for _ in range(Comment.REPLY_PREVIEW + 1)
+        ]
+        comments[1].delete()
+        user = utils.course.student(course=problem.course)
+        comments[2].like(user=user)
+        client = forge_client(user.username)
+        rv = client.get(f'/problem/{problem.pk}/comments?limit=3')
+        rv_json = rv.get_json()
+        assert rv.status_code == 200, rv_json
+        data = rv_json['data']
+        # Deleted comment is skipped
+        assert [c['floor'] for c in data['comments']] == [1, 3, 4]
+        first, liked, _ = data['comments']
+        assert first['author']['username'] == comments[0].author.username
+        assert first['replyCount'] == Comment.REPLY_PREVIEW + 1
+        # The earliest replies are previewed
+        assert [r['id'] for r in first['replies']
+                ] == [str(r.id) for r in replies[:Comment.REPLY_PREVIEW]]
+        assert first['submission']['id'] == str(comments[0].submission.id)
+        assert liked['liked'] is True and liked['likeCount'] == 1
+        # Next page
+        rv = client.get(f'/problem/{problem.pk}/comments?after={data["next"]}')
+        data = rv.get_json()['data']
+        assert [c['floor'] for c in data['comments']] == [5]
+        assert data['next'] is None
+
+    def test_get_oj_comment_thread(
+        self,
+        forge_client: Callable[[str, Optional[str]], FlaskClient],
+    ):
+        course = utils.course.lazy_add()
+        problem = utils.problem.lazy_add(course=course, is_oj=True)
+        utils.comment.lazy_add_comment(problem=problem)
+        u = utils.course.student(course=course)
+        own = utils.comment.lazy_add_comment(problem=problem, author=u)
+        # Student can only read their own OJ comments
+        client = forge_client(u.username)
+        rv = client.get(f'/problem/{problem.pk}/comments')
+        assert rv.status_code == 200
+        comments = rv.get_json()['data']['comments']
+        assert [c['id'] for c in comments] == [str(own.id)]
+        # Teacher can read all of them
+        client = forge_client(course.teacher.username)
+        rv = client.get(f'/problem/{problem.pk}/comments')
+        assert len(rv.get_json()['data']['comments']) == 2
+        rv = client.get(f'/problem/{problem.pk}/comments?limit=0')
+        assert rv.status_code == 400
@@ -1,3 +1,4 @@
+import pytest
 import secrets
 from mongo import *
 from mongo import engine
@@ -35,6 +36,26 @@ def test_sandbox_init(forge_client: Callable[[str, Optional[str]],
     config['sandbox'] = None
 
 
+def test_sandbox_init_on_every_start(config_app):
+    config_app()
+    url = 'http://test.sandbox'
+    config['sandbox'] = {
+        'url': url,
+        'token': 'TestToken',
+    }
+    try:
+        # Later deploys register sandboxes added to config
+        config_app()
+        assert engine.Sandbox.objects(url=url).get().token == 'TestToken'
+        # And update the existing ones
+        config['sandbox']['token'] = 'NewToken'
+        config_app()
+        assert engine.Sandbox.objects(url=url).get().token == 'NewToken'
+        assert engine.Sandbox.objects.count() == 1
+    finally:
+        config['sandbox'] = None
+
+
 def test_create_sandbox(forge_client: Callable[[str, Optional[str]],
                                                FlaskClient]):
     assert len(engine.Sandbox.objects) == 0
@@ -109,3 +130,56 @@ def test_cannot_update_sandbox_token(
     assert rv.status_code == 200
     sandbox = engine.Sandbox.objects(url=url).get()
     assert sandbox.token != new_token
+
+
+def test_get_latency(forge_client: Callable[[str, Optional[str]],
+                                            FlaskClient]):
+    admin = utils.user.Factory.admin()
+    client = forge_client(admin.username)
+    rv = client.get('/sandbox/latency?window=600')
+    assert rv.status_code == 200
+    data = rv.get_json()['data']
+    assert data['window'] == 600
+    assert set(data['stages']) == {
+        'queue',
+        'dispatch',
+        'judge',
+        'handle',
+        'total',
+    }
+    rv = client.get('/sandbox/latency?window=abc')
+    assert rv.status_code == 400
+
+
+def test_student_cannot_get_latency(
+        forge_client: Callable[[str, Optional[str]], FlaskClient]):
+    student = utils.user.Factory.student()
+    client = forge_client(student.username)
+    rv = client.get('/sandbox/latency')
+    assert rv.status_code == 403
+
+
+def test_get_rate_limit_metrics(forge_client: Callable[[str, Optional[str]],
+                                                       FlaskClient]):
+    admin = utils.user.Factory.admin()
+    client = forge_client(admin.username)
+    rv = client.get('/sandbox/rate-limit')
+    assert rv.status_code == 200
+    assert isinstance(rv.get_json()['data'], dict)
+
+
+def test_failed_setup_runs_again(config_app):
+    with pytest.raises(FileNotFoundError):
+        config_app(env='not-exist')
+    assert engine.AppConfig.objects(key='init').get().value == True
+    config_app()
+    assert engine.AppConfig.objects(key='init').get().value == False
+
+
+def test_setup_runs_in_one_worker(config_app):
+    config_app()
+    # Another worker is running setup
+    engine.AppConfig.objects(key='init').update_one(set__value=True)
+    engine.AppConfig.objects(key='init').modify(set__value='running')
+    config_app(env='not-exist')
+    assert engine.AppConfig.objects(key='init').get().value == 'running'
@@ -30,6 +30,29 @@ class TestToken:
         assert token is not None
         assert Token(token).verify(_id) is True
 
+    def test_assign_twice(self):
+        _id = secrets.token_hex()
+        Token().assign(_id)
+        with pytest.raises(TokenExistError):
+            Token().assign(_id)
+
+    def test_verify_only_once(self):
+        _id = secrets.token_hex()
+        token = Token().assign(_id)
+        assert Token('wrong-token').verify(_id) is False
+        assert Token(token).verify(_id) is True
+        assert Token(token).verify(_id) is False
+
+    def test_assign_many(self):
+        pending = secrets.token_hex()
+        Token().assign(pending)
+        ids = [secrets.token_hex() for _ in range(5)]
+        token = Token()
+        result = token.assign_many([pending, *ids])
+        assert result.pop(pending) is False
+        assert all(result.values())
+        assert all(Token(token.val).verify(_id) for _id in ids)
+
 
 class SubmissionTester:
     init_submission_count = 8
@@ -391,3 +414,23 @@ class TestCreateSubmission:
             json={'code': 'print("Yabe")'},
         )
         assert rv.status_code == 403
+
+    def test_submit_too_many_times(
+        self,
+        forge_client: Callable[[str, Optional[str]], FlaskClient],
+    ):
+        user = utils.user.Factory.student()
+        comment = utils.comment.lazy_add_comment(author=user)
+        # Exhaust user's budget
+        with pytest.raises(RateLimitExceeded):
+            while True:
+                RateLimiter('submission').consume(user=user.id)
+        client = forge_client(user.username)
+        rv = client.post(
+            f'/comment/{comment.id}/submission',
+            json={'code': 'print("Too fast")'},
+        )
+        assert rv.status_code == 429
+        retry_after = rv.get_json()['data']['retryAfter']
+        assert retry_after > 0
+        assert rv.headers['Retry-After'] == str(retry_after)
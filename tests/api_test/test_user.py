@@ -13,3 +13,16 @@ def test_get_all_user(forge_client: Callable[[str], FlaskClient]):
     rv_json = rv.json
     assert rv.status_code == 200, rv_json
     assert len(rv_json['data']) == count
+
+
+def test_get_cache_stats(forge_client: Callable[[str], FlaskClient]):
+    admin = utils.user.Factory.admin()
+    client = forge_client(admin.username)
+    client.get('/user')
+    rv = client.get('/user/cache/stats')
+    assert rv.status_code == 200, rv.json
+    assert {'hit', 'miss', 'hitRate'} == rv.json['data'].keys()
+    student = utils.user.Factory.student()
+    client = forge_client(student.username)
+    rv = client.get('/user/cache/stats')
+    assert rv.status_code == 403
@@ -0,0 +1,55 @@
+from mongo import *
+from mongo import engine
+from tests import utils
+
+
+def setup_function(_):
+    ISandbox.use(utils.submission.MockSandbox)
+    utils.mongo.drop_db()
+
+
+def teardown_function(_):
+    ISandbox.use(None)
+
+
+def test_snapshot_is_filled_on_creation():
+    comment = utils.comment.lazy_add_comment()
+    problem = Problem(comment.problem)
+    for doc in (comment, problem):
+        assert doc.author_snapshot.username == doc.author.username
+        assert doc.author_info == {
+            k: v
+            for k, v in doc.author.info.items() if k != 'email'
+        }
+
+
+def test_snapshot_is_refreshed_on_user_update():
+    comment = utils.comment.lazy_add_comment()
+    author = User(comment.author)
+    author.update(display_name='Kaguya')
+    assert comment.reload().author_info['displayName'] == 'Kaguya'
+    # Unrelated updates don't touch the snapshot
+    comment.update(author_snapshot=None)
+    author.update(active=False)
+    assert comment.reload().author_snapshot is None
+
+
+def test_snapshot_is_refreshed_on_user_save():
+    comment = utils.comment.lazy_add_comment()
+    author = comment.author
+    author.display_name = 'Kaguya'
+    # Saving checks that the email isn't used by anyone, including itself
+    author.email = None
+    author.save()
+    assert comment.reload().author_info['displayName'] == 'Kaguya'
+
+
+def test_serialize_without_snapshot():
+    problem = utils.problem.lazy_add()
+    engine.Problem.objects(pk=problem.pk).update(author_snapshot=None)
+    problem.reload()
+    # Same shape as the snapshot
+    assert problem.to_dict()['author'] == {
+        k: v
+        for k, v in problem.author.info.items() if k != 'email'
+    }
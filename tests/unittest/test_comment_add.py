@@ -74,6 +74,32 @@ def test_add_comment_concurrent():
     assert sorted(r.floor for r in results) == [*range(1, cnt + 1)]
 
 
+def test_add_exclusive_comment_twice():
+    p = utils.problem.lazy_add(allow_multiple_comments=False)
+    u = utils.course.student(course=p.course)
+    utils.comment.lazy_add_comment(problem=p.pk, author=u)
+    # Rejected by the unique index of exclusive key
+    with pytest.raises(TooManyComments):
+        utils.comment.lazy_add_comment(problem=p.pk, author=u)
+    # The floor allocated by the rejected one is given back
+    assert p.reload('height').height == 1
+
+
+def test_disallow_multiple_comments_afterwards():
+    p = utils.problem.lazy_add(allow_multiple_comments=True)
+    u = utils.course.student(course=p.course)
+    cs = [
+        utils.comment.lazy_add_comment(problem=p.pk, author=u)
+        for _ in range(2)
+    ]
+    p.update(allow_multiple_comments=False)
+    p.reload()
+    with pytest.raises(TooManyComments):
+        utils.comment.lazy_add_comment(problem=p.pk, author=u)
+    # The earliest one holds the key
+    assert [c.reload().exclusive_key for c in cs] == [f'{u.id}:{p.pk}', None]
+
+
 # TODO: put these functions not related to add to right location
 
 
@@ -87,6 +113,41 @@ def test_like_comment():
     u.reload()
     assert c.obj in u.likes
     assert u.obj in c.liked
+    assert c.like_count == 1
+
+
+def test_unlike_comment():
+    c = utils.comment.lazy_add_comment()
+    u = utils.course.student(course=c.problem.course)
+    c.like(user=u)
+    c.like(user=u)
+    u.reload()
+    assert c.obj not in u.likes
+    assert u.obj not in c.reload().liked
+    assert c.like_count == 0
+
+
+def test_like_signal_follows_current_state():
+    c = utils.comment.lazy_add_comment()
+    u = utils.course.student(course=c.problem.course)
+    course = c.problem.course.id
+    c.like(user=u)
+    assert len(UserStats.statistic(u, [course])['likes']) == 1
+    # Unliked before the queued handler of like runs
+    c.update(pull__liked=u.pk, dec__like_count=1)
+    c.on_like_toggled(u)
+    assert UserStats.statistic(u, [course])['likes'] == []
+    c.on_like_toggled(u)
+    assert UserStats.statistic(u, [course])['likes'] == []
+
+
+def test_like_comment_concurrent():
+    c = utils.comment.lazy_add_comment()
+    users = [utils.course.student(course=c.problem.course) for _ in range(5)]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        [*executor.map(lambda u: Comment(c.pk).like(user=u), users)]
+    c.reload()
+    assert len(c.liked) == c.like_count == len(users)
 
 
 @pytest.mark.parametrize(
@@ -40,3 +40,13 @@ def test_delete_tree():
         r.reload()
     assert all(r.status == engine.Comment.Status.HIDDEN
                for r in rs), [r.status for r in rs]
+
+
+def test_comment_again_after_delete():
+    p = utils.problem.lazy_add(allow_multiple_comments=False)
+    u = utils.course.student(course=p.course)
+    c = utils.comment.lazy_add_comment(problem=p.pk, author=u)
+    with pytest.raises(TooManyComments):
+        utils.comment.lazy_add_comment(problem=p.pk, author=u)
+    c.delete()
+    utils.comment.lazy_add_comment(problem=p.pk, author=u)
@@ -1,7 +1,8 @@
 from typing import List
 import pytest
 from mongo import *
-from mongo import engine
+from mongo import engine, requirement
+from mongo.utils import get_redis_client
 from tests import utils
 
 
@@ -50,12 +51,37 @@ def test_course_statistic():
     c.add_student(student)
     c = c.reload()
 
-    assert c.statistic_file().readlines() == [
-        'username,problems,likes,comments,replies,liked,success,fail\n',
-        'student,0,0,0,0,0,0,0\n',
+    assert [*c.statistic_csv()] == [
+        'username,problems,likes,comments,replies,liked,success,fail\r\n',
+        'student,0,0,0,0,0,0,0\r\n',
     ]
 
 
+def test_course_statistic_rows_in_batches():
+    c = utils.course.lazy_add()
+    usernames = [f'student{i}' for i in range(5)]
+    for username in usernames:
+        c.add_student(utils.user.lazy_signup(username=username))
+    rows = c.reload().statistic_rows(batch_size=2)
+    assert [row['username'] for row in rows] == usernames
+
+
+def test_task_progress_of_many_students():
+    ISandbox.use(utils.submission.MockSandbox)
+    task = utils.task.lazy_add()
+    course = Course(task.course)
+    problem = utils.problem.lazy_add(is_oj=False, course=course)
+    requirement.LeaveComment.add(task=task, problem=problem)
+    requirement.ReplyToComment.add(task=task)
+    students = [utils.course.student(course=course) for _ in range(3)]
+    utils.comment.lazy_add_comment(problem=problem, author=students[0])
+    ISandbox.use(None)
+    task = engine.Task.objects.get(pk=task.pk)
+    progress = Course.task_progress(task, [u.id for u in students])
+    assert progress == {u.id: task.progress(u.obj) for u in students}
+    assert progress[students[0].id] == (1, 2)
+
+
 def test_course_oj_statistic():
     # Setup course and student
     c = utils.course.lazy_add()
@@ -96,6 +122,51 @@ def test_course_oj_statistic():
         assert user_stat[str(p.pid)] == problem_stat
 
 
+def test_course_oj_statistic_with_submissions():
+    ISandbox.use(utils.submission.MockSandbox)
+    c = utils.course.lazy_add()
+    passed = utils.user.lazy_signup(username='passed')
+    failed = utils.user.lazy_signup(username='failed')
+    c.add_student(passed)
+    c.add_student(failed)
+    p = utils.problem.lazy_add(course=c, author=c.teacher, is_oj=True)
+    comment = utils.comment.lazy_add_comment(author=passed, problem=p)
+    Submission(comment.submission.pk).complete(judge_result=1)
+    submission = comment.new_submission('print(1)', throttle=False)
+    submission.complete(judge_result=0)
+    comment = utils.comment.lazy_add_comment(author=failed, problem=p)
+    Submission(comment.submission.pk).complete(judge_result=1)
+    stat = c.oj_statistic([p])
+    ISandbox.use(None)
+    assert stat['overview'][str(p.pid)] == {
+        'acCount': 1,
+        'tryCount': 3,
+        'acUser': 1,
+        'tryUser': 2,
+    }
+    results = {
+        u['info']['username']: u[str(p.pid)]['result']
+        for u in stat['users']
+    }
+    assert results == {
+        'passed': User.OJProblemResult.PASS,
+        'failed': User.OJProblemResult.FAIL,
+    }
+    # The python evaluator should agree with the aggregation
+    submissions = engine.Submission.objects(problem=p.pid).as_pymongo()
+    students = [passed.id, failed.id]
+    expected = next(
+        engine.Submission.objects.aggregate(
+            c.oj_submission_pipeline([p.pid], students)))
+    result = c.evaluate_oj_submissions(submissions, students)
+    key = lambda t: t['commentId']
+    assert sorted(result['tries'], key=key) == sorted(
+        expected['tries'],
+        key=key,
+    )
+    assert result['acCount'] == expected['acCount']
+
+
 def test_course_permission():
     nobody = utils.user.lazy_signup(username='nobody')
     c = utils.course.lazy_add(status=engine.Course.Status.READONLY)
@@ -113,3 +184,148 @@ def test_course_permission():
     )
     nobody_permission = c.own_permission(user=nobody)
     assert nobody_permission == Course.Permission.READ
+
+
+def test_enrollment_follows_students():
+    c = utils.course.lazy_add(status=engine.Course.Status.PRIVATE)
+    other = utils.course.lazy_add()
+    student = utils.user.lazy_signup(username='student')
+    assert not c.permission(user=student, req=Course.Permission.PARTICIPATE)
+    c.add_student(student)
+    assert c.is_enrolled(student)
+    assert c.permission(user=student, req=Course.Permission.PARTICIPATE)
+    other.enroll([student.id])
+    # Enroll again should be ignored
+    other.enroll([student.id])
+    assert Course.enrolled_courses(student) == {c.id, other.id}
+    assert Course.enrolled_courses(student, [other]) == {other.id}
+    c.unenroll([student.id])
+    assert not c.is_enrolled(student)
+
+
+def test_course_claim():
+    c = utils.course.lazy_add(status=engine.Course.Status.PRIVATE)
+    student = utils.course.student(course=c)
+    payload = jwt_decode(student.cookie)['data']
+    claim = User.verify_claim(payload)
+    assert claim == {str(c.id): 'student'}
+    assert User.verify_claim(jwt_decode(User(c.teacher).cookie)['data']) == {
+        str(c.id): 'teacher'
+    }
+    # Permission of a user with claim is decided without querying course
+    # membership
+    lazy = User.lazy(student.id, role=student.role)
+    lazy.claim = claim
+    engine.Enrollment.objects(user=student.id).delete()
+    assert c.permission(user=lazy, req=Course.Permission.PARTICIPATE)
+    assert not c.permission(user=lazy, req=Course.Permission.WRITE)
+    assert '_lazy' in lazy.__dict__
+    # Membership changes make issued claims stale
+    c.unenroll([student.id])
+    assert User.verify_claim(payload) is None
+    assert User.verify_claim(jwt_decode(student.cookie)['data']) == {}
+
+
+def test_course_claim_after_version_lost():
+    c = utils.course.lazy_add(status=engine.Course.Status.PRIVATE)
+    student = utils.course.student(course=c)
+    payload = jwt_decode(student.cookie)['data']
+    assert User.verify_claim(payload) == {str(c.id): 'student'}
+    versions = EnrollmentVersion()
+    # A lost counter doesn't restart from a value issued claims have seen
+    for _ in range(2):
+        versions._client.delete(versions.key(student.id))
+        c.remove_students([student.id])
+        assert versions.get(student.id) > payload['courseClaim']['version']
+        assert User.verify_claim(payload) is None
+
+
+def test_remove_students():
+    ISandbox.use(utils.submission.MockSandbox)
+    c = utils.course.lazy_add()
+    student = utils.course.student(course=c)
+    other = utils.course.student(course=c)
+    own = utils.problem.lazy_add(
+        course=c,
+        author=student,
+        allow_multiple_comments=True,
+    )
+    kept = utils.problem.lazy_add(
+        course=c,
+        author=other,
+        allow_multiple_comments=True,
+    )
+    under_own = utils.comment.lazy_add_comment(problem=own.pk, author=other)
+    comment = utils.comment.lazy_add_comment(problem=kept.pk, author=student)
+    reply = utils.comment.lazy_add_reply(comment=comment, author=other)
+    liked = utils.comment.lazy_add_comment(
+        problem=kept.pk,
+        author=c.teacher,
+    )
+    liked.like(user=student)
+    comment.like(user=other)
+    assert UserStats.statistic(other, [c.id])['likes']
+    c.remove_students([student.id])
+    ISandbox.use(None)
+    assert not c.reload('students').is_enrolled(student)
+    assert student.obj not in c.students
+    assert c.obj not in student.reload('courses').courses
+    assert not Problem(own.pk)
+    assert not Comment(under_own.id)
+    assert Comment(comment.id).reload().status == engine.Comment.Status.HIDDEN
+    assert Comment(reply.id).reload().status == engine.Comment.Status.HIDDEN
+    liked.reload()
+    assert liked.liked == [] and liked.like_count == 0
+    assert UserStats.statistic(other, [c.id])['likes'] == []
+    assert c.reload('pending_purge').pending_purge == []
+
+
+def test_purge_skips_rejoined_students():
+    c = utils.course.lazy_add()
+    student = utils.course.student(course=c)
+    own = utils.problem.lazy_add(
+        course=c,
+        author=student,
+        allow_multiple_comments=True,
+    )
+    # Rejoin before the queued purge runs
+    c.update(
+        pull_all__students=[student.pk],
+        add_to_set__pending_purge=[student.pk],
+    )
+    c.add_students([student.pk])
+    c.purge_students([student.pk])
+    assert Problem(own.pk)
+    assert c.reload('pending_purge').pending_purge == []
+
+
+def test_resume_interrupted_purge():
+    c = utils.course.lazy_add()
+    student = utils.course.student(course=c)
+    rejoined = utils.course.student(course=c)
+    own = utils.problem.lazy_add(
+        course=c,
+        author=student,
+        allow_multiple_comments=True,
+    )
+    kept = utils.problem.lazy_add(
+        course=c,
+        author=rejoined,
+        allow_multiple_comments=True,
+    )
+    # Simulate a worker which died before purging
+    c.update(
+        pull_all__students=[student.pk, rejoined.pk],
+        add_to_set__pending_purge=[student.pk, rejoined.pk],
+    )
+    c.add_students([rejoined.pk])
+    # Another worker is resuming them
+    client = get_redis_client()
+    client.set(Course.RESUME_PURGES_LEASE, 1)
+    Course.resume_purges()
+    assert Problem(own.pk)
+    client.delete(Course.RESUME_PURGES_LEASE)
+    Course.resume_purges()
+    assert not Problem(own.pk)
+    assert Problem(kept.pk)
+    assert c.reload('pending_purge').pending_purge == []
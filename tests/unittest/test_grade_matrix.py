@@ -0,0 +1,53 @@
+import base64
+import numpy as np
+from mongo import *
+from mongo import engine
+from tests import utils
+
+
+def setup_function(_):
+    utils.mongo.drop_db()
+    ISandbox.use(utils.submission.MockSandbox)
+
+
+def teardown_function(_):
+    ISandbox.use(None)
+
+
+def test_grade_matrix():
+    c = utils.course.lazy_add()
+    passed = utils.user.lazy_signup(username='passed')
+    idle = utils.user.lazy_signup(username='idle')
+    c.add_student(passed)
+    c.add_student(idle)
+    ps = [
+        utils.problem.lazy_add(course=c, author=c.teacher, is_oj=True)
+        for _ in range(2)
+    ]
+    comment = utils.comment.lazy_add_comment(author=passed, problem=ps[1])
+    Submission(comment.submission.pk).complete(judge_result=0)
+    comment.like(user=idle)
+    matrix = GradeMatrix(c.reload())
+    assert matrix.problems == [p.pid for p in ps]
+    Acceptance = engine.Comment.Acceptance
+    assert matrix.acceptance.tolist() == [
+        [Acceptance.NOT_TRY, Acceptance.ACCEPTED],
+        [Acceptance.NOT_TRY, Acceptance.NOT_TRY],
+    ]
+    assert matrix.tries.tolist() == [[0, 1], [0, 0]]
+    assert matrix.likes.tolist() == [[0, 1], [0, 0]]
+    summary = matrix.summary()
+    assert summary['problems']['acRate'].tolist() == [0, 0.5]
+    assert summary['students']['acCount'].tolist() == [1, 0]
+    assert summary['percentiles']['50'] == 0.5
+
+
+def test_grade_matrix_base64_encoding():
+    c = utils.course.lazy_add()
+    c.add_student(utils.user.lazy_signup(username='student'))
+    utils.problem.lazy_add(course=c, author=c.teacher, is_oj=True)
+    data = GradeMatrix(c.reload()).to_dict('base64')
+    assert data['usernames'] == ['student']
+    tries = data['tries']
+    arr = np.frombuffer(base64.b64decode(tries['data']), dtype=tries['dtype'])
+    assert arr.reshape(tries['shape']).tolist() == [[0]]
@@ -0,0 +1,53 @@
+import secrets
+import pytest
+from mongo import *
+
+
+def random_limiter(**budgets):
+    return RateLimiter(secrets.token_hex(8), budgets)
+
+
+def test_consume_within_burst():
+    limiter = random_limiter(user=(1, 3))
+    for _ in range(3):
+        limiter.consume(user='user')
+    with pytest.raises(RateLimitExceeded) as err:
+        limiter.consume(user='user')
+    assert err.value.scope == 'user'
+    assert err.value.retry_after >= 1
+    assert limiter.metrics() == {'allowed': 3, 'rejected:user': 1}
+
+
+def test_buckets_are_independent():
+    limiter = random_limiter(user=(1, 1))
+    limiter.consume(user='a')
+    limiter.consume(user='b')
+    with pytest.raises(RateLimitExceeded):
+        limiter.consume(user='a')
+
+
+def test_rejected_request_does_not_consume_other_buckets():
+    limiter = random_limiter(user=(1, 1), course=(1, 2))
+    limiter.consume(user='a', course='c')
+    with pytest.raises(RateLimitExceeded) as err:
+        limiter.consume(user='a', course='c')
+    assert err.value.scope == 'user'
+    # The course bucket still has one token
+    limiter.consume(user='b', course='c')
+    with pytest.raises(RateLimitExceeded) as err:
+        limiter.consume(user='c', course='c')
+    assert err.value.scope == 'course'
+
+
+def test_scope_without_budget_is_unlimited():
+    limiter = random_limiter(user=(1, 1))
+    for _ in range(5):
+        limiter.consume(course='c')
+    assert limiter.metrics() == {}
+
+
+def test_read_budget_from_config():
+    budget = RateLimiter('submission').budget('user')
+    assert budget is not None
+    rate, burst = budget
+    assert rate > 0 and burst >= 1
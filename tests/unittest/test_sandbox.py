@@ -0,0 +1,183 @@
+import secrets
+import pytest
+import requests as rq
+from mongo import *
+from mongo import engine
+from mongo import sandbox as sandbox_lib
+from tests import utils
+
+
+def setup_function(_):
+    utils.mongo.drop_db()
+
+
+def random_url():
+    return f'http://{secrets.token_hex(8)}.sandbox'
+
+
+def add_sandbox(url=None):
+    return engine.Sandbox(
+        url=url or random_url(),
+        token=secrets.token_urlsafe(),
+    ).save(force_insert=True)
+
+
+def add_submission():
+    problem = utils.problem.lazy_add(allow_multiple_comments=True)
+    return utils.submission.lazy_add_new(
+        problem=problem,
+        test_submission=True,
+    )
+
+
+class MockResponse:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.text = ''
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+
+def test_circuit_opens_after_consecutive_failures():
+    health = SandboxHealth(random_url())
+    for _ in range(SandboxHealth.MIN_FAILURES - 1):
+        health.record(False, now=0)
+        assert health.snapshot(now=0)['state'] == SandboxHealth.State.CLOSED
+    health.record(False, now=0)
+    assert health.snapshot(now=0)['state'] == SandboxHealth.State.OPEN
+
+
+def test_circuit_half_open_after_cooldown():
+    health = SandboxHealth(random_url())
+    for _ in range(SandboxHealth.MIN_FAILURES):
+        health.record(False, now=0)
+    now = SandboxHealth.COOLDOWN
+    assert health.snapshot(now=now)['state'] == SandboxHealth.State.HALF_OPEN
+    # Failed probe opens the circuit again
+    health.record(False, now=now)
+    assert health.snapshot(now=now)['state'] == SandboxHealth.State.OPEN
+    # Succeeded probe closes it
+    now *= 2
+    health.record(True, 0.1, now=now)
+    assert health.snapshot(now=now)['state'] == SandboxHealth.State.CLOSED
+
+
+def test_route_excludes_open_sandbox():
+    healthy = add_sandbox()
+    broken = add_sandbox()
+    for _ in range(SandboxHealth.MIN_FAILURES):
+        SandboxHealth(broken.url).record(False)
+    assert SandboxHealth.route([healthy, broken]) == [healthy]
+
+
+def test_route_only_allows_one_probe():
+    sandbox = add_sandbox()
+    for _ in range(SandboxHealth.MIN_FAILURES):
+        SandboxHealth(sandbox.url).record(False, now=0)
+    assert SandboxHealth.route([sandbox]) == [sandbox]
+    assert SandboxHealth.route([sandbox]) == []
+
+
+def test_route_prefers_less_outstanding_requests():
+    busy = add_sandbox()
+    idle = add_sandbox()
+    for _ in range(3):
+        SandboxHealth(busy.url).dispatch(secrets.token_hex())
+    assert SandboxHealth.route([busy, idle]) == [idle, busy]
+
+
+def test_send_falls_back_to_next_sandbox(monkeypatch):
+    broken = add_sandbox()
+    healthy = add_sandbox()
+    posted = []
+
+    def post(url, **ks):
+        posted.append(url)
+        if url.startswith(broken.url):
+            raise rq.exceptions.ConnectionError
+        return MockResponse()
+
+    monkeypatch.setattr(sandbox_lib.rq, 'post', post)
+    # Make the broken one preferred
+    for _ in range(3):
+        SandboxHealth(healthy.url).dispatch(secrets.token_hex())
+    submission = add_submission()
+    assert Sandbox().send(submission=submission) is True
+    assert [url.rsplit('/', 1)[0] for url in posted] == [
+        broken.url,
+        healthy.url,
+    ]
+    # Token is assigned by the sandbox which receives the submission
+    assert Token(healthy.token).verify(str(submission.id))
+    assert SandboxHealth(broken.url).snapshot()['failures'] == 1
+    assert SandboxHealth(broken.url).snapshot()['inflight'] == 0
+
+
+def test_send_does_not_retry_after_read_timeout(monkeypatch):
+    add_sandbox()
+    add_sandbox()
+    posted = []
+
+    def post(url, **ks):
+        posted.append(url)
+        raise rq.exceptions.ReadTimeout
+
+    monkeypatch.setattr(sandbox_lib.rq, 'post', post)
+    submission = add_submission()
+    assert Sandbox().send(submission=submission) is True
+    # The first sandbox may still be judging it
+    assert len(posted) == 1
+    url = posted[0].rsplit('/', 1)[0]
+    assert SandboxHealth(url).snapshot()['failures'] == 1
+    assert SandboxHealth(url).snapshot()['inflight'] == 1
+
+
+def test_send_many_assigns_tokens_in_batch(monkeypatch):
+    broken = add_sandbox()
+    healthy = add_sandbox()
+    posted = []
+
+    def post(url, **ks):
+        posted.append(url)
+        if url.startswith(broken.url):
+            raise rq.exceptions.ConnectionError
+        return MockResponse()
+
+    monkeypatch.setattr(sandbox_lib.rq, 'post', post)
+    for _ in range(3):
+        SandboxHealth(healthy.url).dispatch(secrets.token_hex())
+    submissions = [add_submission() for _ in range(3)]
+    # The last one is still pending
+    Token(broken.token).assign(str(submissions[-1].id))
+    pending = Sandbox().send_many(submissions)
+    assert pending == [str(submissions[-1].id)]
+    # The rest skip the sandbox once it fails
+    assert [url.rsplit('/', 1)[0] for url in posted] == [
+        broken.url,
+        healthy.url,
+        healthy.url,
+    ]
+    for submission in submissions[:-1]:
+        assert Token(healthy.token).verify(str(submission.id))
+
+
+def test_send_without_available_sandbox():
+    submission = add_submission()
+    with pytest.raises(SandboxNotFound):
+        Sandbox().send(submission=submission)
+
+
+def test_complete_releases_inflight_submission(monkeypatch):
+    sandbox = add_sandbox()
+    monkeypatch.setattr(
+        sandbox_lib.rq,
+        'post',
+        lambda *args, **ks: MockResponse(),
+    )
+    submission = add_submission()
+    Sandbox().send(submission=submission)
+    assert SandboxHealth(sandbox.url).snapshot()['inflight'] == 1
+    submission.complete(judge_result=0)
+    assert SandboxHealth(sandbox.url).snapshot()['inflight'] == 0
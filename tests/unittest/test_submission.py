@@ -1,5 +1,6 @@
 import io
 import secrets
+from datetime import datetime, timedelta
 from tests import utils
 from mongo.comment import Comment
 from mongo.submission import Submission
@@ -72,7 +73,9 @@ def test_complete_multiple():
     except_outputs = ((secrets.token_hex(), secrets.token_hex())
                       for _ in range(10))
     for out, err in except_outputs:
-        submission.complete(
+        # rejudge
+        submission.submit()
+        assert submission.complete(
             files=[],
             stderr=err,
             stdout=out,
@@ -82,6 +85,35 @@ def test_complete_multiple():
         assert submission.result.stderr == err
 
 
+def test_duplicated_complete_is_ignored(monkeypatch):
+    problem = utils.problem.lazy_add(allow_multiple_comments=True)
+    submission = utils.submission.lazy_add_new(problem=problem)
+    assert submission.complete(
+        files=[],
+        stderr='',
+        stdout='first',
+        judge_result=0,
+    )
+    # Files of a duplicated result are not uploaded
+    uploaded = []
+    monkeypatch.setattr(
+        Submission,
+        'new_file',
+        lambda self, f, **ks: uploaded.append(f),
+    )
+    assert not submission.complete(
+        files=[FileStorage(io.BytesIO(b'second'), filename='out')],
+        stderr='err',
+        stdout='second',
+        judge_result=0,
+    )
+    assert uploaded == []
+    assert submission.reload().result.stdout == 'first'
+    comment = Comment(submission.comment)
+    assert comment.success == 1
+    assert comment.fail == 0
+
+
 def test_oj_problem_has_accepted_should_update():
     problem = utils.problem.lazy_add(
         allow_multiple_comments=True,
@@ -102,6 +134,57 @@ def test_oj_problem_has_accepted_should_update():
     assert problem.acceptance(user) == Comment.engine.Acceptance.ACCEPTED
 
 
+def test_oj_acceptance_is_sticky():
+    problem = utils.problem.lazy_add(
+        allow_multiple_comments=True,
+        is_oj=True,
+    )
+    comment = utils.comment.lazy_add_comment(problem=problem)
+    AC = Submission.engine.JudgeResult.AC
+    WA = Submission.engine.JudgeResult.WA
+    Submission(comment.submission.pk).complete(judge_result=AC)
+    assert comment.reload().acceptance == Comment.engine.Acceptance.ACCEPTED
+    # A later failed submission doesn't reject the comment
+    submission = comment.add_new_submission('print("oops")')
+    submission.complete(judge_result=WA)
+    assert comment.reload().acceptance == Comment.engine.Acceptance.ACCEPTED
+    assert comment.success == 2
+
+
+def test_oj_rejudge_accepted_submission_as_wrong():
+    problem = utils.problem.lazy_add(
+        allow_multiple_comments=True,
+        is_oj=True,
+    )
+    comment = utils.comment.lazy_add_comment(problem=problem)
+    AC = Submission.engine.JudgeResult.AC
+    WA = Submission.engine.JudgeResult.WA
+    submission = Submission(comment.submission.pk)
+    submission.complete(judge_result=AC)
+    assert comment.reload().acceptance == Comment.engine.Acceptance.ACCEPTED
+    # Rejudge, the only AC submission becomes WA
+    comment.submit()
+    submission.reload().complete(judge_result=WA)
+    assert comment.reload().acceptance == Comment.engine.Acceptance.REJECTED
+
+
+def test_oj_rejudge_with_other_accepted_submission():
+    problem = utils.problem.lazy_add(
+        allow_multiple_comments=True,
+        is_oj=True,
+    )
+    comment = utils.comment.lazy_add_comment(problem=problem)
+    AC = Submission.engine.JudgeResult.AC
+    WA = Submission.engine.JudgeResult.WA
+    Submission(comment.submission.pk).complete(judge_result=AC)
+    other = comment.add_new_submission('print("again")')
+    other.complete(judge_result=AC)
+    # Rejudge the latest one, the first submission is still accepted
+    comment.reload().submit()
+    Submission(other.pk).complete(judge_result=WA)
+    assert comment.reload().acceptance == Comment.engine.Acceptance.ACCEPTED
+
+
 def test_problem_file_is_correct():
     problem = utils.problem.lazy_add(
         allow_multiple_comments=True,
@@ -113,3 +196,52 @@ def test_problem_file_is_correct():
     with zipfile.ZipFile(problem.get_file()[0][1][1]) as zip_ref:
         assert zip_ref.read('input') == b'in'
         assert zip_ref.read('output') == b'out'
+
+
+def test_judge_stages_are_traced():
+    problem = utils.problem.lazy_add(allow_multiple_comments=True)
+    submission = utils.submission.lazy_add_new(problem=problem)
+    submission.dispatched('http://test.sandbox')
+    submission.complete(judge_result=0)
+    trace = submission.reload().trace
+    assert trace.queued <= trace.dispatched <= trace.completed <= trace.handled
+    assert trace.sandbox == 'http://test.sandbox'
+    # Late dispatch record doesn't change a completed submission
+    submission.dispatched('http://other.sandbox')
+    assert submission.reload().trace == trace
+
+
+def test_rejudge_starts_new_attempt():
+    problem = utils.problem.lazy_add(allow_multiple_comments=True)
+    submission = utils.submission.lazy_add_new(problem=problem)
+    assert submission.reload().trace.created == submission.timestamp
+    submission.complete(judge_result=0)
+    submission.update(timestamp=datetime.now() - timedelta(days=7))
+    submission.reload().submit()
+    trace = submission.reload().trace
+    # Queue time of a rejudge starts when it's requested
+    assert trace.created == trace.queued
+    # Rejudged old submissions are counted in the window
+    stat = Submission.latency_statistic(timedelta(hours=1))
+    assert stat['stages']['queue']['count'] == 1
+    assert stat['stages']['queue']['p99'] == 0
+
+
+def test_latency_statistic():
+    problem = utils.problem.lazy_add(allow_multiple_comments=True)
+    now = datetime.now()
+    for i in range(1, 101):
+        submission = utils.submission.lazy_add_new(problem=problem)
+        submission.update(trace=Submission.engine.Trace(
+            queued=now,
+            dispatched=now + timedelta(seconds=1),
+            sandbox='http://test.sandbox',
+            completed=now + timedelta(seconds=1 + i),
+            handled=now + timedelta(seconds=1 + i),
+        ))
+    stat = Submission.latency_statistic(timedelta(hours=1))
+    judge = stat['stages']['judge']
+    assert judge['count'] == 100
+    assert (judge['p50'], judge['p95'], judge['p99']) == (50, 95, 99)
+    assert stat['sandboxes']['http://test.sandbox']['judge'] == judge
+    assert stat['stages']['dispatch']['p99'] == 1
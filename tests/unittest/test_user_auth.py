@@ -2,6 +2,7 @@ from mongo.utils import hash_id
 import pytest
 import secrets
 from mongo import *
+from mongo import engine
 from tests import utils
 
 
@@ -66,3 +67,87 @@ def test_change_password():
             u.email,
             password,
         ) == u
+
+
+def test_lazy_user_is_loaded_on_demand():
+    u = utils.user.lazy_signup()
+    lazy = User.lazy(u.id, role=u.role)
+    assert lazy.id == u.id
+    assert lazy.role == u.role
+    assert lazy
+    assert 'obj' not in vars(lazy)
+    assert lazy.username == u.username
+    assert lazy.obj == u.obj
+
+
+def test_signed_token_is_reused_until_claims_change():
+    u = utils.user.lazy_signup()
+    cookie = u.cookie
+    assert User.lazy(u.id).cookie == cookie
+    assert u.secret != cookie
+    # Changing user document signs a new token
+    u.update(display_name='another name')
+    new_cookie = u.cookie
+    assert new_cookie != cookie
+    assert jwt_decode(new_cookie)['data']['displayName'] == 'another name'
+    # So does changing course membership
+    c = utils.course.lazy_add()
+    c.enroll([u.id])
+    assert u.cookie != new_cookie
+    assert jwt_decode(u.cookie)['data']['courseClaim']['courses'] == {
+        str(c.id): 'student'
+    }
+    # Login tokens are credentials, they are never cached
+    secret = u.secret
+    redis = get_redis_client()
+    assert secret.encode() not in redis.mget(redis.keys(f'jwt:{u.id}:*'))
+
+
+def test_token_signed_before_invalidation_is_not_cached():
+    u = utils.user.lazy_signup()
+    cache = TokenCache()
+    digest = cache.digest(['displayName'], None, {})
+    generation = cache.generation(u.id)
+    # The user is updated while the token is being signed
+    cache.invalidate(u.id)
+    cache.set(u.id, digest, 'stale token', generation)
+    assert cache.get(u.id, digest) is None
+    cache.set(u.id, digest, 'token', cache.generation(u.id))
+    assert cache.get(u.id, digest) == 'token'
+
+
+def test_batch_signup():
+    c = utils.course.lazy_add()
+    old = utils.user.lazy_signup()
+
+    def row(username, **ks):
+        return {
+            'username': username,
+            'password': 'password',
+            'display_name': '',
+            'school': '',
+            'role': engine.User.Role.STUDENT,
+            **ks,
+        }
+
+    users, exists, fails = User.batch_signup(
+        [
+            row('alice'),
+            row(old.username, school=old.school),
+            row('x' * 17),
+            row('bob', password=''),
+            row('alice'),
+        ],
+        course=c.obj,
+    )
+    assert [*users] == [(old.school, old.username), ('', 'alice')]
+    # Rows after the first one of the same user are treated as existing
+    assert exists == [(old.school, old.username), ('', 'alice')]
+    assert [f['username'] for f in fails] == ['x' * 17, 'bob']
+    alice = User(users[('', 'alice')])
+    assert User.login('', 'alice', 'password') == alice
+    assert alice.display_name == 'alice'
+    c.reload('students')
+    assert {*c.students} == {old.obj, alice.obj}
+    assert c.is_enrolled(alice) and c.is_enrolled(old)
+    assert c.obj in alice.courses and c.obj in old.reload('courses').courses
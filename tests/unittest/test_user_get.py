@@ -1,5 +1,6 @@
 import pytest
 from mongo import *
+from mongo import engine
 from tests import utils
 
 
@@ -47,3 +48,56 @@ def test_can_not_get_email_with_none():
     utils.user.lazy_signup(has_email=False)
     with pytest.raises(DoesNotExist):
         User.get_by_email(None)
+
+
+def test_info_many():
+    users = [utils.user.lazy_signup() for _ in range(5)]
+    infos = User.info_many(users)
+    assert infos == [u.info for u in users]
+    # Second call is served from cache
+    stats = UserInfoCache().stats()
+    assert User.info_many(reversed(users)) == infos[::-1]
+    assert UserInfoCache().stats()['hit'] == stats['hit'] + len(users)
+
+
+def test_info_cache_invalidated_on_update():
+    u = utils.user.lazy_signup()
+    assert User.info_many([u])[0]['displayName'] == u.display_name
+    u.update(display_name='Hayasaka')
+    assert User.info_many([u])[0]['displayName'] == 'Hayasaka'
+    u.change_password('new-password')
+    u.update(email='hayasaka@noj.tw')
+    assert User.info_many([u])[0]['email'] == 'hayasaka@noj.tw'
+
+
+def test_info_invalidated_while_loading_is_not_cached(monkeypatch):
+    u = utils.user.lazy_signup()
+    objects = engine.User.objects
+
+    def load(**ks):
+        users = [*objects(**ks)]
+        monkeypatch.undo()
+        # Updated after the info is loaded
+        u.update(display_name='Hayasaka')
+        return users
+
+    monkeypatch.setattr(engine.User, 'objects', load)
+    assert User.info_many([u])[0]['displayName'] != 'Hayasaka'
+    assert User.info_many([u])[0]['displayName'] == 'Hayasaka'
+
+
+def test_relations_are_not_embedded_in_user():
+    ISandbox.use(utils.submission.MockSandbox)
+    problem = utils.problem.lazy_add(allow_multiple_comments=True)
+    author = utils.course.student(course=problem.course)
+    liker = utils.course.student(course=problem.course)
+    comment = utils.comment.lazy_add_comment(author=author, problem=problem)
+    comment.like(user=liker)
+    ISandbox.use(None)
+    user = author.reload().to_mongo()
+    for field in ('problems', 'comments', 'likes', 'notifs'):
+        assert field not in user
+    assert [c.id for c in author.comments] == [comment.id]
+    assert [c.id for c in liker.likes] == [comment.id]
+    assert [p.pid for p in User(problem.author).problems] == [problem.pid]
+    assert author.notifs.count() == 1
@@ -0,0 +1,153 @@
+from mongo import *
+from mongo import engine
+from tests import utils
+
+
+def setup_function(_):
+    utils.mongo.drop_db()
+    ISandbox.use(utils.submission.MockSandbox)
+
+
+def teardown_function(_):
+    ISandbox.use(None)
+
+
+def setup_course():
+    problem = utils.problem.lazy_add(
+        is_oj=False,
+        allow_multiple_comments=True,
+    )
+    course = Course(problem.course)
+    author = utils.user.Factory.student()
+    liker = utils.user.Factory.student()
+    course.add_student(author)
+    course.add_student(liker)
+    return problem, author.reload(), liker.reload()
+
+
+def test_stats_are_built_on_first_read():
+    problem, author, _ = setup_course()
+    comment = utils.comment.lazy_add_comment(author=author, problem=problem)
+    assert UserStats.engine.objects.count() == 0
+    stats = author.statistic()
+    assert [c['id'] for c in stats['comments']] == [comment.id]
+    assert UserStats.engine.objects(user=author.id).count() == 1
+
+
+def test_events_update_existing_stats():
+    problem, author, liker = setup_course()
+    # Build stats before any activity
+    author.statistic()
+    liker.statistic()
+    comment = utils.comment.lazy_add_comment(author=author, problem=problem)
+    reply = utils.comment.lazy_add_reply(comment=comment, author=author)
+    comment.like(user=liker)
+    Submission(comment.submission.pk).complete(judge_result=0)
+    stats = author.statistic()
+    assert [c['id'] for c in stats['comments']] == [comment.id]
+    assert [r['id'] for r in stats['replies']] == [reply.id]
+    assert [i['success'] for i in stats['execInfo']] == [1]
+    starers = stats['liked'][0]['starers']
+    assert [s['id'] for s in starers] == [liker.id]
+    likes = liker.statistic()['likes']
+    assert [like['id'] for like in likes] == [comment.id]
+    assert likes[0]['staree']['id'] == author.id
+    # Incremental result should be identical to the rebuilt one
+    UserStats.rebuild(author, problem.course)
+    UserStats.rebuild(liker, problem.course)
+    assert author.statistic() == stats
+    assert liker.statistic()['likes'] == likes
+
+
+def test_unlike_and_delete_are_removed_from_stats():
+    problem, author, liker = setup_course()
+    comment = utils.comment.lazy_add_comment(author=author, problem=problem)
+    author.statistic()
+    liker.statistic()
+    comment.like(user=liker)
+    comment.like(user=liker)
+    assert liker.statistic()['likes'] == []
+    assert author.statistic()['liked'] == []
+    comment.like(user=liker)
+    Comment(comment.pk).delete()
+    assert liker.statistic()['likes'] == []
+    assert author.statistic()['comments'] == []
+
+
+def test_created_problem_is_recorded():
+    problem, _, _ = setup_course()
+    teacher = User(problem.author)
+    assert len(teacher.statistic()['problems']) == 1
+    new_problem = utils.problem.lazy_add(
+        author=teacher,
+        course=problem.course,
+    )
+    pids = [p['pid'] for p in teacher.statistic()['problems']]
+    assert pids == [problem.pid, new_problem.pid]
+
+
+def test_rebuild_all():
+    problem, author, _ = setup_course()
+    utils.comment.lazy_add_comment(author=author, problem=problem)
+    UserStats.rebuild_all()
+    # teacher and 2 students
+    assert UserStats.engine.objects.count() == 3
+    assert len(author.statistic()['comments']) == 1
+
+
+def test_statistic_keeps_course_order():
+    problems = [
+        utils.problem.lazy_add(is_oj=False, allow_multiple_comments=True)
+        for _ in range(3)
+    ]
+    author = utils.user.Factory.student()
+    for p in problems:
+        Course(p.course).add_student(author)
+        utils.comment.lazy_add_comment(author=author, problem=p)
+    courses = [p.course.id for p in problems]
+
+    def course_ids(stats):
+        return [c['course']['id'] for c in stats['comments']]
+
+    assert course_ids(author.reload().statistic()) == courses
+    assert course_ids(author.statistic(courses[::-1])) == courses[::-1]
+    # Courses with activity are included even if the user is not a member
+    engine.User.objects(pk=author.pk).update(pull__courses=courses[0])
+    assert course_ids(
+        author.reload().statistic()) == [*courses[1:], courses[0]]
+
+
+def test_likes_order_does_not_depend_on_build():
+    problem, author, liker = setup_course()
+    comments = [
+        utils.comment.lazy_add_comment(author=author, problem=problem)
+        for _ in range(3)
+    ]
+    liker.statistic()
+    # Like them in reverse order
+    for comment in comments[::-1]:
+        comment.like(user=liker)
+    likes = liker.statistic()['likes']
+    assert [like['id'] for like in likes] == [c.id for c in comments]
+    UserStats.rebuild(liker, problem.course)
+    assert liker.statistic()['likes'] == likes
+
+
+def test_rebuild_does_not_overwrite_events(monkeypatch):
+    problem, author, liker = setup_course()
+    comment = utils.comment.lazy_add_comment(author=author, problem=problem)
+    author.statistic()
+    load = UserStats.load_from_scratch
+    events = []
+
+    def load_with_event(user, course):
+        stats = load(user, course)
+        # A like comes after the documents are loaded
+        if not events:
+            events.append(comment.like(user=liker))
+        return stats
+
+    monkeypatch.setattr(UserStats, 'load_from_scratch', load_with_event)
+    UserStats.rebuild(author, problem.course)
+    starers = author.statistic()['liked'][0]['starers']
+    assert [s['id'] for s in starers] == [liker.id]
@@ -0,0 +1,20 @@
+import threading
+import time
+from mongo import utils
+
+
+def test_background_tasks_run_in_order(monkeypatch):
+    monkeypatch.setattr(utils, 'config', {'TESTING': False})
+    results = []
+    done = threading.Event()
+
+    def task(i, delay):
+        time.sleep(delay)
+        results.append(i)
+
+    # The earlier one is slower but still runs first
+    utils.run_in_background(task, 0, 0.05)
+    utils.run_in_background(task, 1, 0)
+    utils.run_in_background(done.set)
+    assert done.wait(timeout=5)
+    assert results == [0, 1]